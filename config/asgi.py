@@ -3,6 +3,11 @@ ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Con uvicorn, las vistas asíncronas de importación (core/views.py) esperan a
+Databricks sin ocupar un hilo:
+
+    uvicorn config.asgi:application --host 0.0.0.0 --port 8000 --workers 2
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -14,7 +14,8 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 
-# Cargar variables del archivo .env (si existe)
+# Cargar variables del archivo .env (si existe). Es el único sitio donde se
+# carga: settings se importa antes que cualquier otro módulo del proyecto.
 load_dotenv()
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -54,11 +55,15 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    'core.compresion.CompresionMiddleware',  # Brotli/gzip (y MINIFICAR_HTML) de las respuestas de texto
+    'core.instrumentacion.InstrumentacionMiddleware',  # Solo activo con INSTRUMENTACION=True
+    'core.metricas.MetricasMiddleware',  # Latencia por vista para /metricas/ (METRICAS=False lo desactiva)
+    'core.asincrono.WhiteNoiseAsincronoMiddleware',  # WhiteNoise sin forzar un hilo por petición en ASGI
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.perfilador.PerfiladorMiddleware',  # ?_perfil=1 (staff) o PERFIL_FRACCION_ALEATORIA
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -87,11 +92,194 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+#
+# DB_ENGINE=sqlite   -> fichero local en modo WAL: los lectores no se bloquean
+#                       mientras una sincronización escribe
+# DB_ENGINE=postgres -> PostgreSQL con pool de conexiones de psycopg (DB_POOL=True)
+#                       o conexiones persistentes (CONN_MAX_AGE)
+
+DB_ENGINE = os.environ.get("DB_ENGINE", "sqlite")
+
+# Segundos que se reutiliza una conexión entre peticiones (0 = una por petición)
+CONN_MAX_AGE = int(os.environ.get("CONN_MAX_AGE", "60"))
+
+# PRAGMAs que se aplican a cada conexión SQLite nueva
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',       # lectores y escritor concurrentes
+    'synchronous': 'NORMAL',     # seguro con WAL y mucho más rápido que FULL
+    'mmap_size': int(os.environ.get("SQLITE_MMAP_MB", "256")) * 1024 * 1024,
+    'cache_size': -20000,        # ~20 MB de caché de páginas por conexión
+    'temp_store': 'MEMORY',
+}
+
+if DB_ENGINE == "postgres":
+    DB_POOL = os.environ.get("DB_POOL", "True") == "True"
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get("DB_NAME", "farmaswitch"),
+            'USER': os.environ.get("DB_USER", "farmaswitch"),
+            'PASSWORD': os.environ.get("DB_PASSWORD", ""),
+            'HOST': os.environ.get("DB_HOST", "localhost"),
+            'PORT': os.environ.get("DB_PORT", "5432"),
+            # Con pool las conexiones las gestiona psycopg (Django exige CONN_MAX_AGE=0)
+            'CONN_MAX_AGE': 0 if DB_POOL else CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get("DB_POOL_MIN", "2")),
+                    'max_size': int(os.environ.get("DB_POOL_MAX", "10")),
+                    'timeout': 10,
+                },
+            } if DB_POOL else {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get("SQLITE_PATH", BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            'OPTIONS': {
+                'init_command': ';'.join(f'PRAGMA {k}={v}' for k, v in SQLITE_PRAGMAS.items()),
+                # Segundos que una escritura espera a que se libere el bloqueo
+                'timeout': int(os.environ.get("SQLITE_BUSY_TIMEOUT", "20")),
+                # Las transacciones toman el bloqueo de escritura al empezar:
+                # evita errores "database is locked" al promocionar lecturas a escrituras
+                'transaction_mode': 'IMMEDIATE',
+            },
+        }
+    }
+
+
+# Caché
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Las claves de datos llevan la versión de la farmacia (core/cache_utils.py),
+# así que una sincronización invalida su caché sin tener que borrar nada.
+#
+# CACHE_BACKEND=sqlite -> fichero SQLite compartido por todos los workers de
+#                         gunicorn (por defecto, ver core/cache_backends.py)
+# CACHE_BACKEND=locmem -> caché por proceso: solo para desarrollo o un único
+#                         worker; con varios, una sincronización invalidaría
+#                         solo la caché de uno (core/checks.py lo impide)
+
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "sqlite")
+
+if CACHE_BACKEND == "sqlite":
+    CACHES = {
+        'default': {
+            'BACKEND': 'core.cache_backends.SQLiteCache',
+            'LOCATION': os.environ.get("CACHE_PATH", str(BASE_DIR / 'farma_cache.sqlite3')),
+            'OPTIONS': {
+                'MAX_ENTRIES': int(os.environ.get("CACHE_MAX_ENTRIES", "20000")),
+                'MAX_SIZE': int(os.environ.get("CACHE_MAX_SIZE_MB", "256")) * 1024 * 1024,
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'farma-cache',
+            'OPTIONS': {
+                'MAX_ENTRIES': 5000,
+            },
+        }
     }
+
+# Vida (segundos) de los datos y fragmentos cacheados por farmacia
+FARMA_CACHE_TIMEOUT = int(os.environ.get("FARMA_CACHE_TIMEOUT", "3600"))
+
+# Los tests llevan los ficheros SQLite de ejecución a un directorio temporal
+TEST_RUNNER = 'core.test_runner.DiscoverRunnerFarma'
+
+
+# Origen de los datos de sincronización (core/db_utils.databricks_connection)
+# DATABRICKS_BACKEND=databricks -> warehouse real (DATABRICKS_* en .env)
+# DATABRICKS_BACKEND=local -> SQLite con datos sintéticos (core/warehouse_local.py),
+#   para desarrollar, testear y hacer benchmarks sin red ni credenciales.
+
+DATABRICKS_BACKEND = os.environ.get("DATABRICKS_BACKEND", "databricks")
+WAREHOUSE_LOCAL_PATH = os.environ.get("WAREHOUSE_LOCAL_PATH", str(BASE_DIR / 'warehouse_local.sqlite3'))
+
+# Hilos por proceso para las llamadas bloqueantes al warehouse desde las vistas
+# asíncronas (core/asincrono.py). Acota cuántas consultas lentas a Databricks
+# hay a la vez sin tocar los hilos que atienden el resto de páginas.
+WAREHOUSE_HILOS = int(os.environ.get("WAREHOUSE_HILOS", "8"))
+
+
+# Sesiones
+# https://docs.djangoproject.com/en/5.2/topics/http/sessions/
+# La sesión solo guarda la farmacia activa y el estado compacto de los
+# exámenes (core/estado_examen.py). Por defecto cached_db: se lee de la caché
+# compartida y se puede revocar en el servidor (cerrar sesión, borrar filas).
+#
+# SESSION_BACKEND=cached_db -> caché + base de datos (por defecto). Cada
+#   respuesta del examen cambia la sesión y escribe su fila de django_session
+# SESSION_BACKEND=signed_cookies -> cookie firmada: solo con este backend
+#   responder el examen no escribe en BD. A cambio no se puede revocar en el
+#   servidor, una cookie antigua sigue siendo válida hasta que caduca y todo
+#   lo que se guarde en la sesión debe caber en 4 KB (límite de los navegadores;
+#   el estado de los dos exámenes ocupa unos cientos de bytes) (opcional)
+# SESSION_BACKEND=cache / db -> resto de backends estándar de Django
+
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "cached_db")
+SESSION_ENGINE = f"django.contrib.sessions.backends.{SESSION_BACKEND}"
+
+
+# Instrumentación por petición (core/instrumentacion.py)
+# Con INSTRUMENTACION=True cada respuesta lleva la cabecera Server-Timing,
+# se escribe una línea JSON por petición en el logger core.instrumentacion y
+# staff puede ver los percentiles por vista en /rendimiento/. Desactivada,
+# el middleware se descarta al arrancar y no añade coste.
+
+INSTRUMENTACION = os.environ.get("INSTRUMENTACION", "False") == "True"
+
+# Perfilador bajo demanda (core/perfilador.py)
+# Staff: ?_perfil=1 (muestreo) o ?_perfil=cprofile (determinista); el perfil
+# queda en el admin (Perfiles de petición) para descargarlo.
+# PERFIL_FRACCION_ALEATORIA=0.001 perfila por muestreo 1 de cada 1000 peticiones.
+
+PERFIL_FRACCION_ALEATORIA = float(os.environ.get("PERFIL_FRACCION_ALEATORIA", "0"))
+PERFIL_INTERVALO_MS = float(os.environ.get("PERFIL_INTERVALO_MS", "5"))
+PERFIL_MAX_CONSULTAS = 500
+PERFIL_MAX_GUARDADOS = int(os.environ.get("PERFIL_MAX_GUARDADOS", "200"))
+
+# Métricas Prometheus (core/metricas.py) en /metricas/
+# Cada worker acumula en memoria y vuelca cada METRICAS_VOLCADO_S segundos a
+# un fichero SQLite compartido; el endpoint suma el de todos los workers.
+# Prometheus se autentica con "Authorization: Bearer $METRICAS_TOKEN".
+# Opcional (METRICAS=True): desactivadas no se crea el fichero ni el hilo de volcado.
+
+METRICAS = os.environ.get("METRICAS", "False") == "True"
+METRICAS_PATH = os.environ.get("METRICAS_PATH", str(BASE_DIR / 'farma_metricas.sqlite3'))
+METRICAS_VOLCADO_S = float(os.environ.get("METRICAS_VOLCADO_S", "1"))
+METRICAS_TOKEN = os.environ.get("METRICAS_TOKEN", "")
+
+# Compresión de respuestas (core/compresion.py)
+# Brotli si el navegador lo acepta y está instalado el paquete, si no gzip.
+# Calidad de Brotli 5 y nivel de gzip 6: casi toda la reducción sin que
+# comprimir cueste más que lo que se ahorra en la red.
+# MINIFICAR_HTML=True quita además la sangría de las plantillas.
+
+COMPRESION_MINIMO = int(os.environ.get("COMPRESION_MINIMO", "1024"))
+COMPRESION_BROTLI_CALIDAD = int(os.environ.get("COMPRESION_BROTLI_CALIDAD", "5"))
+COMPRESION_GZIP_NIVEL = int(os.environ.get("COMPRESION_GZIP_NIVEL", "6"))
+MINIFICAR_HTML = os.environ.get("MINIFICAR_HTML", "False") == "True"
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'core.instrumentacion': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
 }
 
 
@@ -139,6 +327,14 @@ NUMBER_GROUPING = 3
 # Configuración de Archivos Multimedia (Imágenes)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Los ficheros de MEDIA_ROOT los sirve core.views.servir_media (también con DEBUG=False)
+# con ETag y caché larga. Si Nginx tiene una location interna apuntando a MEDIA_ROOT,
+# p. ej. MEDIA_X_ACCEL_REDIRECT=/media-interna/, Django solo valida la petición y el
+# envío del fichero lo hace Nginx (X-Accel-Redirect)
+MEDIA_X_ACCEL_REDIRECT = os.environ.get('MEDIA_X_ACCEL_REDIRECT', '')
+# Caché de las fotos originales (su URL no cambia si cambia la foto); las variantes
+# con hash en el nombre se sirven como inmutables durante un año
+MEDIA_MAX_AGE = int(os.environ.get('MEDIA_MAX_AGE', 7 * 24 * 3600))
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
@@ -146,6 +342,15 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR / "staticfiles"
 
+# collectstatic añade el hash del contenido al nombre (manifiesto) y precomprime
+# cada fichero en .gz (y .br si está instalado Brotli). WhiteNoise sirve los
+# nombres con hash como inmutables (un año de caché) y elige la versión comprimida
+# según Accept-Encoding
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"},
+}
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -1,8 +1,17 @@
 # core/admin.py
+import json
+
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
-from .models import Oportunidad, Preferencia, PerfilFarmacia # Asegúrate de importar PerfilFarmacia
+from django.core.exceptions import PermissionDenied
+from django.db.models import Avg
+from django.db.models.functions import TruncDate
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
+from .models import Oportunidad, Preferencia, PerfilFarmacia, PerfilPeticion, EjecucionSync # Asegúrate de importar PerfilFarmacia
 
 # 1. Definimos el perfil en línea (para que salga dentro de la ficha de usuario)
 class PerfilInline(admin.StackedInline):
@@ -20,4 +29,142 @@ admin.site.register(User, UserAdmin)
 
 # Registramos tus otros modelos también para verlos
 admin.site.register(Oportunidad)
-admin.site.register(Preferencia)
\ No newline at end of file
+admin.site.register(Preferencia)
+
+
+# 4. Perfiles de rendimiento (core/perfilador.py): solo lectura + descargas
+@admin.register(PerfilPeticion)
+class PerfilPeticionAdmin(admin.ModelAdmin):
+    list_display = ('creado', 'metodo', 'ruta', 'farmacia_id', 'modo', 'aleatorio', 'duracion_ms', 'num_consultas', 'bd_ms')
+    list_filter = ('modo', 'aleatorio', 'vista', 'farmacia_id')
+    search_fields = ('ruta', 'farmacia_id')
+    exclude = ('funciones', 'consultas', 'pilas', 'pstats')
+    readonly_fields = (
+        'creado', 'usuario', 'farmacia_id', 'metodo', 'ruta', 'vista', 'estado', 'modo', 'aleatorio',
+        'duracion_ms', 'num_consultas', 'bd_ms', 'descargas', 'tabla_funciones', 'tabla_consultas',
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/descargar/<str:formato>/', self.admin_site.admin_view(self.descargar),
+                 name='core_perfilpeticion_descargar'),
+        ] + super().get_urls()
+
+    def descargar(self, request, pk, formato):
+        # admin_view solo exige staff: las descargas llevan SQL con parámetros y pilas
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        perfil = get_object_or_404(PerfilPeticion, pk=pk)
+        if formato == 'pilas' and perfil.pilas:
+            response = HttpResponse(perfil.pilas, content_type='text/plain; charset=utf-8')
+            nombre = f'perfil_{pk}.folded'
+        elif formato == 'pstats' and perfil.pstats:
+            response = HttpResponse(bytes(perfil.pstats), content_type='application/octet-stream')
+            nombre = f'perfil_{pk}.prof'
+        elif formato == 'sql':
+            response = HttpResponse(json.dumps(perfil.consultas, indent=2), content_type='application/json')
+            nombre = f'perfil_{pk}_sql.json'
+        else:
+            raise Http404
+        response['Content-Disposition'] = f'attachment; filename="{nombre}"'
+        return response
+
+    @admin.display(description='Descargas')
+    def descargas(self, obj):
+        formatos = [('sql', 'SQL (JSON)')]
+        if obj.pilas:
+            formatos.insert(0, ('pilas', 'Pilas colapsadas (flamegraph / speedscope)'))
+        if obj.pstats:
+            formatos.insert(0, ('pstats', 'Volcado cProfile (snakeviz)'))
+        return format_html_join(
+            ' · ', '<a href="{}">{}</a>',
+            ((reverse('admin:core_perfilpeticion_descargar', args=[obj.pk, f]), texto) for f, texto in formatos),
+        )
+
+    @admin.display(description='Funciones principales')
+    def tabla_funciones(self, obj):
+        filas = format_html_join(
+            '', '<tr><td>{}</td><td style="text-align:right">{}</td><td style="text-align:right">{}</td><td style="text-align:right">{}</td></tr>',
+            ((f['funcion'], f['total_ms'], f['propio_ms'], f['llamadas'] or '') for f in obj.funciones),
+        )
+        return format_html(
+            '<table><tr><th>Función</th><th>Total ms</th><th>Propio ms</th><th>Llamadas</th></tr>{}</table>', filas
+        )
+
+    @admin.display(description='Consultas SQL')
+    def tabla_consultas(self, obj):
+        filas = format_html_join(
+            '', '<tr><td style="text-align:right">{}</td><td><code>{}</code></td></tr>',
+            ((c['ms'], c['sql']) for c in sorted(obj.consultas, key=lambda c: c['ms'], reverse=True)),
+        )
+        return format_html('<table><tr><th>ms</th><th>SQL</th></tr>{}</table>', filas)
+
+
+# 5. Histórico de sincronizaciones con gráficos de tendencia
+def _tendencia_sync(queryset, max_farmacias=8):
+    """
+    Medias diarias para los gráficos del listado de ejecuciones.
+
+    Returns:
+        dict: {'dias': [...], 'farmacias': {farmacia: [total_s medio por día]},
+               'fases': {fase: [segundos medios por día]}}
+    """
+    correctas = queryset.filter(error_tipo='').order_by()
+    por_dia = list(
+        correctas.annotate(dia=TruncDate('inicio')).values('dia')
+        .annotate(**{fase: Avg(f'{fase}_s') for fase in EjecucionSync.FASES}).order_by('dia')
+    )
+    dias = [str(fila['dia']) for fila in por_dia]
+
+    principales = list(
+        correctas.values_list('farmacia_id', flat=True).distinct().order_by('farmacia_id')[:max_farmacias]
+    )
+    farmacias = {f: [None] * len(dias) for f in principales}
+    posicion = {dia: i for i, dia in enumerate(dias)}
+    for fila in (
+        correctas.filter(farmacia_id__in=principales).annotate(dia=TruncDate('inicio'))
+        .values('dia', 'farmacia_id').annotate(media=Avg('total_s'))
+    ):
+        farmacias[fila['farmacia_id']][posicion[str(fila['dia'])]] = round(fila['media'], 2)
+
+    return {
+        'dias': dias,
+        'farmacias': farmacias,
+        'fases': {fase: [round(fila[fase] or 0, 2) for fila in por_dia] for fase in EjecucionSync.FASES},
+    }
+
+
+@admin.register(EjecucionSync)
+class EjecucionSyncAdmin(admin.ModelAdmin):
+    list_display = (
+        'inicio', 'segmento', 'farmacia_id', 'fecha_desde', 'fecha_hasta', 'total_s', 'ejecucion_s',
+        'descarga_s', 'escritura_s', 'filas_leidas', 'filas_escritas', 'correcta',
+    )
+    list_filter = ('segmento', 'farmacia_id', 'error_tipo')
+    date_hierarchy = 'inicio'
+    search_fields = ('farmacia_id', 'id_consulta', 'error')
+    change_list_template = 'admin/core/ejecucionsync/change_list.html'
+
+    def get_readonly_fields(self, request, obj=None):
+        return [f.name for f in EjecucionSync._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(boolean=True, description='OK')
+    def correcta(self, obj):
+        return obj.correcta
+
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        # Los gráficos usan los mismos filtros que el listado
+        contexto = getattr(response, 'context_data', None)
+        if contexto and 'cl' in contexto:
+            contexto['tendencia_sync'] = _tendencia_sync(contexto['cl'].queryset)
+        return response
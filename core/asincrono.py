@@ -0,0 +1,153 @@
+# core/asincrono.py
+"""
+Soporte para las vistas asíncronas que esperan al warehouse.
+
+Con un servidor ASGI (uvicorn) las vistas `async def` no ocupan un hilo
+mientras esperan: las llamadas bloqueantes al conector de Databricks (y el
+ORM que las acompaña) se mandan a un pool de hilos acotado
+(WAREHOUSE_HILOS), de modo que muchas consultas lentas al warehouse a la vez
+no dejan sin hilos a las páginas rápidas, que siguen en el pool de Django.
+
+Los trabajos largos (la importación de una farmacia) se lanzan en ese mismo
+pool sin esperar al resultado; su estado se guarda en la caché compartida
+para que cualquier worker pueda responder a las consultas de progreso.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from .cache_utils import PREFIJO
+
+logger = logging.getLogger(__name__)
+
+# Vida del estado de un trabajo terminado (o perdido si su proceso muere)
+DURACION_ESTADO_TRABAJO = 3600
+
+_ejecutor = None
+_ejecutor_lock = threading.Lock()
+
+
+def ejecutor_warehouse():
+    """Pool de hilos compartido por las llamadas al warehouse (se crea al primer uso)."""
+    global _ejecutor
+    with _ejecutor_lock:
+        if _ejecutor is None:
+            _ejecutor = ThreadPoolExecutor(max_workers=settings.WAREHOUSE_HILOS, thread_name_prefix='warehouse')
+        return _ejecutor
+
+
+def _en_hilo(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # Cada hilo del pool abre su propia conexión a la BD: la cerramos al terminar
+        connections.close_all()
+
+
+async def en_warehouse(func, *args, **kwargs):
+    """
+    Ejecuta una función bloqueante en el pool del warehouse y espera su resultado.
+
+    Args:
+        func (callable): Función síncrona (conector de Databricks, ORM...)
+
+    Returns:
+        Lo que devuelva `func`
+    """
+    bucle = asyncio.get_running_loop()
+    return await bucle.run_in_executor(ejecutor_warehouse(), functools.partial(_en_hilo, func, *args, **kwargs))
+
+
+def _clave_trabajo(trabajo_id):
+    return f"{PREFIJO}:trabajo:{trabajo_id}"
+
+
+def estado_trabajo(trabajo_id):
+    """
+    Estado de un trabajo lanzado con `lanzar_trabajo`.
+
+    Returns:
+        dict | None: {'id', 'tipo', 'estado', 'fase', 'resultado', 'error', ...} o None si no existe
+    """
+    return cache.get(_clave_trabajo(trabajo_id))
+
+
+def _guardar_estado(trabajo, **cambios):
+    trabajo.update(cambios, actualizado=time.time())
+    cache.set(_clave_trabajo(trabajo['id']), trabajo, DURACION_ESTADO_TRABAJO)
+
+
+def _ejecutar_trabajo(trabajo, func, args):
+    _guardar_estado(trabajo, estado='en_curso')
+    try:
+        resultado = func(*args, progreso=lambda fase: _guardar_estado(trabajo, fase=fase))
+    except Exception as e:
+        logger.exception("Error en el trabajo %s (%s)", trabajo['id'], trabajo['tipo'])
+        _guardar_estado(trabajo, estado='error', error=str(e))
+    else:
+        _guardar_estado(trabajo, estado='terminado', resultado=resultado)
+
+
+def lanzar_trabajo(tipo, func, *args, **datos):
+    """
+    Encola `func(*args, progreso=...)` en el pool del warehouse sin esperarla.
+
+    `func` recibe un callable `progreso(fase)` para ir publicando la fase en
+    curso y debe devolver algo serializable (se guarda en la caché).
+
+    Args:
+        tipo (str): Tipo de trabajo (p. ej. 'importacion')
+        func (callable): Trabajo síncrono
+        **datos: Datos extra que se guardan con el estado (usuario, farmacia...)
+
+    Returns:
+        str: ID del trabajo (ver `estado_trabajo`)
+    """
+    trabajo = {'id': uuid.uuid4().hex, 'tipo': tipo, 'estado': 'pendiente', 'fase': '', 'resultado': None,
+               'error': None, 'creado': time.time(), **datos}
+    _guardar_estado(trabajo)
+    ejecutor_warehouse().submit(_en_hilo, _ejecutar_trabajo, trabajo, func, args)
+    return trabajo['id']
+
+
+class WhiteNoiseAsincronoMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise apto para ASGI.
+
+    El WhiteNoiseMiddleware original solo es síncrono y obliga a Django a
+    ejecutar toda la cadena de middlewares (y las vistas async) a través de
+    un hilo por petición. La búsqueda del fichero estático es en memoria, así
+    que se puede hacer igual desde el bucle de eventos.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = self.find_file(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
@@ -0,0 +1,189 @@
+# core/benchmarks.py
+"""
+Utilidades compartidas por los comandos de benchmark.
+
+Los benchmarks nunca tocan la base de datos real: `entorno_benchmark()` crea
+una base de datos de test temporal (como hace `manage.py test`) y la destruye
+al terminar.
+"""
+import random
+import sqlite3
+import statistics
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from core.instrumentacion import percentil
+
+# Métricas que se comparan con la línea base: +1 si subir es peor, -1 si bajar es peor
+METRICAS_COMPARABLES = {'p50_ms': 1, 'p95_ms': 1, 'consultas': 1, 'pico_kb': 1, 'ops_s': -1}
+
+
+def resumen_tiempos(tiempos):
+    """
+    Resume una lista de duraciones en segundos.
+
+    Returns:
+        dict: n, media_ms, p50_ms, p95_ms, p99_ms, max_ms, ops_s
+    """
+    if not tiempos:
+        return {'n': 0}
+    total = sum(tiempos)
+    return {
+        'n': len(tiempos),
+        'media_ms': round(statistics.mean(tiempos) * 1000, 3),
+        'p50_ms': round(percentil(tiempos, 50) * 1000, 3),
+        'p95_ms': round(percentil(tiempos, 95) * 1000, 3),
+        'p99_ms': round(percentil(tiempos, 99) * 1000, 3),
+        'max_ms': round(max(tiempos) * 1000, 3),
+        'ops_s': round(len(tiempos) / total, 1) if total else 0.0,
+    }
+
+
+def medir(func, repeticiones):
+    """
+    Ejecuta `func(i)` `repeticiones` veces y devuelve las duraciones en segundos.
+    """
+    tiempos = []
+    for i in range(repeticiones):
+        inicio = time.perf_counter()
+        func(i)
+        tiempos.append(time.perf_counter() - inicio)
+    return tiempos
+
+
+@contextmanager
+def entorno_benchmark(verbosity=0):
+    """
+    Context manager que prepara una base de datos de test desechable.
+
+    Uso:
+        with entorno_benchmark():
+            ... sembrar datos y medir ...
+    """
+    setup_test_environment()
+    connection = connections['default']
+    nombre_original = connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, keepdb=False)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(nombre_original, verbosity=verbosity)
+        teardown_test_environment()
+
+
+def sembrar_datos(farmacia_id, num_grupos, semilla=0):
+    """
+    Crea oportunidades AH y EFP de prueba para una farmacia.
+
+    Cada grupo tiene 4 competidores en el formato real de `a_sustituir`.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+        num_grupos (int): Grupos AH y EFP a crear
+        semilla (int): Semilla para que los datos sean reproducibles
+    """
+    from core.models import Oportunidad
+    from efp.models import OportunidadEFP
+
+    rnd = random.Random(semilla)
+    familias = ['SISTEMA DIGESTIVO', 'DERMATOLOGÍA', 'SISTEMA RESPIRATORIO', 'SISTEMA NERVIOSO']
+    ah, efp = [], []
+    for i in range(num_grupos):
+        competidores_ah = ' || '.join(
+            f'MARCA {i}-{j} ({rnd.randint(1, 500)}|{rnd.randint(5, 60)}%|{600000 + j})' for j in range(4)
+        )
+        competidores_efp = ' || '.join(
+            f'RIVAL {i}-{j} ({rnd.randint(1, 300)}###{rnd.randint(5, 60)}###{rnd.uniform(1, 30):.1f}###{700000 + j}###{rnd.uniform(2, 20):.2f})'
+            for j in range(4)
+        )
+        ah.append(Oportunidad(
+            farmacia_id=farmacia_id, grupo_homogeneo=f'GRUPO {i}', producto_recomendado=f'GENERICO {i}',
+            pvp_medio=rnd.uniform(2, 60), puc_medio=rnd.uniform(1, 20), margen_pct=rnd.uniform(20, 80),
+            penetracion_pct=rnd.uniform(5, 90), a_sustituir=competidores_ah,
+            ahorro_potencial=rnd.uniform(10, 3000), codigo_nacional=str(650000 + i),
+        ))
+        efp.append(OportunidadEFP(
+            farmacia_id=farmacia_id, id_agrupacion=i + 1, nombre_grupo=f'SINTOMA {i}',
+            familia=familias[i % len(familias)], producto_recomendado=f'EFP {i}',
+            pvp_medio=rnd.uniform(2, 30), margen_pct=rnd.uniform(20, 70), ahorro_potencial=rnd.uniform(10, 500),
+            codigo_nacional=str(660000 + i), a_sustituir=competidores_efp,
+        ))
+    for obj in ah + efp:
+        obj.opciones = obj.calcular_opciones()
+    Oportunidad.objects.bulk_create(ah)
+    OportunidadEFP.objects.bulk_create(efp)
+
+
+def cliente_de_farmacia(usuario, farmacia_id):
+    """
+    Cliente de test autenticado con la farmacia activa en la sesión.
+
+    Args:
+        usuario (User): Usuario con el que iniciar sesión
+        farmacia_id (str): Farmacia activa
+
+    Returns:
+        Client: Cliente listo para hacer peticiones
+    """
+    cliente = Client()
+    cliente.force_login(usuario)
+    sesion = cliente.session
+    sesion['farmacia_activa'] = farmacia_id
+    sesion.save()
+    # Con cookies firmadas la clave de sesión ES el contenido y cambia al guardar
+    cliente.cookies[settings.SESSION_COOKIE_NAME] = sesion.session_key
+    return cliente
+
+
+def preparar_warehouse(ruta, farmacias, grupos_ah, semilla=0):
+    """
+    Crea en `ruta` un warehouse local (core/warehouse_local.py) para esas farmacias.
+
+    Args:
+        ruta (str): Fichero SQLite a (re)crear
+        farmacias (list): IDs de farmacia con dispensaciones
+        grupos_ah (int): Agrupaciones homogéneas del catálogo
+        semilla (int): Semilla para que los datos sean reproducibles
+    """
+    from core.warehouse_local import cargar_tablas, crear_esquema, generar_tablas
+
+    conn = sqlite3.connect(ruta, isolation_level=None)
+    try:
+        conn.execute('BEGIN')
+        crear_esquema(conn)
+        cargar_tablas(conn, generar_tablas(farmacias, grupos_ah=grupos_ah, semilla=semilla))
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+
+def comparar_con_base(actual, base, umbral_pct, ruta=()):
+    """
+    Compara dos resultados anidados métrica a métrica (ver METRICAS_COMPARABLES).
+
+    Args:
+        actual (dict): Resultado de esta ejecución
+        base (dict): Resultado guardado como línea base
+        umbral_pct (float): Empeoramiento (%) a partir del cual se marca regresión
+
+    Returns:
+        list: dicts con ruta, metrica, base, actual, cambio_pct y regresion
+    """
+    diferencias = []
+    for clave, valor in actual.items():
+        if clave not in base:
+            continue
+        if isinstance(valor, dict) and isinstance(base[clave], dict):
+            diferencias += comparar_con_base(valor, base[clave], umbral_pct, ruta + (clave,))
+        elif clave in METRICAS_COMPARABLES and base[clave]:
+            cambio = (valor - base[clave]) * 100 / base[clave]
+            diferencias.append({
+                'ruta': '/'.join(ruta), 'metrica': clave, 'base': base[clave], 'actual': valor,
+                'cambio_pct': round(cambio, 1),
+                'regresion': cambio * METRICAS_COMPARABLES[clave] > umbral_pct,
+            })
+    return diferencias
@@ -0,0 +1,263 @@
+# core/cache_backends.py
+"""
+Backend de caché compartido entre procesos sobre un fichero SQLite.
+
+Pensado para servidores donde no hay Redis: todos los workers de gunicorn
+abren el mismo fichero (modo WAL), así que calientan y invalidan una única
+caché. Incluye desalojo por número de entradas y por tamaño (LRU aproximado)
+y un `get_or_set` atómico que evita estampidas cuando varias peticiones
+piden a la vez una clave que no está calculada.
+
+Uso en settings:
+    CACHES = {
+        'default': {
+            'BACKEND': 'core.cache_backends.SQLiteCache',
+            'LOCATION': '/ruta/farma_cache.sqlite3',
+            'OPTIONS': {'MAX_ENTRIES': 20000, 'MAX_SIZE': 256 * 1024 * 1024},
+        }
+    }
+"""
+import itertools
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+_NO_ENCONTRADO = object()
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires);
+"""
+
+
+class SQLiteCache(BaseCache):
+    """
+    Caché en un fichero SQLite compartido por todos los procesos del servidor.
+
+    OPTIONS admitidas (además de las estándar MAX_ENTRIES y CULL_FREQUENCY):
+        - MAX_SIZE: bytes máximos de valores almacenados (por defecto 256 MB)
+        - LOCK_TIMEOUT: segundos que un proceso espera a que otro termine de
+          calcular una clave en `get_or_set` antes de calcularla él mismo
+        - BUSY_TIMEOUT: segundos de espera de SQLite ante bloqueos de escritura
+    """
+
+    # Cada cuántas escrituras (por proceso) se revisan los límites de tamaño
+    CULL_CADA = 100
+    # Resolución del LRU: no reescribimos `accessed` en cada lectura
+    LRU_RESOLUCION = 10
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._ruta = str(location)
+        self._max_size = int(options.get('MAX_SIZE', 256 * 1024 * 1024))
+        self._lock_timeout = float(options.get('LOCK_TIMEOUT', 30))
+        self._busy_timeout = float(options.get('BUSY_TIMEOUT', 5))
+        self._local = threading.local()
+        # itertools.count: next() es atómico, varios hilos comparten la instancia
+        self._escrituras = itertools.count(1)
+
+    # --- CONEXIÓN ---
+
+    def _conexion(self):
+        """Conexión por hilo y por proceso (tras un fork no se reutiliza la del padre)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            directorio = os.path.dirname(self._ruta)
+            if directorio:
+                os.makedirs(directorio, exist_ok=True)
+            conn = sqlite3.connect(self._ruta, timeout=self._busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_ESQUEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # --- API DE DJANGO ---
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        fila = self._conexion().execute(
+            'SELECT value, expires, accessed FROM cache WHERE key = ?', (key,)
+        ).fetchone()
+        if fila is None:
+            return default
+
+        value, expires, accessed = fila
+        ahora = time.time()
+        if expires is not None and expires <= ahora:
+            self._conexion().execute('DELETE FROM cache WHERE key = ? AND expires <= ?', (key, ahora))
+            return default
+
+        if ahora - accessed > self.LRU_RESOLUCION:
+            self._conexion().execute('UPDATE cache SET accessed = ? WHERE key = ?', (ahora, key))
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        datos = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._conexion().execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires, accessed, size) VALUES (?, ?, ?, ?, ?)',
+            (key, datos, self.get_backend_timeout(timeout), time.time(), len(datos)),
+        )
+        self._tras_escritura()
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        datos = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        ahora = time.time()
+        # Solo escribe si la clave no existe o ha caducado (operación atómica)
+        cursor = self._conexion().execute(
+            """
+            INSERT INTO cache (key, value, expires, accessed, size) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                value = excluded.value, expires = excluded.expires,
+                accessed = excluded.accessed, size = excluded.size
+            WHERE cache.expires IS NOT NULL AND cache.expires <= ?
+            """,
+            (key, datos, self.get_backend_timeout(timeout), ahora, len(datos), ahora),
+        )
+        if cursor.rowcount:
+            self._tras_escritura()
+        return cursor.rowcount > 0
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        ahora = time.time()
+        cursor = self._conexion().execute(
+            'UPDATE cache SET expires = ?, accessed = ? WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (self.get_backend_timeout(timeout), ahora, key, ahora),
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._conexion().execute('DELETE FROM cache WHERE key = ?', (key,))
+        return cursor.rowcount > 0
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        fila = self._conexion().execute(
+            'SELECT 1 FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time()),
+        ).fetchone()
+        return fila is not None
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        conn = self._conexion()
+        # BEGIN IMMEDIATE toma el bloqueo de escritura: lectura+escritura atómicas
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            fila = conn.execute(
+                'SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                (key, time.time()),
+            ).fetchone()
+            if fila is None:
+                raise ValueError("Key '%s' not found" % key)
+            nuevo = pickle.loads(fila[0]) + delta
+            datos = pickle.dumps(nuevo, pickle.HIGHEST_PROTOCOL)
+            conn.execute(
+                'UPDATE cache SET value = ?, size = ?, accessed = ? WHERE key = ?',
+                (datos, len(datos), time.time(), key),
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return nuevo
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Devuelve la clave o la calcula una sola vez entre todos los procesos.
+
+        Si `default` es invocable, el primer proceso que encuentra la clave
+        vacía toma un cerrojo (otra entrada de la caché creada con `add`) y la
+        calcula; el resto espera a que aparezca el valor. Si el cálculo tarda
+        más que LOCK_TIMEOUT, quien espera la calcula por su cuenta.
+        """
+        valor = self.get(key, _NO_ENCONTRADO, version=version)
+        if valor is not _NO_ENCONTRADO:
+            return valor
+
+        if not callable(default):
+            self.add(key, default, timeout=timeout, version=version)
+            return self.get(key, default, version=version)
+
+        clave_cerrojo = f"{key}:__cerrojo__"
+        limite = time.monotonic() + self._lock_timeout
+        espera = 0.01
+        while True:
+            if self.add(clave_cerrojo, os.getpid(), timeout=self._lock_timeout, version=version):
+                try:
+                    # Puede que otro proceso lo haya calculado mientras esperábamos
+                    valor = self.get(key, _NO_ENCONTRADO, version=version)
+                    if valor is _NO_ENCONTRADO:
+                        valor = default()
+                        self.set(key, valor, timeout=timeout, version=version)
+                    return valor
+                finally:
+                    self.delete(clave_cerrojo, version=version)
+
+            time.sleep(espera)
+            espera = min(espera * 2, 0.2)
+            valor = self.get(key, _NO_ENCONTRADO, version=version)
+            if valor is not _NO_ENCONTRADO:
+                return valor
+            if time.monotonic() > limite:
+                valor = default()
+                self.set(key, valor, timeout=timeout, version=version)
+                return valor
+
+    def clear(self):
+        self._conexion().execute('DELETE FROM cache')
+
+    def close(self, **kwargs):
+        # La conexión se mantiene abierta entre peticiones (es local al hilo)
+        pass
+
+    # --- DESALOJO ---
+
+    def _tras_escritura(self):
+        if next(self._escrituras) % self.CULL_CADA == 0:
+            self._cull()
+
+    def _cull(self):
+        """Elimina caducadas y, si se superan los límites, las menos usadas (LRU)."""
+        conn = self._conexion()
+        conn.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+
+        num, tamano = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache').fetchone()
+        if num > self._max_entries:
+            # Como locmem: se elimina 1/CULL_FREQUENCY de las entradas
+            a_borrar = num // self._cull_frequency if self._cull_frequency else num
+            conn.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                (max(a_borrar, num - self._max_entries),),
+            )
+        if tamano > self._max_size:
+            # Borramos las más antiguas hasta bajar al 90% del tamaño máximo
+            objetivo = tamano - int(self._max_size * 0.9)
+            conn.execute(
+                """
+                DELETE FROM cache WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, size, SUM(size) OVER (ORDER BY accessed ROWS UNBOUNDED PRECEDING) AS acumulado
+                        FROM cache
+                    ) WHERE acumulado - size < ?
+                )
+                """,
+                (objetivo,),
+            )
@@ -0,0 +1,178 @@
+# core/cache_utils.py
+"""
+Caché versionada por farmacia.
+
+Cada farmacia tiene un contador de versión de datos guardado en la caché.
+Las sincronizaciones y los cambios de preferencias lo incrementan, y todas
+las claves de caché de esa farmacia incluyen la versión, de forma que al
+subirla las entradas antiguas dejan de leerse (invalidación automática) y
+terminan saliendo por expiración o por el límite de entradas del backend.
+"""
+import hashlib
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core.instrumentacion import registrar_cache
+from core.metricas import CACHE_ACCESOS
+
+PREFIJO = 'farma'
+
+def _clave_version(farmacia_id):
+    return f"{PREFIJO}:version:{farmacia_id}"
+
+
+def obtener_version(farmacia_id):
+    """
+    Devuelve la versión de datos actual de una farmacia.
+
+    Si la clave no existe (primer uso o desalojada por el backend) se
+    inicializa con una marca de tiempo en nanosegundos: así una versión
+    recreada nunca coincide con una anterior y no se sirven datos viejos.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+
+    Returns:
+        int: Versión actual
+    """
+    clave = _clave_version(farmacia_id)
+    version = cache.get(clave)
+    if version is None:
+        cache.add(clave, time.time_ns(), timeout=None)
+        version = cache.get(clave, 0)
+    return version
+
+
+def incrementar_version(farmacia_id):
+    """
+    Invalida toda la caché de una farmacia subiendo su versión de datos.
+
+    Se llama tras sincronizar desde Databricks y tras guardar preferencias.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+
+    Returns:
+        int: Nueva versión
+    """
+    clave = _clave_version(farmacia_id)
+    try:
+        return cache.incr(clave)
+    except ValueError:
+        # La clave no existía: la creamos ya "por delante" de cualquier valor previo
+        version = time.time_ns()
+        cache.set(clave, version, timeout=None)
+        return version
+
+
+def clave_cache(vista, farmacia_id, params=()):
+    """
+    Construye la clave de caché para (vista, farmacia, versión, parámetros).
+
+    Args:
+        vista (str): Nombre lógico de la vista o cálculo
+        farmacia_id (str): ID de la farmacia
+        params (tuple): Parámetros de consulta que afectan al resultado
+
+    Returns:
+        str: Clave lista para usar en la caché
+    """
+    version = obtener_version(farmacia_id)
+    huella = hashlib.md5(repr(tuple(params)).encode('utf-8')).hexdigest()
+    return f"{PREFIJO}:{vista}:{farmacia_id}:{version}:{huella}"
+
+
+# Aciertos y fallos de este proceso por (vista, acierto). Van en memoria y no
+# en la caché compartida: contarlos ahí costaría dos escrituras por lectura.
+# El total de todos los workers está en /metricas/ (farma_cache_accesos_total).
+_accesos = Counter()
+_cerrojo_accesos = threading.Lock()
+
+
+def _registrar_acceso(vista, acierto):
+    """Incrementa el contador de aciertos o fallos de caché de una vista."""
+    registrar_cache(acierto)
+    CACHE_ACCESOS.inc(vista=vista, resultado='acierto' if acierto else 'fallo')
+    with _cerrojo_accesos:
+        _accesos[(vista, acierto)] += 1
+
+
+def estadisticas_cache(vistas):
+    """
+    Devuelve los contadores de aciertos/fallos y la tasa de acierto por vista.
+
+    Son los de este proceso desde que arrancó; los de todos los workers
+    juntos están en la métrica farma_cache_accesos_total.
+
+    Args:
+        vistas (iterable): Nombres de vista a consultar
+
+    Returns:
+        dict: {vista: {'hits': int, 'misses': int, 'ratio': float}}
+    """
+    resultado = {}
+    with _cerrojo_accesos:
+        for vista in vistas:
+            hits = _accesos[(vista, True)]
+            misses = _accesos[(vista, False)]
+            total = hits + misses
+            resultado[vista] = {
+                'hits': hits,
+                'misses': misses,
+                'ratio': (hits / total) if total else 0.0,
+            }
+    return resultado
+
+
+# Registro de vistas cacheadas (para consultar sus estadísticas)
+VISTAS_CACHEADAS = set()
+
+
+def cache_por_farmacia(vista, timeout=None):
+    """
+    Decorador que cachea el resultado de una función de cálculo por farmacia.
+
+    La función decorada debe recibir `farmacia_id` como primer argumento; el
+    resto de argumentos posicionales forman parte de la clave (filtros, orden,
+    texto de búsqueda...).
+
+    Uso:
+        @cache_por_farmacia('dashboard')
+        def resumen_dashboard(farmacia_id):
+            ...
+
+    Args:
+        vista (str): Nombre lógico usado en la clave y en los contadores
+        timeout (int, optional): Segundos de vida; por defecto FARMA_CACHE_TIMEOUT
+    """
+    VISTAS_CACHEADAS.add(vista)
+
+    def decorador(func):
+        @wraps(func)
+        def wrapper(farmacia_id, *args):
+            clave = clave_cache(vista, farmacia_id, args)
+            calculado = []
+
+            def calcular():
+                calculado.append(True)
+                return func(farmacia_id, *args)
+
+            # Una sola lectura: get_or_set solo llama a `calcular` si falta la
+            # clave. Con el backend SQLite compartido, si varios procesos fallan
+            # a la vez solo uno calcula y el resto espera su resultado (para
+            # esos es un acierto: no han calculado nada)
+            valor = cache.get_or_set(
+                clave, calcular, timeout if timeout is not None else settings.FARMA_CACHE_TIMEOUT,
+            )
+            _registrar_acceso(vista, not calculado)
+            return valor
+
+        # Acceso directo a la función sin caché (útil para depurar)
+        wrapper.sin_cache = func
+        return wrapper
+    return decorador
@@ -0,0 +1,28 @@
+# core/checks.py
+"""Comprobaciones de arranque (manage.py check, runserver, migrate...)."""
+import os
+
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+
+@register(Tags.caches)
+def comprobar_cache_compartida(app_configs, **kwargs):
+    """
+    Con DEBUG=False y varios workers la caché tiene que ser compartida.
+
+    Una sincronización o un cambio de preferencias sube la versión de la
+    farmacia solo en la caché del proceso que lo atiende: con LocMemCache el
+    resto de workers seguiría sirviendo datos viejos hasta FARMA_CACHE_TIMEOUT.
+    Solo se admite si WEB_CONCURRENCY=1 (un único worker).
+    """
+    if settings.DEBUG or os.environ.get('WEB_CONCURRENCY') == '1':
+        return []
+    backend = settings.CACHES['default']['BACKEND']
+    if backend == 'django.core.cache.backends.locmem.LocMemCache':
+        return [Error(
+            'La caché por defecto es LocMemCache (una por proceso) con DEBUG=False.',
+            hint='Usa CACHE_BACKEND=sqlite (o un backend compartido), o WEB_CONCURRENCY=1 con un solo worker.',
+            id='core.E001',
+        )]
+    return []
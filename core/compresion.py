@@ -0,0 +1,226 @@
+# core/compresion.py
+"""
+Compresión de las respuestas (Brotli o gzip) y minificado opcional del HTML.
+
+Las páginas con una fila por grupo y sus tablas de competidores
+(datos_brutos, configuracion, el dashboard EFP) pesan cientos de KB de HTML
+muy repetitivo. El middleware las comprime con Brotli si el navegador lo
+acepta y el paquete está instalado, y si no con gzip:
+
+- Solo tipos de texto (HTML, JSON, CSV, JS, SVG...); las fotos ya van comprimidas.
+- Las respuestas por debajo de COMPRESION_MINIMO bytes se dejan tal cual.
+- Las respuestas en streaming (síncronas o asíncronas) se comprimen trozo a
+  trozo, vaciando el compresor tras cada uno para no retener la salida.
+
+Mitigación de BREACH (páginas con el token CSRF y datos del usuario):
+como GZipMiddleware desde Django 4.2, la cabecera gzip lleva un nombre de
+fichero de longitud aleatoria (hasta RELLENO_MAXIMO bytes) para que el
+tamaño de la respuesta no delate el contenido. Brotli no tiene dónde
+rellenar, así que las páginas que han usado el token CSRF van siempre con
+gzip.
+
+Con MINIFICAR_HTML=True además se quita la sangría de las plantillas
+(espacios al principio de línea y líneas en blanco), salvo dentro de <pre>,
+<textarea> y <script>.
+"""
+import gzip
+import re
+import secrets
+import struct
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # Opcional: sin Brotli se comprime solo con gzip
+    brotli = None
+
+TIPOS_COMPRIMIBLES = (
+    'text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+)
+# Bloques cuyo contenido no se toca al minificar
+RE_BLOQUES_LITERALES = re.compile(r'(<(pre|textarea|script)\b.*?</\2\s*>)', re.S | re.I)
+RE_SANGRIA = re.compile(r'\n\s+')
+# Bytes aleatorios máximos en la cabecera gzip (el mismo valor que GZipMiddleware)
+RELLENO_MAXIMO = 100
+
+
+def elegir_codificacion(accept_encoding, permitir_brotli=True):
+    """
+    Codificación que se va a usar según la cabecera Accept-Encoding.
+
+    Args:
+        accept_encoding (str): Cabecera de la petición
+        permitir_brotli (bool): False en páginas con el token CSRF (ver docstring del módulo)
+
+    Returns:
+        str | None: 'br', 'gzip' o None si el cliente no acepta ninguna
+    """
+    aceptadas = {}
+    for parte in accept_encoding.lower().split(','):
+        nombre, _, parametros = parte.strip().partition(';')
+        calidad = 1.0
+        if parametros.strip().startswith('q='):
+            try:
+                calidad = float(parametros.strip()[2:])
+            except ValueError:
+                calidad = 0.0
+        aceptadas[nombre.strip()] = calidad
+    comodin = aceptadas.get('*', 0)
+    if permitir_brotli and brotli is not None and aceptadas.get('br', comodin) > 0:
+        return 'br'
+    if aceptadas.get('gzip', comodin) > 0:
+        return 'gzip'
+    return None
+
+
+def minificar_html(html):
+    """Quita la sangría y las líneas en blanco fuera de <pre>, <textarea> y <script>."""
+    partes = RE_BLOQUES_LITERALES.split(html)
+    # split() intercala: texto, bloque, nombre de etiqueta, texto, bloque, nombre...
+    return ''.join(
+        RE_SANGRIA.sub('\n', parte) if i % 3 == 0 else parte
+        for i, parte in enumerate(partes) if i % 3 != 2
+    )
+
+
+class _CompresorGzip:
+    """
+    Deflate con la cabecera y el pie gzip escritos a mano.
+
+    zlib no deja poner nombre de fichero en la cabecera; aquí lleva uno de
+    longitud aleatoria como relleno contra BREACH (como django.utils.text.compress_string).
+    """
+
+    def __init__(self, nivel):
+        # wbits=-15: deflate sin cabecera, la ponemos nosotros
+        self._deflate = zlib.compressobj(nivel, zlib.DEFLATED, -15)
+        self._crc = 0
+        self._tamano = 0
+        relleno = b'a' * secrets.randbelow(RELLENO_MAXIMO)
+        # Mágico, método deflate, FNAME, mtime 0, sin flags extra, SO desconocido
+        self._cabecera = b'\x1f\x8b\x08' + bytes([gzip.FNAME]) + b'\x00' * 5 + b'\xff' + relleno + b'\x00'
+
+    def _con_cabecera(self, salida):
+        if self._cabecera:
+            salida, self._cabecera = self._cabecera + salida, b''
+        return salida
+
+    def comprimir(self, datos):
+        self._crc = zlib.crc32(datos, self._crc)
+        self._tamano += len(datos)
+        return self._con_cabecera(self._deflate.compress(datos))
+
+    def vaciar(self):
+        return self._con_cabecera(self._deflate.flush(zlib.Z_SYNC_FLUSH))
+
+    def terminar(self):
+        pie = struct.pack('<II', self._crc, self._tamano & 0xFFFFFFFF)
+        return self._con_cabecera(self._deflate.flush()) + pie
+
+
+def _compresor(codificacion):
+    """
+    Returns:
+        tuple: (comprimir(bytes), vaciar(), terminar()) del compresor de la codificación
+    """
+    if codificacion == 'br':
+        compresor = brotli.Compressor(quality=settings.COMPRESION_BROTLI_CALIDAD)
+        return compresor.process, compresor.flush, compresor.finish
+    compresor = _CompresorGzip(settings.COMPRESION_GZIP_NIVEL)
+    return compresor.comprimir, compresor.vaciar, compresor.terminar
+
+
+def _comprimir_flujo(partes, codificacion):
+    comprimir, vaciar, terminar = _compresor(codificacion)
+    for parte in partes:
+        salida = comprimir(parte) + vaciar()
+        if salida:
+            yield salida
+    yield terminar()
+
+
+async def _comprimir_flujo_asincrono(partes, codificacion):
+    comprimir, vaciar, terminar = _compresor(codificacion)
+    async for parte in partes:
+        salida = comprimir(parte) + vaciar()
+        if salida:
+            yield salida
+    yield terminar()
+
+
+class CompresionMiddleware:
+    """Comprime las respuestas de texto con Brotli o gzip (ver docstring del módulo)."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.procesar(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.procesar(request, await self.get_response(request))
+
+    def procesar(self, request, response):
+        tipo = response.get('Content-Type', '').split(';')[0].strip().lower()
+        if (
+            response.has_header('Content-Encoding')
+            or response.has_header('X-Accel-Redirect')
+            or not tipo.startswith(TIPOS_COMPRIMIBLES)
+        ):
+            return response
+
+        if settings.MINIFICAR_HTML and tipo == 'text/html' and not response.streaming:
+            minificado = minificar_html(response.content.decode(response.charset)).encode(response.charset)
+            if len(minificado) < len(response.content):
+                self._debilitar_etag(response)
+                response.content = minificado
+                response['Content-Length'] = str(len(minificado))
+
+        # Varía según Accept-Encoding aunque esta petición no se comprima (cachés intermedias)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if not response.streaming and len(response.content) < settings.COMPRESION_MINIMO:
+            return response
+        codificacion = elegir_codificacion(
+            request.META.get('HTTP_ACCEPT_ENCODING', ''),
+            # get_token() marca así la petición cuando la página lleva el token CSRF
+            permitir_brotli=not request.META.get('CSRF_COOKIE_NEEDS_UPDATE'),
+        )
+        if codificacion is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = _comprimir_flujo_asincrono(response.streaming_content, codificacion)
+            else:
+                response.streaming_content = _comprimir_flujo(response.streaming_content, codificacion)
+            # Ya no se conoce la longitud final
+            del response['Content-Length']
+        else:
+            comprimir, _, terminar = _compresor(codificacion)
+            comprimido = comprimir(response.content) + terminar()
+            if len(comprimido) >= len(response.content):
+                return response
+            response.content = comprimido
+            response['Content-Length'] = str(len(comprimido))
+
+        self._debilitar_etag(response)
+        response['Content-Encoding'] = codificacion
+        return response
+
+    @staticmethod
+    def _debilitar_etag(response):
+        # El contenido cambia de bytes pero no de significado (igual que GZipMiddleware)
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
@@ -1,5 +1,6 @@
-from .models import Oportunidad
-import random
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+from .services import farmacias_locales, tip_del_dia
 
 def contexto_global(request):
     """
@@ -7,32 +8,18 @@ def contexto_global(request):
     1. El Tip del día dinámico.
     2. La lista de farmacias disponibles para el selector.
     3. La farmacia activa actualmente.
+    4. La vida de los fragmentos cacheados ({% cache cache_timeout ... %}).
+
+    El tip y la lista son perezosos y salen de la caché: solo se calculan si
+    la plantilla los usa y, como mucho, una vez por versión de datos.
     """
     
-    # --- PARTE 1: FARMACIAS DISPONIBLES ---
     f_activa = request.session.get('farmacia_activa', 'HF280050001')
-    
-    # Buscamos todos los IDs únicos de farmacia que hay en la base de datos
-    farmacias_disponibles = Oportunidad.objects.values_list('farmacia_id', flat=True).distinct().order_by('farmacia_id')
-    
-    # --- PARTE 2: TIP DEL DÍA ---
-    # Buscamos una oportunidad de ahorro > 500€ en la farmacia activa
-    oportunidad = Oportunidad.objects.filter(farmacia_id=f_activa, ahorro_potencial__gt=500).order_by('?').first()
-    
-    if oportunidad:
-        competidor = "la marca"
-        if oportunidad.a_sustituir:
-            stats = oportunidad.get_competidores_stats()
-            if stats:
-                competidor = stats[0]['nombre'] # Cogemos el primer competidor
-                
-        mensaje = f"Sustituyendo <b>{competidor}</b> por <b>{oportunidad.producto_recomendado[:20]}...</b> aumentas el margen un <b>{oportunidad.margen_pct}%</b>."
-    else:
-        mensaje = "Revisa los márgenes de los genéricos, ¡cada céntimo cuenta!"
-        
+
     # Devolvemos TODO junto
     return {
-        'tip_del_dia': mensaje,
-        'farmacias_disponibles': farmacias_disponibles,
-        'farmacia_activa': f_activa
-    }
\ No newline at end of file
+        'tip_del_dia': SimpleLazyObject(lambda: tip_del_dia(f_activa)),
+        'farmacias_disponibles': SimpleLazyObject(farmacias_locales),
+        'farmacia_activa': f_activa,
+        'cache_timeout': settings.FARMA_CACHE_TIMEOUT,
+    }
@@ -0,0 +1,211 @@
+# core/datos_sinteticos.py
+"""
+Generador de datos sintéticos para pruebas de escala.
+
+Fabrica farmacias completas en la base de datos de Django (oportunidades AH
+y EFP con sus competidores, preferencias) con inserciones masivas y semilla
+fija. Usa el mismo catálogo que el warehouse local (core/warehouse_local.py),
+cuyas tablas se exportan aparte como ficheros de fixtures, así que los
+grupos, laboratorios y los CN de EFP cuadran en ambos lados.
+
+Cada farmacia usa su propio generador (semilla + ID), de modo que generar
+10 o 1000 farmacias da los mismos datos para las 10 primeras.
+"""
+import random
+from collections import Counter
+from functools import lru_cache
+
+from django.core.cache import cache
+from django.db import transaction
+
+from core.cache_utils import incrementar_version
+from core.db_utils import TAMANO_LOTE
+from core.models import Oportunidad, Preferencia
+from core.services import CLAVE_FARMACIAS_LOCALES
+from core.warehouse_local import LABORATORIOS, MARCAS_EFP, grupos_efp, nombre_grupo_ah
+from efp.models import OportunidadEFP, PreferenciaEFP
+from efp.services import ICONOS_FAMILIAS, cargar_jerarquia_local
+
+# Farmacias que se acumulan en memoria antes de cada volcado a la base de datos
+FARMACIAS_POR_VOLCADO = 50
+
+
+def ids_farmacias(num):
+    """IDs con el formato real, empezando por la farmacia por defecto (HF280050001)."""
+    return [f"HF{280050001 + i}" for i in range(num)]
+
+
+@lru_cache(maxsize=1)
+def _catalogo_efp():
+    """Jerarquía local y grupos de efp_grupos.json por ID (se leen una vez por proceso)."""
+    return cargar_jerarquia_local(), {g['id']: g for g in grupos_efp()}
+
+
+def ids_grupos_efp(num_familias):
+    """
+    IDs de los grupos EFP de las `num_familias` primeras superfamilias.
+
+    Returns:
+        list: IDs de efp_grupos.json con familia asignada, en orden
+    """
+    familias = set(list(ICONOS_FAMILIAS)[:num_familias])
+    jerarquia, catalogo = _catalogo_efp()
+    return [id_grupo for id_grupo in catalogo if jerarquia.get(id_grupo, ('OTRAS',))[0] in familias]
+
+
+def _competidores(rnd, nombres, cns, precio_base):
+    """
+    Unidades, margen y PVP de cada producto del grupo, con el de mayor margen primero.
+
+    Returns:
+        list: dicts con nombre, cn, unidades, pvp, margen_pct y margen_eur
+    """
+    productos = []
+    for nombre, cn in zip(nombres, cns):
+        pvp = round(precio_base * rnd.uniform(0.9, 1.1), 2)
+        margen_pct = rnd.uniform(15, 45)
+        productos.append({
+            'nombre': nombre, 'cn': str(cn), 'unidades': rnd.randint(5, 400), 'pvp': pvp,
+            'margen_pct': margen_pct, 'margen_eur': pvp * margen_pct / 100,
+        })
+    return sorted(productos, key=lambda p: p['margen_eur'], reverse=True)
+
+
+def _ahorro(productos):
+    mejor = productos[0]['margen_eur']
+    return round(max(sum(p['unidades'] * (mejor - p['margen_eur']) for p in productos), 10.01), 2)
+
+
+def generar_farmacia(farmacia_id, grupos_ah, ids_efp, competidores=4, fraccion_preferencias=0.2, semilla=0):
+    """
+    Crea (sin guardar) los datos de una farmacia.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+        grupos_ah (int): Agrupaciones homogéneas de la farmacia
+        ids_efp (list): IDs de grupos EFP de la farmacia
+        competidores (int): Productos que compiten con el recomendado en cada grupo
+        fraccion_preferencias (float): Fracción de grupos con preferencia guardada
+        semilla (int): Semilla global del generador
+
+    Returns:
+        dict: {'ah': [...], 'efp': [...], 'preferencias': [...], 'preferencias_efp': [...]}
+    """
+    rnd = random.Random(f"{semilla}:{farmacia_id}")
+    jerarquia, catalogo_efp = _catalogo_efp()
+    datos = {'ah': [], 'efp': [], 'preferencias': [], 'preferencias_efp': []}
+
+    for g in range(grupos_ah):
+        principio = nombre_grupo_ah(g)
+        laboratorios = rnd.sample(LABORATORIOS, min(competidores + 1, len(LABORATORIOS)))
+        productos = _competidores(
+            rnd, [f"{principio} {lab} 28 COMPRIMIDOS" for lab in laboratorios],
+            [100000 + g * 50 + i for i in range(len(laboratorios))], rnd.uniform(2, 30),
+        )
+        campeon, resto = productos[0], productos[1:]
+        oportunidad = Oportunidad(
+            farmacia_id=farmacia_id,
+            grupo_homogeneo=principio,
+            producto_recomendado=campeon['nombre'],
+            pvp_medio=campeon['pvp'],
+            puc_medio=round(campeon['pvp'] - campeon['margen_eur'], 2),
+            margen_pct=round(campeon['margen_pct'], 2),
+            penetracion_pct=round(campeon['unidades'] * 100 / sum(p['unidades'] for p in productos), 2),
+            a_sustituir=' || '.join(
+                f"{p['nombre']} ({p['unidades']}|{round(p['margen_pct'])}%|{p['cn']})" for p in resto
+            ),
+            ahorro_potencial=_ahorro(productos),
+            codigo_nacional=campeon['cn'],
+        )
+        oportunidad.opciones = oportunidad.calcular_opciones()
+        datos['ah'].append(oportunidad)
+        if rnd.random() < fraccion_preferencias:
+            datos['preferencias'].append(Preferencia(
+                farmacia_id=farmacia_id, grupo_homogeneo=principio,
+                laboratorio_preferente=rnd.choice(oportunidad.opciones), activo=rnd.random() < 0.9,
+            ))
+
+    for id_grupo in ids_efp:
+        familia, nombre = jerarquia.get(id_grupo, ('OTRAS', catalogo_efp[id_grupo]['nombre']))
+        cns = catalogo_efp[id_grupo]['cn'][:competidores + 1]
+        productos = _competidores(
+            rnd, [f"{rnd.choice(MARCAS_EFP)} {nombre.split(' - ')[0]} {cn}" for cn in cns], cns, rnd.uniform(3, 25),
+        )
+        total_unidades = sum(p['unidades'] for p in productos)
+        campeon, resto = productos[0], productos[1:]
+        oportunidad = OportunidadEFP(
+            farmacia_id=farmacia_id,
+            id_agrupacion=id_grupo,
+            nombre_grupo=nombre,
+            familia=familia,
+            subfamilia=nombre,
+            producto_recomendado=campeon['nombre'],
+            pvp_medio=campeon['pvp'],
+            margen_pct=round(campeon['margen_pct'], 2),
+            ahorro_potencial=_ahorro(productos),
+            codigo_nacional=campeon['cn'],
+            a_sustituir=' || '.join(
+                f"{p['nombre']} ({p['unidades']}###{round(p['margen_pct'])}###"
+                f"{p['unidades'] * 100 / total_unidades:.1f}###{p['cn']}###{p['pvp']:.2f})"
+                for p in resto
+            ),
+        )
+        oportunidad.opciones = oportunidad.calcular_opciones()
+        datos['efp'].append(oportunidad)
+        if rnd.random() < fraccion_preferencias:
+            datos['preferencias_efp'].append(PreferenciaEFP(
+                farmacia_id=farmacia_id, id_agrupacion=id_grupo, producto_preferido=rnd.choice(oportunidad.opciones),
+            ))
+    return datos
+
+
+_MODELOS = {'ah': Oportunidad, 'efp': OportunidadEFP, 'preferencias': Preferencia, 'preferencias_efp': PreferenciaEFP}
+
+
+def _volcar(pendientes, totales):
+    with transaction.atomic():
+        for clave, objetos in pendientes.items():
+            _MODELOS[clave].objects.bulk_create(objetos, batch_size=TAMANO_LOTE)
+            totales[clave] += len(objetos)
+            objetos.clear()
+
+
+def cargar_en_django(farmacias, grupos_ah=200, ids_efp=(), competidores=4, fraccion_preferencias=0.2,
+                     semilla=0, borrar=True):
+    """
+    Genera y guarda con inserciones masivas los datos de varias farmacias.
+
+    Args:
+        farmacias (list): IDs de farmacia (ver `ids_farmacias`)
+        grupos_ah (int): Agrupaciones homogéneas por farmacia
+        ids_efp (iterable): IDs de grupos EFP por farmacia (ver `ids_grupos_efp`)
+        competidores (int): Productos que compiten con el recomendado en cada grupo
+        fraccion_preferencias (float): Fracción de grupos con preferencia guardada
+        semilla (int): Semilla del generador
+        borrar (bool): Borrar antes los datos que ya tengan esas farmacias
+
+    Returns:
+        Counter: Filas creadas por tipo ('ah', 'efp', 'preferencias', 'preferencias_efp')
+    """
+    ids_efp = list(ids_efp)
+    totales = Counter()
+    if borrar:
+        for inicio in range(0, len(farmacias), TAMANO_LOTE):
+            lote = farmacias[inicio:inicio + TAMANO_LOTE]
+            for modelo in _MODELOS.values():
+                modelo.objects.filter(farmacia_id__in=lote).delete()
+
+    pendientes = {clave: [] for clave in _MODELOS}
+    for i, farmacia_id in enumerate(farmacias, 1):
+        datos = generar_farmacia(farmacia_id, grupos_ah, ids_efp, competidores, fraccion_preferencias, semilla)
+        for clave, objetos in datos.items():
+            pendientes[clave].extend(objetos)
+        if i % FARMACIAS_POR_VOLCADO == 0:
+            _volcar(pendientes, totales)
+    _volcar(pendientes, totales)
+
+    # Los datos han cambiado: cualquier cálculo cacheado de estas farmacias queda obsoleto
+    for farmacia_id in farmacias:
+        incrementar_version(farmacia_id)
+    cache.delete(CLAVE_FARMACIAS_LOCALES)
+    return totales
@@ -2,13 +2,19 @@
 """
 Utilidades compartidas para operaciones con Databricks y base de datos.
 """
+import logging
 import os
-from contextlib import contextmanager
-from databricks import sql
-from django.db import transaction
-from dotenv import load_dotenv
+import time
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.db import DatabaseError, connections, router, transaction
+from django.utils import timezone
 
-load_dotenv()
+from core.instrumentacion import medir
+from core.metricas import registrar_sync
+from core import warehouse_local
+
+logger = logging.getLogger(__name__)
 
 
 @contextmanager
@@ -22,17 +28,26 @@ def databricks_connection():
             results = cursor.fetchall()
     
     Garantiza que la conexión y cursor se cierren siempre, incluso si hay errores.
+    Con DATABRICKS_BACKEND=local la conexión es al warehouse local de
+    core/warehouse_local.py (mismas tablas y mismas consultas).
     """
     connection = None
     cursor = None
     try:
-        connection = sql.connect(
-            server_hostname=os.getenv("DATABRICKS_SERVER_HOSTNAME"),
-            http_path=os.getenv("DATABRICKS_HTTP_PATH"),
-            access_token=os.getenv("DATABRICKS_TOKEN")
-        )
-        cursor = connection.cursor()
-        yield connection, cursor
+        with medir('databricks'):
+            if settings.DATABRICKS_BACKEND == 'local':
+                connection = warehouse_local.conectar()
+            else:
+                # Importación diferida: el conector (thrift, pyarrow...) solo se carga
+                # en el proceso que sincroniza, no en cada worker al arrancar
+                from databricks import sql
+                connection = sql.connect(
+                    server_hostname=os.getenv("DATABRICKS_SERVER_HOSTNAME"),
+                    http_path=os.getenv("DATABRICKS_HTTP_PATH"),
+                    access_token=os.getenv("DATABRICKS_TOKEN")
+                )
+            cursor = connection.cursor()
+            yield connection, cursor
     finally:
         if cursor:
             cursor.close()
@@ -40,6 +55,96 @@ def databricks_connection():
             connection.close()
 
 
+class MedicionSync:
+    """Acumula el tiempo de cada fase de una sincronización sobre su `EjecucionSync`."""
+
+    def __init__(self, ejecucion):
+        self.ejecucion = ejecucion
+
+    @contextmanager
+    def fase(self, nombre):
+        """Suma la duración del bloque al campo `<nombre>_s` de la ejecución."""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            campo = f'{nombre}_s'
+            setattr(self.ejecucion, campo, getattr(self.ejecucion, campo) + time.perf_counter() - inicio)
+
+
+@contextmanager
+def registrar_ejecucion_sync(farmacia_id, segmento, fecha_inicio, fecha_fin):
+    """
+    Registra una sincronización en `EjecucionSync` (y en las métricas), acabe bien o mal.
+
+    Uso:
+        with registrar_ejecucion_sync(farmacia_id, 'AH', fecha_inicio, fecha_fin) as medicion:
+            rows = ejecutar_consulta_medida(query, medicion)
+            with medicion.fase('escritura'):
+                ...
+
+    Las excepciones se anotan (tipo y mensaje) y se vuelven a lanzar: el
+    llamador decide cómo informar del error. Si no se puede guardar el
+    registro, se escribe en el log y la sincronización no se ve afectada.
+    """
+    from core.models import EjecucionSync
+
+    ejecucion = EjecucionSync(
+        farmacia_id=farmacia_id,
+        segmento=segmento,
+        fecha_desde=fecha_inicio or None,
+        fecha_hasta=fecha_fin or None,
+        inicio=timezone.now(),
+    )
+    inicio = time.perf_counter()
+    try:
+        yield MedicionSync(ejecucion)
+    except Exception as e:
+        ejecucion.error_tipo = type(e).__name__
+        ejecucion.error = str(e)[:5000]
+        raise
+    finally:
+        ejecucion.total_s = time.perf_counter() - inicio
+        ejecucion.fin = timezone.now()
+        try:
+            ejecucion.save()
+        except (DatabaseError, ValueError, TypeError):
+            logger.exception("No se pudo guardar la ejecución de sincronización %s %s", segmento, farmacia_id)
+        registrar_sync(
+            segmento.lower(), farmacia_id,
+            {fase: getattr(ejecucion, f'{fase}_s') for fase in EjecucionSync.FASES},
+            ejecucion.filas_leidas, ejecucion.filas_escritas, error=ejecucion.error_tipo or None,
+        )
+
+
+def ejecutar_consulta_medida(query, medicion):
+    """
+    Ejecuta una consulta en Databricks midiendo conexión, ejecución y descarga.
+
+    Anota también en la ejecución las filas leídas, el tamaño aproximado del
+    resultado y el query ID del warehouse (para buscarla en su historial).
+
+    Args:
+        query (str): Query SQL a ejecutar
+        medicion (MedicionSync): Medición de la sincronización en curso
+
+    Returns:
+        list: Filas devueltas
+    """
+    with ExitStack() as pila:
+        with medicion.fase('conexion'):
+            connection, cursor = pila.enter_context(databricks_connection())
+        with medicion.fase('ejecucion'):
+            cursor.execute(query)
+        medicion.ejecucion.id_consulta = str(getattr(cursor, 'query_id', None) or '')[:100]
+        with medicion.fase('descarga'):
+            rows = cursor.fetchall()
+
+    medicion.ejecucion.filas_leidas = len(rows)
+    medicion.ejecucion.bytes_resultado = sum(len(str(valor)) for row in rows for valor in row)
+    return rows
+
+
 def execute_databricks_query(query, farmacia_id=None):
     """
     Ejecuta una consulta en Databricks y devuelve los resultados.
@@ -66,10 +171,41 @@ def execute_databricks_query(query, farmacia_id=None):
         return [], str(e)
 
 
+# Filas por INSERT en las cargas masivas (limita el tamaño de cada sentencia)
+TAMANO_LOTE = 1000
+
+
+def _clave_natural(model_class):
+    """
+    Campos únicos del modelo que incluyen `farmacia_id` (p. ej. farmacia + agrupación).
+
+    Returns:
+        list | None: Nombres de campo, o None si el modelo no tiene esa restricción
+    """
+    for campos in model_class._meta.unique_together:
+        if 'farmacia_id' in campos:
+            return list(campos)
+    return None
+
+
 def bulk_create_or_update(model_class, farmacia_id, objects_list, delete_existing=True):
     """
     Crea o actualiza objetos en masa de forma atómica.
     
+    En PostgreSQL, si el modelo tiene una clave única por farmacia, se hace un
+    upsert (INSERT ... ON CONFLICT DO UPDATE) y luego se borran solo las filas
+    que ya no vienen en la carga: las filas que no cambian de clave conservan
+    su id y no se borran y reinsertan todas (menos índices que rehacer y
+    menos filas muertas que limpiar con VACUUM). En el resto de casos se
+    borra y se inserta todo dentro de la misma transacción.
+
+    Hoy solo `OportunidadEFP` (farmacia + `id_agrupacion`) tiene esa clave.
+    `Oportunidad` (AH) no la tiene a propósito: la sincronización agrupa por
+    `Id_Agrupacion` pero guarda como `grupo_homogeneo` el principio activo,
+    que se repite entre agrupaciones de distinta dosis o forma; una
+    restricción única sobre (farmacia, grupo_homogeneo) rechazaría cargas
+    reales, así que AH sigue borrando e insertando.
+    
     Args:
         model_class: Clase del modelo Django (ej: Oportunidad)
         farmacia_id (str): ID de la farmacia
@@ -79,12 +215,39 @@ def bulk_create_or_update(model_class, farmacia_id, objects_list, delete_existin
     Returns:
         int: Número de objetos creados
     """
-    with transaction.atomic():
+    db = router.db_for_write(model_class)
+    clave = _clave_natural(model_class)
+
+    with transaction.atomic(using=db):
+        if connections[db].vendor == 'postgresql' and clave and objects_list:
+            campos_actualizar = [
+                f.name for f in model_class._meta.concrete_fields
+                if not f.primary_key and f.name not in clave
+            ]
+            model_class.objects.using(db).bulk_create(
+                objects_list,
+                batch_size=TAMANO_LOTE,
+                update_conflicts=True,
+                unique_fields=clave,
+                update_fields=campos_actualizar,
+            )
+            if delete_existing:
+                # Borramos las filas de la farmacia que no están en la nueva carga
+                otros = [c for c in clave if c != 'farmacia_id']
+                vigentes = {tuple(getattr(o, c) for c in otros) for o in objects_list}
+                obsoletas = [
+                    pk for pk, *valores in model_class.objects.using(db)
+                    .filter(farmacia_id=farmacia_id).values_list('pk', *otros)
+                    if tuple(valores) not in vigentes
+                ]
+                model_class.objects.using(db).filter(pk__in=obsoletas).delete()
+            return len(objects_list)
+
         if delete_existing:
-            model_class.objects.filter(farmacia_id=farmacia_id).delete()
+            model_class.objects.using(db).filter(farmacia_id=farmacia_id).delete()
         
         if objects_list:
-            model_class.objects.bulk_create(objects_list)
+            model_class.objects.using(db).bulk_create(objects_list, batch_size=TAMANO_LOTE)
         
         return len(objects_list)
 
@@ -0,0 +1,57 @@
+# core/estado_examen.py
+"""
+Estado compacto de los exámenes (AH y EFP) guardado en la sesión.
+
+En lugar de guardar diccionarios completos de preguntas y opciones, cada
+examen ocupa una sola clave de sesión con una lista pequeña de enteros:
+
+    [aciertos, total, pregunta, resultado]
+
+    - pregunta:  [id_pregunta, [índices de opciones]] o None
+    - resultado: [id_pregunta, [índices de opciones], índice_elegido] o None
+
+Los índices apuntan a la lista de candidatos de la pregunta en el banco de
+preguntas cacheado (ver `banco_preguntas_ah` / `banco_preguntas_efp`), que
+está en orden alfabético: la sesión no revela cuál es la respuesta correcta.
+Así la sesión sigue siendo de pocos bytes con cualquier backend y cabe
+holgadamente en una cookie firmada (SESSION_BACKEND=signed_cookies), con la
+que responder no escribe nada en la base de datos. Con el backend por
+defecto (cached_db) cada respuesta sigue guardando la fila de la sesión.
+"""
+
+
+class EstadoExamen:
+    """
+    Acceso al estado compacto de un examen dentro de `request.session`.
+
+    Uso:
+        estado = EstadoExamen(request.session, 'examen_ah')
+        estado.total += 1
+        estado.guardar()
+    """
+
+    def __init__(self, session, clave):
+        self._session = session
+        self._clave = clave
+        datos = session.get(clave)
+        if not isinstance(datos, list) or len(datos) != 4:
+            datos = [0, 0, None, None]
+        self.aciertos, self.total, self.pregunta, self.resultado = datos
+
+    @property
+    def iniciado(self):
+        """True si el examen ya existe en la sesión."""
+        return self._clave in self._session
+
+    def reiniciar(self):
+        self.aciertos = 0
+        self.total = 0
+        self.pregunta = None
+        self.resultado = None
+        self.guardar()
+
+    def guardar(self):
+        """Escribe el estado en la sesión solo si ha cambiado (sin escrituras inútiles)."""
+        datos = [self.aciertos, self.total, self.pregunta, self.resultado]
+        if self._session.get(self._clave) != datos:
+            self._session[self._clave] = datos
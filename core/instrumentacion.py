@@ -0,0 +1,329 @@
+# core/instrumentacion.py
+"""
+Instrumentación por petición: consultas SQL, tiempos y aciertos de caché.
+
+Se activa con INSTRUMENTACION=True. Con ella desactivada el middleware se
+descarta al arrancar (MiddlewareNotUsed) y las funciones de este módulo solo
+leen una ContextVar vacía, así que el coste es despreciable.
+
+Por cada petición se miden:
+    - consultas SQL y tiempo total en la base de datos
+    - tiempo en Databricks (`db_utils.databricks_connection`)
+    - tiempo de renderizado de plantillas (incluye las consultas lanzadas desde ellas)
+    - aciertos/fallos de `cache_por_farmacia`
+
+y se devuelven en la cabecera `Server-Timing` (visible en las DevTools del
+navegador), en una línea de log JSON y en una muestra por vista, de la que
+salen los percentiles de la página de rendimiento para staff.
+
+Las muestras se acumulan en memoria y cada proceso las vuelca como mucho
+cada METRICAS_VOLCADO_S segundos (como core/metricas.py) en un lote nuevo
+de la caché compartida, numerado con un `incr` atómico: ningún worker
+reescribe lo de otro y cada volcado cuesta lo que ocupa el lote, no la
+ventana entera.
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Muestras (las más recientes) que se usan por vista para los percentiles
+MUESTRAS_POR_VISTA = 500
+# Vida de cada lote de muestras en la caché
+VIDA_LOTES = 24 * 3600
+
+# Bajo el prefijo 'farma' de core/cache_utils.py (no se importa: cache_utils depende de este módulo)
+PREFIJO = 'farma:instr'
+_CLAVE_VISTAS = f"{PREFIJO}:vistas"
+
+_actual = ContextVar('metricas_peticion', default=None)
+
+
+class MetricasPeticion:
+    """Acumuladores de una petición en curso."""
+
+    def __init__(self):
+        self.consultas = 0
+        self.tiempos = {'bd': 0.0, 'databricks': 0.0, 'plantillas': 0.0}
+        self.cache_aciertos = 0
+        self.cache_fallos = 0
+        self._midiendo = set()
+
+
+def percentil(valores, p):
+    """
+    Percentil `p` (0-100) por interpolación lineal.
+
+    Args:
+        valores (list): Muestras numéricas
+        p (float): Percentil a calcular
+
+    Returns:
+        float: Valor del percentil (0.0 si no hay muestras)
+    """
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    pos = (len(ordenados) - 1) * (p / 100)
+    inferior = int(pos)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (pos - inferior)
+
+
+def metricas_actuales():
+    """Métricas de la petición en curso, o None si no se está instrumentando."""
+    return _actual.get()
+
+
+@contextmanager
+def medir(nombre):
+    """
+    Suma la duración del bloque al tiempo `nombre` de la petición en curso.
+
+    Las llamadas anidadas con el mismo nombre solo cuentan una vez (p. ej. un
+    render_to_string dentro de una plantilla).
+    """
+    metricas = _actual.get()
+    if metricas is None or nombre in metricas._midiendo:
+        yield
+        return
+    metricas._midiendo.add(nombre)
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        metricas.tiempos[nombre] += time.perf_counter() - inicio
+        metricas._midiendo.discard(nombre)
+
+
+def registrar_cache(acierto):
+    """Anota un acierto o fallo de caché en la petición en curso."""
+    metricas = _actual.get()
+    if metricas is None:
+        return
+    if acierto:
+        metricas.cache_aciertos += 1
+    else:
+        metricas.cache_fallos += 1
+
+
+def _envoltorio_sql(execute, sql, params, many, context):
+    inicio = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metricas = _actual.get()
+        if metricas is not None:
+            metricas.consultas += 1
+            metricas.tiempos['bd'] += time.perf_counter() - inicio
+
+
+_plantillas_instrumentadas = False
+
+
+def _instrumentar_plantillas():
+    """Envuelve el render del backend de plantillas de Django (una sola vez por proceso)."""
+    global _plantillas_instrumentadas
+    if _plantillas_instrumentadas:
+        return
+    from django.template.backends.django import Template
+
+    render_original = Template.render
+
+    @wraps(render_original)
+    def render(self, context=None, request=None):
+        with medir('plantillas'):
+            return render_original(self, context, request)
+
+    Template.render = render
+    _plantillas_instrumentadas = True
+
+
+def _clave_secuencia(vista):
+    return f"{PREFIJO}:secuencia:{vista}"
+
+
+def _clave_lote(vista, numero):
+    return f"{PREFIJO}:lote:{vista}:{numero}"
+
+
+_pendientes = defaultdict(list)
+_cerrojo = threading.Lock()
+_ultimo_volcado = time.monotonic()
+
+
+def _guardar_muestra(vista, muestra):
+    """Añade una muestra de la vista al acumulador del proceso y vuelca si toca."""
+    with _cerrojo:
+        _pendientes[vista].append(muestra)
+    if time.monotonic() - _ultimo_volcado >= settings.METRICAS_VOLCADO_S:
+        volcar_muestras()
+
+
+def _siguiente_lote(vista):
+    clave = _clave_secuencia(vista)
+    try:
+        return cache.incr(clave)
+    except ValueError:
+        # Primera muestra de la vista (o tras reiniciar): numeración por encima de cualquier lote anterior
+        cache.add(clave, time.time_ns(), timeout=None)
+        return cache.incr(clave)
+
+
+def volcar_muestras():
+    """Escribe en la caché compartida un lote por vista con lo acumulado en este proceso."""
+    global _ultimo_volcado
+    with _cerrojo:
+        lotes = {vista: muestras[-MUESTRAS_POR_VISTA:] for vista, muestras in _pendientes.items()}
+        _pendientes.clear()
+        _ultimo_volcado = time.monotonic()
+    if not lotes:
+        return
+    for vista, muestras in lotes.items():
+        cache.set(_clave_lote(vista, _siguiente_lote(vista)), muestras, timeout=VIDA_LOTES)
+
+    # La lista de vistas sí es leer-modificar-escribir, pero solo cambia al
+    # aparecer una vista nueva y se revisa en cada volcado: si dos workers la
+    # pisan a la vez, el siguiente volcado la completa
+    vistas = cache.get(_CLAVE_VISTAS) or []
+    if not set(lotes) <= set(vistas):
+        cache.set(_CLAVE_VISTAS, sorted(set(vistas) | set(lotes)), timeout=None)
+
+
+atexit.register(volcar_muestras)
+
+
+def _muestras_recientes(vista):
+    """Últimas MUESTRAS_POR_VISTA muestras de la vista, de los lotes más nuevos hacia atrás."""
+    numero = cache.get(_clave_secuencia(vista))
+    muestras = []
+    while numero is not None and len(muestras) < MUESTRAS_POR_VISTA:
+        numeros = range(numero, numero - 50, -1)
+        lotes = cache.get_many([_clave_lote(vista, n) for n in numeros])
+        for n in numeros:
+            lote = lotes.get(_clave_lote(vista, n))
+            if lote is None:
+                # Antes del primer lote, caducado o desalojado: no hay más
+                return muestras[:MUESTRAS_POR_VISTA]
+            muestras.extend(reversed(lote))
+        numero -= 50
+    return muestras[:MUESTRAS_POR_VISTA]
+
+
+def resumen_por_vista():
+    """
+    Percentiles de duración y medias de consultas por vista.
+
+    Returns:
+        list: dicts {vista, n, p50_ms, p95_ms, p99_ms, max_ms, consultas, bd_ms, plantillas_ms}
+              ordenados por p95 descendente
+    """
+    volcar_muestras()
+    filas = []
+    for vista in cache.get(_CLAVE_VISTAS) or []:
+        muestras = _muestras_recientes(vista)
+        if not muestras:
+            continue
+        totales = [m['total_ms'] for m in muestras]
+        n = len(muestras)
+        filas.append({
+            'vista': vista,
+            'n': n,
+            'p50_ms': round(percentil(totales, 50), 1),
+            'p95_ms': round(percentil(totales, 95), 1),
+            'p99_ms': round(percentil(totales, 99), 1),
+            'max_ms': round(max(totales), 1),
+            'consultas': round(sum(m['consultas'] for m in muestras) / n, 1),
+            'bd_ms': round(sum(m['bd_ms'] for m in muestras) / n, 1),
+            'plantillas_ms': round(sum(m['plantillas_ms'] for m in muestras) / n, 1),
+        })
+    return sorted(filas, key=lambda f: f['p95_ms'], reverse=True)
+
+
+def reiniciar_resumen():
+    """Olvida las muestras acumuladas de todas las vistas (los lotes viejos caducan solos)."""
+    with _cerrojo:
+        _pendientes.clear()
+    vistas = cache.get(_CLAVE_VISTAS) or []
+    cache.delete_many([_clave_secuencia(v) for v in vistas] + [_CLAVE_VISTAS])
+
+
+def _server_timing(metricas, total_ms):
+    ms = {nombre: segundos * 1000 for nombre, segundos in metricas.tiempos.items()}
+    partes = [
+        f'db;dur={ms["bd"]:.1f};desc="{metricas.consultas} consultas"',
+        f'tpl;dur={ms["plantillas"]:.1f}',
+        f'cache;desc="{metricas.cache_aciertos} aciertos / {metricas.cache_fallos} fallos"',
+        f'total;dur={total_ms:.1f}',
+    ]
+    if ms['databricks']:
+        partes.insert(1, f'databricks;dur={ms["databricks"]:.1f}')
+    return ', '.join(partes)
+
+
+class InstrumentacionMiddleware:
+    """
+    Mide cada petición y añade la cabecera Server-Timing.
+
+    Va justo después de SecurityMiddleware y CompresionMiddleware para que el
+    total incluya la sesión, la autenticación y el resto de middlewares; la
+    compresión queda fuera (se aplica después, sobre la respuesta ya medida).
+    Es solo síncrono: con ASGI, Django la ejecuta en un hilo por petición (es
+    de diagnóstico y está desactivada por defecto).
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'INSTRUMENTACION', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        _instrumentar_plantillas()
+
+    def __call__(self, request):
+        metricas = MetricasPeticion()
+        token = _actual.set(metricas)
+        inicio = time.perf_counter()
+        try:
+            with ExitStack() as pila:
+                for conexion in connections.all():
+                    pila.enter_context(conexion.execute_wrapper(_envoltorio_sql))
+                response = self.get_response(request)
+        finally:
+            _actual.reset(token)
+        total_ms = (time.perf_counter() - inicio) * 1000
+
+        response['Server-Timing'] = _server_timing(metricas, total_ms)
+
+        coincidencia = getattr(request, 'resolver_match', None)
+        vista = coincidencia.view_name if coincidencia else 'sin_resolver'
+        muestra = {
+            'total_ms': round(total_ms, 2),
+            'consultas': metricas.consultas,
+            'bd_ms': round(metricas.tiempos['bd'] * 1000, 2),
+            'databricks_ms': round(metricas.tiempos['databricks'] * 1000, 2),
+            'plantillas_ms': round(metricas.tiempos['plantillas'] * 1000, 2),
+        }
+        logger.info(json.dumps({
+            'vista': vista,
+            'metodo': request.method,
+            'ruta': request.path,
+            'estado': response.status_code,
+            'farmacia': request.session.get('farmacia_activa') if hasattr(request, 'session') else None,
+            'cache_aciertos': metricas.cache_aciertos,
+            'cache_fallos': metricas.cache_fallos,
+            **muestra,
+        }))
+        if coincidencia:
+            _guardar_muestra(vista, muestra)
+        return response
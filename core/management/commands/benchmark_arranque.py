@@ -0,0 +1,121 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Lo que hace un worker de gunicorn antes de su primera petición: cargar la
+# aplicación WSGI y resolver las URLs (que importan todas las vistas).
+ARRANQUE = """
+import json, os, sys, time
+inicio = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+from django.urls import get_resolver
+get_resolver().url_patterns
+if {con_conector}:
+    from databricks.sql import client  # lo que carga la primera conexión real
+segundos = time.perf_counter() - inicio
+rss_kb = next(int(l.split()[1]) for l in open('/proc/self/status') if l.startswith('VmRSS'))
+print(json.dumps({{
+    'segundos': segundos, 'rss_mb': rss_kb / 1024, 'modulos': len(sys.modules),
+    'databricks': 'databricks' in sys.modules,
+    'benchmarks': 'core.benchmarks' in sys.modules or 'django.test' in sys.modules,
+}}))
+"""
+
+
+def _importtime(salida):
+    """
+    Suma el tiempo propio de cada paquete de primer nivel de `-X importtime`.
+
+    Returns:
+        dict: {paquete: microsegundos}
+    """
+    por_paquete = defaultdict(int)
+    for linea in salida.splitlines():
+        if not linea.startswith('import time:') or 'self [us]' in linea:
+            continue
+        propio, _, nombre = linea[len('import time:'):].split('|')
+        por_paquete[nombre.strip().split('.')[0]] += int(propio)
+    return dict(por_paquete)
+
+
+def medir_arranque(con_conector=False):
+    """
+    Arranca un proceso nuevo como un worker y mide su importación.
+
+    Args:
+        con_conector (bool): Importar además el cliente de databricks.sql (pandas, numpy, thrift...),
+            como un worker que ya ha sincronizado
+
+    Returns:
+        dict: segundos, rss_mb, modulos, databricks (si se cargó el conector),
+            benchmarks (si se cargaron core.benchmarks o django.test) e importtime_ms
+            (tiempo propio por paquete)
+    """
+    proceso = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', ARRANQUE.format(con_conector=con_conector)],
+        cwd=settings.BASE_DIR, capture_output=True, text=True,
+        env={**os.environ, 'PYTHONWARNINGS': 'ignore'},
+    )
+    if proceso.returncode:
+        raise CommandError(f"El arranque ha fallado:\n{proceso.stderr[-2000:]}")
+    resultado = json.loads(proceso.stdout.strip().splitlines()[-1])
+    resultado['importtime_ms'] = {p: us / 1000 for p, us in _importtime(proceso.stderr).items()}
+    return resultado
+
+
+def _resumen(medidas):
+    importtime = defaultdict(list)
+    for m in medidas:
+        for paquete, ms in m['importtime_ms'].items():
+            importtime[paquete].append(ms)
+    return {
+        'segundos': round(statistics.median(m['segundos'] for m in medidas), 3),
+        'rss_mb': round(statistics.median(m['rss_mb'] for m in medidas), 1),
+        'modulos': medidas[0]['modulos'],
+        'databricks': medidas[0]['databricks'],
+        'importtime_ms': {p: round(statistics.median(v), 1) for p, v in importtime.items()},
+    }
+
+
+class Command(BaseCommand):
+    help = 'Mide el arranque de un worker (tiempo de importación con -X importtime y RSS)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeticiones', type=int, default=5, help='Arranques medidos por variante (mediana)')
+        parser.add_argument('--top', type=int, default=10, help='Paquetes más lentos de importar que se muestran')
+        parser.add_argument('--json', action='store_true', help='Salida en JSON')
+
+    def handle(self, *args, **options):
+        repeticiones = max(options['repeticiones'], 1)
+        resultado = {
+            'worker': _resumen([medir_arranque() for _ in range(repeticiones)]),
+            'worker_con_conector': _resumen([medir_arranque(con_conector=True) for _ in range(repeticiones)]),
+        }
+        if resultado['worker']['databricks']:
+            self.stderr.write(self.style.WARNING('El arranque ya importa databricks: algún módulo lo carga al inicio'))
+
+        if options['json']:
+            self.stdout.write(json.dumps(resultado, indent=2))
+            return
+
+        self.stdout.write(f"{'variante':<22} {'arranque s':>11} {'RSS MB':>8} {'módulos':>8}")
+        for nombre, r in resultado.items():
+            self.stdout.write(f"{nombre:<22} {r['segundos']:>11} {r['rss_mb']:>8} {r['modulos']:>8}")
+        base, conector = resultado['worker'], resultado['worker_con_conector']
+        self.stdout.write(
+            f"Conector en diferido: {conector['segundos'] - base['segundos']:.3f} s y "
+            f"{conector['rss_mb'] - base['rss_mb']:.1f} MB menos por worker que no sincroniza"
+        )
+
+        self.stdout.write("\nPaquetes más lentos de importar (tiempo propio, con el conector):")
+        lentos = sorted(conector['importtime_ms'].items(), key=lambda p: p[1], reverse=True)[:options['top']]
+        for paquete, ms in lentos:
+            self.stdout.write(f"  {paquete:<24} {ms:>8.1f} ms")
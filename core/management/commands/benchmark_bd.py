@@ -0,0 +1,162 @@
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.benchmarks import resumen_tiempos
+
+_ESQUEMA = """
+CREATE TABLE oportunidad (
+    id INTEGER PRIMARY KEY,
+    farmacia_id TEXT NOT NULL,
+    grupo_homogeneo TEXT NOT NULL,
+    producto_recomendado TEXT NOT NULL,
+    a_sustituir TEXT NOT NULL,
+    ahorro_potencial REAL NOT NULL
+);
+CREATE INDEX oportunidad_farmacia_ahorro ON oportunidad (farmacia_id, ahorro_potencial);
+"""
+
+# Perfil "antes": valores por defecto de Django/SQLite (journal DELETE, synchronous FULL, 5 s de espera)
+PERFILES = {
+    'delete': {'pragmas': {'journal_mode': 'DELETE', 'synchronous': 'FULL'}, 'timeout': 5},
+    'wal': {'pragmas': settings.SQLITE_PRAGMAS, 'timeout': 20},
+}
+
+
+def _conectar(ruta, perfil):
+    conn = sqlite3.connect(ruta, timeout=perfil['timeout'], isolation_level=None, check_same_thread=False)
+    for pragma, valor in perfil['pragmas'].items():
+        conn.execute(f'PRAGMA {pragma}={valor}')
+    return conn
+
+
+def _filas(farmacia_id, num_filas, rnd):
+    return [
+        (farmacia_id, f'GRUPO {i}', f'GENERICO {i}', ' || '.join(f'MARCA {i}-{j} (10|40%|6500{j})' for j in range(4)),
+         rnd.uniform(10, 3000))
+        for i in range(num_filas)
+    ]
+
+
+def _insertar(conn, filas):
+    conn.executemany(
+        'INSERT INTO oportunidad (farmacia_id, grupo_homogeneo, producto_recomendado, a_sustituir, ahorro_potencial) '
+        'VALUES (?, ?, ?, ?, ?)',
+        filas,
+    )
+
+
+def _ejecutar_perfil(directorio, nombre, perfil, opciones):
+    """Lectores de dashboard contra una farmacia mientras otra se sincroniza sin parar."""
+    ruta = os.path.join(directorio, f'{nombre}.sqlite3')
+    rnd = random.Random(0)
+    farmacias = [f'HF{i:03d}' for i in range(opciones['farmacias'])]
+
+    conn = _conectar(ruta, perfil)
+    conn.executescript(_ESQUEMA)
+    conn.execute('BEGIN')
+    for farmacia in farmacias:
+        _insertar(conn, _filas(farmacia, opciones['filas'], rnd))
+    conn.execute('COMMIT')
+    conn.close()
+
+    fin = time.monotonic() + opciones['segundos']
+    tiempos_lectura, tiempos_sync = [], []
+    errores = {'lectura': 0, 'sync': 0}
+    cerrojo = threading.Lock()
+
+    def escritor():
+        # Simula sincronizar_desde_databricks: borrar + insertar la farmacia en una transacción
+        c = _conectar(ruta, perfil)
+        filas = _filas(farmacias[0], opciones['filas'], random.Random(1))
+        while time.monotonic() < fin:
+            inicio = time.perf_counter()
+            try:
+                c.execute('BEGIN IMMEDIATE')
+                c.execute('DELETE FROM oportunidad WHERE farmacia_id = ?', (farmacias[0],))
+                _insertar(c, filas)
+                c.execute('COMMIT')
+                tiempos_sync.append(time.perf_counter() - inicio)
+            except sqlite3.OperationalError:
+                errores['sync'] += 1
+                if c.in_transaction:
+                    c.execute('ROLLBACK')
+        c.close()
+
+    def lector(indice):
+        # Lo que hace el dashboard: KPIs agregados + top 5
+        c = _conectar(ruta, perfil)
+        farmacia = farmacias[1 + indice % (len(farmacias) - 1)] if len(farmacias) > 1 else farmacias[0]
+        propios = []
+        fallos = 0
+        while time.monotonic() < fin:
+            inicio = time.perf_counter()
+            try:
+                c.execute(
+                    'SELECT COUNT(*), SUM(ahorro_potencial) FROM oportunidad WHERE farmacia_id = ?', (farmacia,)
+                ).fetchone()
+                c.execute(
+                    'SELECT grupo_homogeneo, ahorro_potencial FROM oportunidad WHERE farmacia_id = ? '
+                    'ORDER BY ahorro_potencial DESC LIMIT 5', (farmacia,)
+                ).fetchall()
+                propios.append(time.perf_counter() - inicio)
+            except sqlite3.OperationalError:
+                fallos += 1
+        c.close()
+        with cerrojo:
+            tiempos_lectura.extend(propios)
+            errores['lectura'] += fallos
+
+    hilos = [threading.Thread(target=escritor)]
+    hilos += [threading.Thread(target=lector, args=(i,)) for i in range(opciones['lectores'])]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+
+    return {
+        'lecturas': resumen_tiempos(tiempos_lectura),
+        'lecturas_por_segundo': round(len(tiempos_lectura) / opciones['segundos'], 1),
+        'sincronizaciones': resumen_tiempos(tiempos_sync),
+        'errores': errores,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Mide lecturas concurrentes durante una sincronización con SQLite en modo DELETE frente a WAL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--segundos', type=float, default=5, help='Duración de cada prueba')
+        parser.add_argument('--lectores', type=int, default=4, help='Hilos lectores concurrentes')
+        parser.add_argument('--farmacias', type=int, default=5, help='Farmacias en la tabla')
+        parser.add_argument('--filas', type=int, default=2000, help='Oportunidades por farmacia')
+        parser.add_argument('--json', action='store_true', help='Salida en JSON')
+
+    def handle(self, *args, **options):
+        resultados = {}
+        with tempfile.TemporaryDirectory() as directorio:
+            for nombre, perfil in PERFILES.items():
+                resultados[nombre] = _ejecutar_perfil(directorio, nombre, perfil, options)
+
+        if options['json']:
+            self.stdout.write(json.dumps(resultados, indent=2))
+            return
+
+        self.stdout.write(
+            f"{'journal':<8} {'lect/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>9} "
+            f"{'syncs':>6} {'sync p50':>9} {'errores':>8}"
+        )
+        for nombre, r in resultados.items():
+            lect, sync = r['lecturas'], r['sincronizaciones']
+            self.stdout.write(
+                f"{nombre:<8} {r['lecturas_por_segundo']:>9} {lect.get('p50_ms', 0):>8} {lect.get('p95_ms', 0):>8} "
+                f"{lect.get('p99_ms', 0):>8} {lect.get('max_ms', 0):>9} {sync['n']:>6} "
+                f"{sync.get('p50_ms', 0):>9} {sum(r['errores'].values()):>8}"
+            )
@@ -0,0 +1,116 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from django.core.cache.backends.db import DatabaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+from django.core.management.commands.createcachetable import Command as CreateCacheTable
+
+from core.benchmarks import entorno_benchmark, medir, resumen_tiempos
+from core.cache_backends import SQLiteCache
+
+# Valor representativo: el resumen de un dashboard (unos pocos KB)
+VALOR = {'top_5': [{'grupo': f'GRUPO {i}', 'ahorro': i * 10.5} for i in range(50)], 'total': 12345.67}
+
+
+def _crear_backends(directorio):
+    """Instancia los backends a comparar (se llama también en cada proceso hijo)."""
+    return {
+        'locmem': LocMemCache('farma-bench', {}),
+        'file': FileBasedCache(os.path.join(directorio, 'file_cache'), {}),
+        'database': DatabaseCache('farma_bench_cache', {}),
+        'sqlite': SQLiteCache(os.path.join(directorio, 'farma_cache.sqlite3'), {}),
+    }
+
+
+def _worker(nombre, directorio, operaciones, cola):
+    """Proceso hijo: mezcla 80% lecturas / 20% escrituras sobre claves compartidas."""
+    cache = _crear_backends(directorio)[nombre]
+
+    def op(i):
+        clave = f'compartida:{i % 50}'
+        if i % 5 == 0:
+            cache.set(clave, VALOR, 300)
+        else:
+            cache.get(clave)
+
+    cola.put(medir(op, operaciones))
+
+
+class Command(BaseCommand):
+    help = 'Compara el backend SQLiteCache con locmem, file y database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ops', type=int, default=2000, help='Operaciones por prueba')
+        parser.add_argument('--procesos', type=int, default=4, help='Procesos concurrentes en la prueba multiproceso')
+        parser.add_argument('--json', action='store_true', help='Salida en JSON')
+
+    def handle(self, *args, **options):
+        ops = options['ops']
+        resultados = {}
+
+        with entorno_benchmark(), tempfile.TemporaryDirectory() as directorio:
+            creador = CreateCacheTable()
+            creador.verbosity = 0
+            creador.create_table('default', 'farma_bench_cache', dry_run=False)
+            backends = _crear_backends(directorio)
+
+            for nombre, cache in backends.items():
+                cache.clear()
+                r = {}
+                r['set'] = resumen_tiempos(medir(lambda i: cache.set(f'k{i}', VALOR, 300), ops))
+                r['get_hit'] = resumen_tiempos(medir(lambda i: cache.get(f'k{i}'), ops))
+                r['get_miss'] = resumen_tiempos(medir(lambda i: cache.get(f'no{i}'), ops))
+                cache.set('contador', 0, None)
+                r['incr'] = resumen_tiempos(medir(lambda i: cache.incr('contador'), ops))
+                r['get_or_set'] = resumen_tiempos(
+                    medir(lambda i: cache.get_or_set(f'gos{i % 100}', lambda: VALOR, 300), ops)
+                )
+                resultados[nombre] = r
+
+            # Prueba multiproceso: solo tiene sentido en backends compartidos.
+            # (La base de datos de test es en memoria y no se comparte entre procesos.)
+            ctx = multiprocessing.get_context('fork')
+            for nombre in ('file', 'sqlite'):
+                cola = ctx.Queue()
+                procesos = [
+                    ctx.Process(target=_worker, args=(nombre, directorio, ops, cola))
+                    for _ in range(options['procesos'])
+                ]
+                inicio = time.perf_counter()
+                for p in procesos:
+                    p.start()
+                tiempos = []
+                for _ in procesos:
+                    tiempos.extend(cola.get())
+                for p in procesos:
+                    p.join()
+                total = time.perf_counter() - inicio
+                resumen = resumen_tiempos(tiempos)
+                resumen['throughput_total_ops_s'] = round(len(tiempos) / total, 1)
+                resultados[nombre]['multiproceso'] = resumen
+
+            # Visibilidad entre procesos: lo que escribe un hijo, ¿lo ve el padre?
+            for nombre, cache in backends.items():
+                cache.delete('visibilidad')
+                p = ctx.Process(target=lambda c=nombre: _crear_backends(directorio)[c].set('visibilidad', 1, 60))
+                p.start()
+                p.join()
+                resultados[nombre]['compartida_entre_procesos'] = cache.get('visibilidad') == 1
+
+        if options['json']:
+            self.stdout.write(json.dumps(resultados, indent=2))
+            return
+
+        self.stdout.write(f"{'backend':<10} {'op':<14} {'p50 ms':>9} {'p95 ms':>9} {'ops/s':>10}")
+        for nombre, r in resultados.items():
+            for op, datos in r.items():
+                if isinstance(datos, dict):
+                    self.stdout.write(
+                        f"{nombre:<10} {op:<14} {datos['p50_ms']:>9} {datos['p95_ms']:>9} {datos['ops_s']:>10}"
+                    )
+            self.stdout.write(f"{nombre:<10} compartida entre procesos: {r['compartida_entre_procesos']}")
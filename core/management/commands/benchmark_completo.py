@@ -0,0 +1,240 @@
+import json
+import os
+import platform
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from core.benchmarks import (
+    cliente_de_farmacia, comparar_con_base, entorno_benchmark, preparar_warehouse, resumen_tiempos,
+)
+from core.cache_utils import incrementar_version
+from core.datos_sinteticos import cargar_en_django, ids_farmacias, ids_grupos_efp
+from core.models import PerfilFarmacia
+
+# (nombre, url) de las vistas de lectura que se recorren en cada escala
+VISTAS = (
+    ('dashboard', '/'),
+    ('buscador', '/buscador/?q=OMEPRAZOL'),
+    ('datos_brutos', '/datos-brutos/'),
+    ('entrenamiento', '/entrenamiento/'),
+    ('examen', '/examen/'),
+    ('configuracion', '/configuracion/'),
+    ('efp_dashboard', '/efp/dashboard/'),
+    ('efp_buscador', '/efp/buscador/?q=TOS'),
+    ('efp_datos_brutos', '/efp/datos-brutos/'),
+    ('efp_entrenamiento', '/efp/entrenamiento/'),
+    ('efp_examen', '/efp/examen/'),
+    ('efp_configuracion', '/efp/configuracion/'),
+)
+PERIODO_IMPORTAR = {'fecha_inicio': '2024-01-01', 'fecha_fin': '2024-12-31'}
+
+
+def _peticion(cliente, metodo, url, datos=None):
+    """Hace la petición y devuelve (segundos, consultas SQL)."""
+    with CaptureQueriesContext(connection) as consultas:
+        inicio = time.perf_counter()
+        respuesta = getattr(cliente, metodo)(url, datos) if datos else getattr(cliente, metodo)(url)
+        segundos = time.perf_counter() - inicio
+    if respuesta.status_code >= 400:
+        raise CommandError(f"{metodo.upper()} {url} -> {respuesta.status_code}")
+    return segundos, len(consultas)
+
+
+def _pico_memoria_kb(cliente, metodo, url, datos=None):
+    """Memoria máxima reservada (tracemalloc) durante una petición."""
+    tracemalloc.start()
+    try:
+        _peticion(cliente, metodo, url, datos)
+        return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+
+def _medir_vista(cliente, farmacia_id, metodo, url, repeticiones, datos=None):
+    # En frío: la primera petición tras invalidar la caché de la farmacia
+    incrementar_version(farmacia_id)
+    primera, consultas_frio = _peticion(cliente, metodo, url, datos)
+
+    tiempos, consultas = [], []
+    for _ in range(repeticiones):
+        segundos, num = _peticion(cliente, metodo, url, datos)
+        tiempos.append(segundos)
+        consultas.append(num)
+
+    r = resumen_tiempos(tiempos)
+    r['primera_ms'] = round(primera * 1000, 3)
+    r['consultas_frio'] = consultas_frio
+    r['consultas'] = round(sum(consultas) / len(consultas), 2)
+    r['pico_kb'] = _pico_memoria_kb(cliente, metodo, url, datos)
+    return r
+
+
+def _carga(clientes, duracion):
+    """
+    Recorre las vistas en bucle desde varios hilos durante `duracion` segundos.
+
+    Returns:
+        dict: Percentiles de todas las peticiones, peticiones/s y errores
+    """
+    tiempos, errores = [], []
+    cerrojo = threading.Lock()
+    fin = time.perf_counter() + duracion
+
+    def trabajador(indice, cliente):
+        propios, i = [], indice
+        try:
+            while time.perf_counter() < fin:
+                _, url = VISTAS[i % len(VISTAS)]
+                inicio = time.perf_counter()
+                respuesta = cliente.get(url)
+                propios.append(time.perf_counter() - inicio)
+                if respuesta.status_code >= 400:
+                    errores.append(f"{url} -> {respuesta.status_code}")
+                i += 1
+        except Exception as e:
+            errores.append(repr(e))
+        finally:
+            connections.close_all()
+            with cerrojo:
+                tiempos.extend(propios)
+
+    hilos = [threading.Thread(target=trabajador, args=(i, c)) for i, c in enumerate(clientes)]
+    inicio = time.perf_counter()
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    transcurrido = time.perf_counter() - inicio
+
+    r = resumen_tiempos(tiempos)
+    # Rendimiento agregado de todos los hilos (resumen_tiempos da el de un solo hilo)
+    r['ops_s'] = round(len(tiempos) / transcurrido, 1)
+    r['hilos'] = len(clientes)
+    r['errores'] = len(errores)
+    return r
+
+
+class Command(BaseCommand):
+    help = 'Benchmark de extremo a extremo: vistas AH/EFP, importación y carga concurrente a varias escalas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--escalas', default='50,300,1000', help='Grupos AH por farmacia en cada escala')
+        parser.add_argument('--farmacias', type=int, default=4, help='Farmacias sembradas (una por hilo de carga)')
+        parser.add_argument('--repeticiones', type=int, default=30, help='Peticiones en caliente por vista')
+        parser.add_argument('--importaciones', type=int, default=3, help='Importaciones medidas por escala')
+        parser.add_argument('--hilos', type=int, default=4, help='Hilos del generador de carga')
+        parser.add_argument('--duracion', type=float, default=5, help='Segundos de carga concurrente por escala')
+        parser.add_argument('--semilla', type=int, default=0)
+        parser.add_argument('--guardar', help='Guardar el resultado (JSON) en esta ruta')
+        parser.add_argument('--base', help='Resultado guardado con el que comparar')
+        parser.add_argument('--umbral', type=float, default=20,
+                            help='Empeoramiento (%%) frente a la base que se considera regresión')
+        parser.add_argument('--json', action='store_true', help='Salida en JSON')
+
+    def handle(self, *args, **options):
+        escalas = [int(e) for e in options['escalas'].split(',') if e.strip()]
+        farmacias = ids_farmacias(max(options['farmacias'], 1))
+        resultado = {
+            'entorno': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'plataforma': platform.platform(),
+                'fecha': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            },
+            'escalas': {},
+        }
+
+        with tempfile.TemporaryDirectory() as directorio, override_settings(
+            DATABRICKS_BACKEND='local',
+            WAREHOUSE_LOCAL_PATH=os.path.join(directorio, 'warehouse.sqlite3'),
+            METRICAS_PATH=os.path.join(directorio, 'metricas.sqlite3'),
+        ), entorno_benchmark() as conexion:
+            resultado['entorno']['bd'] = conexion.vendor
+            usuarios = []
+            for farmacia_id in farmacias:
+                usuario = User.objects.create_user(f'bench_{farmacia_id}', password='bench')
+                PerfilFarmacia.objects.create(user=usuario, farmacia_id=farmacia_id)
+                usuarios.append((usuario, farmacia_id))
+            # Importar es solo de staff
+            importador = User.objects.create_user('bench_importador', password='bench', is_staff=True)
+            ids_efp = ids_grupos_efp(14)
+
+            for escala in escalas:
+                self.stderr.write(f"Escala {escala} grupos/farmacia...")
+                cargar_en_django(farmacias, grupos_ah=escala, ids_efp=ids_efp, semilla=options['semilla'])
+                preparar_warehouse(
+                    os.path.join(directorio, 'warehouse.sqlite3'), farmacias, escala, semilla=options['semilla'],
+                )
+                usuario, farmacia_id = usuarios[0]
+                cliente = cliente_de_farmacia(usuario, farmacia_id)
+
+                vistas = {}
+                for nombre, url in VISTAS:
+                    vistas[nombre] = _medir_vista(cliente, farmacia_id, 'get', url, options['repeticiones'])
+
+                carga = _carga(
+                    [cliente_de_farmacia(*usuarios[i % len(usuarios)]) for i in range(options['hilos'])],
+                    options['duracion'],
+                )
+
+                # La importación va al final: invalida la caché y reescribe los datos de la farmacia
+                vistas['importar'] = _medir_vista(
+                    cliente_de_farmacia(importador, farmacia_id), farmacia_id, 'post', '/importar/', options['importaciones'],
+                    datos={'farmacia_input': farmacia_id, **PERIODO_IMPORTAR},
+                )
+
+                resultado['escalas'][str(escala)] = {
+                    'vistas': vistas,
+                    'carga': carga,
+                    # ru_maxrss: KB en Linux; pico del proceso hasta este momento
+                    'rss_max_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                }
+
+        if options['base']:
+            with open(options['base'], encoding='utf-8') as f:
+                base = json.load(f)
+            resultado['comparacion'] = comparar_con_base(resultado['escalas'], base.get('escalas', {}), options['umbral'])
+        if options['guardar']:
+            with open(options['guardar'], 'w', encoding='utf-8') as f:
+                json.dump(resultado, f, indent=2)
+
+        if options['json']:
+            self.stdout.write(json.dumps(resultado, indent=2))
+        else:
+            self._tabla(resultado)
+
+        regresiones = [d for d in resultado.get('comparacion', []) if d['regresion']]
+        if regresiones:
+            raise CommandError(f"{len(regresiones)} métricas empeoran más de un {options['umbral']}% frente a la base")
+
+    def _tabla(self, resultado):
+        for escala, datos in resultado['escalas'].items():
+            self.stdout.write(f"\n== {escala} grupos AH por farmacia (RSS máx. {datos['rss_max_mb']} MB) ==")
+            self.stdout.write(
+                f"{'vista':<20} {'frío ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ops/s':>8} "
+                f"{'consultas':>10} {'pico KB':>9}"
+            )
+            for nombre, r in datos['vistas'].items():
+                self.stdout.write(
+                    f"{nombre:<20} {r['primera_ms']:>9} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} "
+                    f"{r['ops_s']:>8} {r['consultas']:>10} {r['pico_kb']:>9}"
+                )
+            c = datos['carga']
+            self.stdout.write(
+                f"Carga ({c['hilos']} hilos): {c['ops_s']} peticiones/s, p50 {c.get('p50_ms')} ms, "
+                f"p95 {c.get('p95_ms')} ms, errores {c['errores']}"
+            )
+        for d in resultado.get('comparacion', []):
+            if d['regresion']:
+                self.stdout.write(self.style.ERROR(
+                    f"REGRESIÓN {d['ruta']} {d['metrica']}: {d['base']} -> {d['actual']} ({d['cambio_pct']:+}%)"
+                ))
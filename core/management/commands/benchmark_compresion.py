@@ -0,0 +1,93 @@
+import json
+import os
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from core.benchmarks import cliente_de_farmacia, entorno_benchmark
+from core.compresion import brotli
+from core.datos_sinteticos import cargar_en_django, ids_grupos_efp
+from core.management.commands.benchmark_completo import VISTAS
+from core.models import PerfilFarmacia
+
+FARMACIA = 'HF280050001'
+# (variante, Accept-Encoding, MINIFICAR_HTML)
+VARIANTES = (
+    ('sin_comprimir', 'identity', False),
+    ('minificado', 'identity', True),
+    ('gzip', 'gzip', False),
+    ('gzip_min', 'gzip', True),
+    ('br', 'br', False),
+    ('br_min', 'br', True),
+)
+
+
+def medir_pagina(cliente, url, accept_encoding, minificar):
+    """
+    Bytes del cuerpo tal como salen al cable y tiempo de la petición.
+
+    Returns:
+        tuple: (bytes, milisegundos)
+    """
+    with override_settings(MINIFICAR_HTML=minificar):
+        inicio = time.perf_counter()
+        respuesta = cliente.get(url, HTTP_ACCEPT_ENCODING=accept_encoding)
+        cuerpo = b''.join(respuesta.streaming_content) if respuesta.streaming else respuesta.content
+        milisegundos = (time.perf_counter() - inicio) * 1000
+    if respuesta.status_code >= 400:
+        raise CommandError(f"GET {url} -> {respuesta.status_code}")
+    return len(cuerpo), round(milisegundos, 2)
+
+
+class Command(BaseCommand):
+    help = 'Mide los bytes de cada página principal sin comprimir, minificada, con gzip y con Brotli'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grupos', type=int, default=300, help='Grupos AH de la farmacia sembrada')
+        parser.add_argument('--familias-efp', type=int, default=14, help='Familias EFP sembradas')
+        parser.add_argument('--semilla', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='Salida en JSON')
+
+    def handle(self, *args, **options):
+        variantes = [v for v in VARIANTES if brotli is not None or not v[0].startswith('br')]
+        if brotli is None:
+            self.stderr.write(self.style.WARNING('Brotli no está instalado: solo se mide gzip'))
+
+        resultado = {}
+        with tempfile.TemporaryDirectory() as directorio, override_settings(
+            METRICAS_PATH=os.path.join(directorio, 'metricas.sqlite3'),
+        ), entorno_benchmark():
+            cargar_en_django(
+                [FARMACIA], grupos_ah=options['grupos'], ids_efp=ids_grupos_efp(options['familias_efp']),
+                semilla=options['semilla'],
+            )
+            usuario = User.objects.create_user('bench_compresion', password='bench')
+            PerfilFarmacia.objects.create(user=usuario, farmacia_id=FARMACIA)
+            cliente = cliente_de_farmacia(usuario, FARMACIA)
+
+            for nombre, url in VISTAS:
+                cliente.get(url)  # Calienta la caché: se mide el envío, no la consulta
+                resultado[nombre] = {
+                    variante: dict(zip(('bytes', 'ms'), medir_pagina(cliente, url, codificacion, minificar)))
+                    for variante, codificacion, minificar in variantes
+                }
+
+        if options['json']:
+            self.stdout.write(json.dumps(resultado, indent=2))
+            return
+
+        nombres = [v[0] for v in variantes]
+        self.stdout.write(f"{'vista':<20}" + ''.join(f"{n:>15}" for n in nombres) + f"{'ahorro':>9}")
+        for vista, medidas in resultado.items():
+            base = medidas['sin_comprimir']['bytes']
+            mejor = min(m['bytes'] for m in medidas.values())
+            self.stdout.write(
+                f"{vista:<20}" + ''.join(f"{medidas[n]['bytes'] / 1024:>12.1f} KB" for n in nombres)
+                + f"{100 * (1 - mejor / base):>8.1f}%"
+            )
+        self.stdout.write("\nTiempo de la petición (ms, caché caliente):")
+        for vista, medidas in resultado.items():
+            self.stdout.write(f"{vista:<20}" + ''.join(f"{medidas[n]['ms']:>15}" for n in nombres))
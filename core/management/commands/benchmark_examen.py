@@ -0,0 +1,94 @@
+import json
+import re
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from core.benchmarks import entorno_benchmark, resumen_tiempos, sembrar_datos
+
+FARMACIA = 'HFBENCH'
+MOTORES = ['db', 'cached_db', 'cache', 'signed_cookies']
+OPCION_RE = re.compile(r'name="opcion" value="(\d+)"')
+
+
+def _responder(cliente, url, recargar_resultado):
+    """Un ciclo completo de examen: ver pregunta, responder (y ver resultado en EFP)."""
+    html = cliente.get(url).content.decode()
+    opciones = OPCION_RE.findall(html)
+    if not opciones:
+        # Examen terminado: empezamos otro
+        cliente.get(url + '?reset=1')
+        opciones = OPCION_RE.findall(cliente.get(url).content.decode())
+    cliente.post(url, {'opcion': opciones[0]})
+    if recargar_resultado:
+        cliente.get(url)
+
+
+class Command(BaseCommand):
+    help = 'Mide respuestas/segundo del examen AH y EFP con distintos motores de sesión'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--respuestas', type=int, default=200, help='Respuestas por motor y examen')
+        parser.add_argument('--grupos', type=int, default=300, help='Grupos AH/EFP de la farmacia de prueba')
+        parser.add_argument('--json', action='store_true', help='Salida en JSON')
+
+    def handle(self, *args, **options):
+        resultados = {}
+
+        with entorno_benchmark():
+            sembrar_datos(FARMACIA, options['grupos'])
+            usuario = User.objects.create_superuser('bench', 'bench@example.com', 'bench')
+
+            for motor in MOTORES:
+                with override_settings(SESSION_ENGINE=f'django.contrib.sessions.backends.{motor}'):
+                    for nombre, url, recargar in (('ah', '/examen/', False), ('efp', '/efp/examen/', True)):
+                        cliente = Client()
+                        cliente.force_login(usuario)
+                        sesion = cliente.session
+                        sesion['farmacia_activa'] = FARMACIA
+                        sesion.save()
+                        # Con cookies firmadas la clave de sesión ES el contenido y cambia al guardar
+                        cliente.cookies[settings.SESSION_COOKIE_NAME] = sesion.session_key
+
+                        # Calentamos cachés (banco de preguntas) fuera de la medida
+                        _responder(cliente, url, recargar)
+
+                        tiempos = []
+                        with CaptureQueriesContext(connection) as consultas:
+                            for _ in range(options['respuestas']):
+                                inicio = time.perf_counter()
+                                _responder(cliente, url, recargar)
+                                tiempos.append(time.perf_counter() - inicio)
+
+                        escrituras = [
+                            q for q in consultas.captured_queries
+                            if 'django_session' in q['sql'] and q['sql'].lstrip().startswith(('INSERT', 'UPDATE', 'DELETE'))
+                        ]
+                        r = resumen_tiempos(tiempos)
+                        r['consultas_por_respuesta'] = round(len(consultas) / len(tiempos), 2)
+                        r['escrituras_sesion_por_respuesta'] = round(len(escrituras) / len(tiempos), 2)
+                        r['bytes_cookie'] = len(cliente.cookies[settings.SESSION_COOKIE_NAME].value)
+                        resultados.setdefault(motor, {})[nombre] = r
+
+        if options['json']:
+            self.stdout.write(json.dumps(resultados, indent=2))
+            return
+
+        self.stdout.write(
+            f"{'motor':<16} {'examen':<6} {'resp/s':>8} {'p95 ms':>8} {'consultas':>10} {'escr. sesión':>13} {'cookie B':>9}"
+        )
+        for motor, por_examen in resultados.items():
+            for nombre, r in por_examen.items():
+                self.stdout.write(
+                    f"{motor:<16} {nombre:<6} {r['ops_s']:>8} {r['p95_ms']:>8} "
+                    f"{r['consultas_por_respuesta']:>10} {r['escrituras_sesion_por_respuesta']:>13} {r['bytes_cookie']:>9}"
+                )
+        self.stdout.write(
+            f"\nMotor en uso (SESSION_BACKEND): {settings.SESSION_ENGINE.rsplit('.', 1)[-1]}. "
+            "Solo signed_cookies evita escribir la sesión en BD en cada respuesta."
+        )
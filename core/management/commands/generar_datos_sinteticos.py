@@ -0,0 +1,79 @@
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core import warehouse_local
+from core.datos_sinteticos import cargar_en_django, ids_farmacias, ids_grupos_efp
+
+
+class Command(BaseCommand):
+    help = 'Genera datos sintéticos a escala (BD de Django y fixtures del warehouse local)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--farmacias', type=int, default=10, help='Número de farmacias (desde HF280050001)')
+        parser.add_argument('--grupos', type=int, default=200, help='Agrupaciones homogéneas por farmacia')
+        parser.add_argument('--competidores', type=int, default=4, help='Competidores por grupo')
+        parser.add_argument('--familias-efp', type=int, default=14, help='Superfamilias EFP (1-14)')
+        parser.add_argument('--preferencias', type=float, default=0.2, help='Fracción de grupos con preferencia')
+        parser.add_argument('--ventas', type=int, default=8, help='Filas de dispensación medias por farmacia y artículo')
+        parser.add_argument('--semilla', type=int, default=0)
+        parser.add_argument('--fixtures', help='Carpeta donde escribir las tablas del warehouse (.csv.gz)')
+        parser.add_argument('--warehouse', action='store_true',
+                            help='Recrear WAREHOUSE_LOCAL_PATH con las tablas generadas')
+        parser.add_argument('--desde-fixtures', help='Solo recrear el warehouse local a partir de esta carpeta')
+        parser.add_argument('--sin-django', action='store_true', help='No tocar la base de datos de Django')
+        parser.add_argument('--conservar', action='store_true',
+                            help='No borrar antes los datos existentes de esas farmacias')
+
+    def handle(self, *args, **options):
+        if options['desde_fixtures']:
+            self._importar(options['desde_fixtures'])
+            return
+        if options['sin_django'] and not (options['fixtures'] or options['warehouse']):
+            raise CommandError('Con --sin-django indica --fixtures y/o --warehouse')
+
+        farmacias = ids_farmacias(options['farmacias'])
+        ids_efp = ids_grupos_efp(options['familias_efp'])
+
+        if not options['sin_django']:
+            inicio = time.perf_counter()
+            totales = cargar_en_django(
+                farmacias, grupos_ah=options['grupos'], ids_efp=ids_efp, competidores=options['competidores'],
+                fraccion_preferencias=options['preferencias'], semilla=options['semilla'],
+                borrar=not options['conservar'],
+            )
+            self.stdout.write(
+                f"Django: {len(farmacias)} farmacias, {totales['ah']} AH, {totales['efp']} EFP, "
+                f"{totales['preferencias'] + totales['preferencias_efp']} preferencias "
+                f"en {time.perf_counter() - inicio:.1f} s"
+            )
+
+        if options['fixtures'] or options['warehouse']:
+            with tempfile.TemporaryDirectory() as temporal:
+                directorio = options['fixtures'] or temporal
+                inicio = time.perf_counter()
+                tablas = warehouse_local.generar_tablas(
+                    farmacias, grupos_ah=options['grupos'], ids_efp=ids_efp, competidores=options['competidores'],
+                    ventas_por_articulo=options['ventas'], semilla=options['semilla'],
+                )
+                escritas = warehouse_local.exportar_fixtures(tablas, directorio)
+                self.stdout.write(
+                    f"Fixtures: {escritas['bridge_dispensacion']} dispensaciones, "
+                    f"{escritas['pip_medicamentos_financiados'] + escritas['map_idArticu_idEfp']} artículos "
+                    f"en {time.perf_counter() - inicio:.1f} s"
+                    + (f" -> {os.path.abspath(directorio)}" if options['fixtures'] else '')
+                )
+                if options['warehouse']:
+                    self._importar(directorio)
+
+        self.stdout.write(self.style.SUCCESS('Datos sintéticos generados.'))
+
+    def _importar(self, directorio):
+        inicio = time.perf_counter()
+        warehouse_local.importar_fixtures(directorio)
+        self.stdout.write(
+            f"Warehouse local recreado en {settings.WAREHOUSE_LOCAL_PATH} ({time.perf_counter() - inicio:.1f} s)"
+        )
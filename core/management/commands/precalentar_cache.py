@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core.models import Oportunidad
+from core.services import precalentar_cache
+from efp.models import OportunidadEFP
+
+
+def _precalentar(farmacia_id):
+    """Precalienta una farmacia y cierra la conexión a BD propia del hilo."""
+    try:
+        return precalentar_cache(farmacia_id)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Precalienta la caché (dashboard, familias EFP, bancos de preguntas y listados) de las farmacias'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--farmacia', action='append', help='Farmacia a precalentar (se puede repetir). Por defecto, todas')
+        parser.add_argument('--hilos', type=int, default=4, help='Farmacias que se precalientan en paralelo')
+
+    def handle(self, *args, **options):
+        if settings.CACHE_BACKEND == 'locmem':
+            self.stdout.write(self.style.WARNING(
+                'CACHE_BACKEND=locmem: la caché vive en este proceso y se perderá al terminar. '
+                'Usa CACHE_BACKEND=sqlite para que la aprovechen los workers del servidor.'
+            ))
+
+        farmacias = options['farmacia']
+        if not farmacias:
+            farmacias = sorted(
+                set(Oportunidad.objects.values_list('farmacia_id', flat=True).distinct())
+                | set(OportunidadEFP.objects.values_list('farmacia_id', flat=True).distinct())
+            )
+
+        if not farmacias:
+            self.stdout.write('No hay farmacias con datos.')
+            return
+
+        errores = 0
+        with ThreadPoolExecutor(max_workers=max(options['hilos'], 1)) as ejecutor:
+            futuros = {ejecutor.submit(_precalentar, f): f for f in farmacias}
+            for futuro in as_completed(futuros):
+                farmacia = futuros[futuro]
+                try:
+                    segundos = futuro.result()
+                    self.stdout.write(f'{farmacia}: {segundos:.2f}s')
+                except Exception as e:
+                    errores += 1
+                    self.stderr.write(f'{farmacia}: error {e}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Precalentadas {len(farmacias) - errores} de {len(farmacias)} farmacias'
+        ))
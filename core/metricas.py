@@ -0,0 +1,362 @@
+# core/metricas.py
+"""
+Registro de métricas (contadores e histogramas) en formato Prometheus.
+
+Pensado para varios workers de gunicorn sin ningún servicio externo: cada
+proceso acumula en memoria y vuelca como mucho cada METRICAS_VOLCADO_S
+segundos a un fichero SQLite compartido (suma atómica con UPSERT). El
+endpoint /metricas/ vuelca lo pendiente del propio proceso y lee el total
+de todos. Se pierden como mucho los últimos segundos de un worker que muera
+sin salir limpiamente. Dentro de un bucle asyncio (vistas y middlewares
+bajo ASGI) el volcado va a un hilo aparte para no bloquear el bucle con E/S
+de SQLite.
+
+Uso:
+    EXAMEN_RESPUESTAS.inc(examen='ah', resultado='acierto')
+    with PETICION_DURACION.medir(vista='dashboard', metodo='GET'):
+        ...
+
+Con METRICAS=False (por defecto) no se acumula nada: ni se crea el fichero
+ni se lanza el hilo de volcado, y /metricas/ da 404.
+"""
+import asyncio
+import atexit
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS muestra (
+    metrica TEXT NOT NULL,
+    etiquetas TEXT NOT NULL,
+    sufijo TEXT NOT NULL,
+    valor REAL NOT NULL,
+    PRIMARY KEY (metrica, etiquetas, sufijo)
+);
+"""
+
+# Cubetas por defecto (segundos): de 5 ms a 60 s
+CUBETAS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRO = {}
+
+_pendiente = defaultdict(float)
+_cerrojo = threading.Lock()
+_ultimo_volcado = time.monotonic()
+_local = threading.local()
+# Un solo hilo: los volcados lanzados desde el bucle asyncio no se solapan
+_hilo_volcado = ThreadPoolExecutor(max_workers=1, thread_name_prefix='metricas')
+_volcado_en_curso = threading.Event()
+
+
+# --- ALMACÉN COMPARTIDO ---
+
+def _conexion():
+    """Conexión por hilo y por proceso al fichero de métricas (como core/cache_backends.py)."""
+    conn = getattr(_local, 'conn', None)
+    ruta = str(settings.METRICAS_PATH)
+    if conn is None or _local.pid != os.getpid() or _local.ruta != ruta:
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        conn = sqlite3.connect(ruta, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_ESQUEMA)
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.ruta = ruta
+    return conn
+
+
+def volcar(forzar=False):
+    """
+    Suma lo acumulado en este proceso al fichero compartido.
+
+    Args:
+        forzar (bool): Volcar aunque no haya pasado METRICAS_VOLCADO_S
+    """
+    global _ultimo_volcado
+    ahora = time.monotonic()
+    if not forzar and ahora - _ultimo_volcado < settings.METRICAS_VOLCADO_S:
+        return
+    with _cerrojo:
+        if not _pendiente:
+            _ultimo_volcado = ahora
+            return
+        filas = [(m, e, s, v) for (m, e, s), v in _pendiente.items()]
+        _pendiente.clear()
+        _ultimo_volcado = ahora
+    conn = None
+    try:
+        conn = _conexion()
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(
+            'INSERT INTO muestra (metrica, etiquetas, sufijo, valor) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (metrica, etiquetas, sufijo) DO UPDATE SET valor = valor + excluded.valor',
+            filas,
+        )
+        conn.execute('COMMIT')
+    except sqlite3.Error:
+        # Fichero bloqueado u ocupado: lo devolvemos al acumulador y se reintenta en el siguiente volcado
+        if conn is not None and conn.in_transaction:
+            conn.execute('ROLLBACK')
+        with _cerrojo:
+            for m, e, s, v in filas:
+                _pendiente[(m, e, s)] += v
+
+
+atexit.register(volcar, forzar=True)
+
+
+def _volcar_en_hilo():
+    try:
+        volcar()
+    finally:
+        _volcado_en_curso.clear()
+
+
+def volcar_si_toca():
+    """
+    Vuelca si ha pasado METRICAS_VOLCADO_S desde el último volcado.
+
+    Llamado desde un bucle asyncio no escribe en el momento: encarga el
+    volcado al hilo de métricas (uno a la vez) y vuelve enseguida.
+    """
+    if time.monotonic() - _ultimo_volcado < settings.METRICAS_VOLCADO_S:
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        volcar()
+        return
+    if not _volcado_en_curso.is_set():
+        _volcado_en_curso.set()
+        _hilo_volcado.submit(_volcar_en_hilo)
+
+
+def _sumar(metrica, etiquetas, sufijo, valor):
+    if not settings.METRICAS:
+        return
+    with _cerrojo:
+        _pendiente[(metrica, etiquetas, sufijo)] += valor
+    volcar_si_toca()
+
+
+# --- TIPOS DE MÉTRICA ---
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        REGISTRO[nombre] = self
+
+    def _clave(self, valores):
+        if set(valores) != set(self.etiquetas):
+            raise ValueError(f"{self.nombre} espera las etiquetas {self.etiquetas}, no {tuple(valores)}")
+        return json.dumps([[e, str(valores[e])] for e in self.etiquetas])
+
+
+class Contador(_Metrica):
+    """Valor que solo crece (peticiones, filas, errores...)."""
+
+    tipo = 'counter'
+
+    def inc(self, valor=1, **etiquetas):
+        _sumar(self.nombre, self._clave(etiquetas), '', valor)
+
+
+class Histograma(_Metrica):
+    """Distribución de valores en cubetas acumuladas, más suma y número de observaciones."""
+
+    tipo = 'histogram'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), cubetas=CUBETAS_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.cubetas = tuple(sorted(cubetas)) + (math.inf,)
+
+    def observar(self, valor, **etiquetas):
+        clave = self._clave(etiquetas)
+        if not settings.METRICAS:
+            return
+        with _cerrojo:
+            for limite in self.cubetas:
+                if valor <= limite:
+                    _pendiente[(self.nombre, clave, f'le={_formatear(limite)}')] += 1
+            _pendiente[(self.nombre, clave, 'sum')] += valor
+            _pendiente[(self.nombre, clave, 'count')] += 1
+        volcar_si_toca()
+
+    @contextmanager
+    def medir(self, **etiquetas):
+        """Observa la duración en segundos del bloque (también si lanza una excepción)."""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, **etiquetas)
+
+
+# --- MÉTRICAS DE LA APLICACIÓN ---
+
+SYNC_DURACION = Histograma(
+    'farma_sync_duracion_segundos', 'Duración de cada fase de la sincronización desde Databricks (ok/error)',
+    etiquetas=('origen', 'fase', 'farmacia', 'estado'),
+    cubetas=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+SYNC_FILAS_LEIDAS = Contador(
+    'farma_sync_filas_leidas_total', 'Filas leídas del warehouse', etiquetas=('origen', 'farmacia'),
+)
+SYNC_FILAS_ESCRITAS = Contador(
+    'farma_sync_filas_escritas_total', 'Filas escritas en la base de datos local', etiquetas=('origen', 'farmacia'),
+)
+SYNC_ERRORES = Contador(
+    'farma_sync_errores_total', 'Sincronizaciones terminadas con error', etiquetas=('origen', 'farmacia'),
+)
+CACHE_ACCESOS = Contador(
+    'farma_cache_accesos_total', 'Accesos a la caché por farmacia (acierto/fallo)', etiquetas=('vista', 'resultado'),
+)
+PETICION_DURACION = Histograma(
+    'farma_peticion_duracion_segundos', 'Latencia de las peticiones HTTP por vista',
+    etiquetas=('vista', 'metodo'),
+)
+EXAMEN_RESPUESTAS = Contador(
+    'farma_examen_respuestas_total', 'Respuestas de examen servidas', etiquetas=('examen', 'resultado'),
+)
+
+
+def registrar_sync(origen, farmacia_id, fases=None, filas_leidas=0, filas_escritas=0, error=None):
+    """
+    Anota una sincronización terminada, también si ha fallado.
+
+    Las duraciones van siempre al histograma con la etiqueta `estado`
+    ('ok' o 'error'), para ver también cuánto tardan las que fallan.
+
+    Args:
+        origen (str): 'ah' o 'efp'
+        farmacia_id (str): ID de la farmacia
+        fases (dict): {fase: segundos}; el total se calcula sumándolas
+        filas_leidas (int): Filas devueltas por el warehouse
+        filas_escritas (int): Filas guardadas en la base de datos local
+        error (str, optional): Mensaje si la sincronización falló
+    """
+    estado = 'error' if error else 'ok'
+    fases = fases or {}
+    try:
+        if error:
+            SYNC_ERRORES.inc(origen=origen, farmacia=farmacia_id)
+        else:
+            SYNC_FILAS_LEIDAS.inc(filas_leidas, origen=origen, farmacia=farmacia_id)
+            SYNC_FILAS_ESCRITAS.inc(filas_escritas, origen=origen, farmacia=farmacia_id)
+    finally:
+        for fase, segundos in fases.items():
+            SYNC_DURACION.observar(segundos, origen=origen, fase=fase, farmacia=farmacia_id, estado=estado)
+        SYNC_DURACION.observar(sum(fases.values()), origen=origen, fase='total', farmacia=farmacia_id, estado=estado)
+
+
+# --- EXPOSICIÓN ---
+
+def _formatear(valor):
+    if valor == math.inf:
+        return '+Inf'
+    valor = float(valor)
+    return str(int(valor)) if valor.is_integer() else repr(valor)
+
+
+def _escapar(valor):
+    return valor.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _etiquetas_texto(pares):
+    if not pares:
+        return ''
+    return '{' + ','.join(f'{e}="{_escapar(v)}"' for e, v in pares) + '}'
+
+
+def exponer():
+    """
+    Texto de todas las métricas (de todos los procesos) en formato Prometheus 0.0.4.
+
+    Returns:
+        str: Cuerpo para la respuesta de /metricas/
+    """
+    volcar(forzar=True)
+    filas = _conexion().execute('SELECT metrica, etiquetas, sufijo, valor FROM muestra').fetchall()
+    # {metrica: {etiquetas (JSON): {sufijo: valor}}}
+    series = defaultdict(lambda: defaultdict(dict))
+    for metrica, etiquetas, sufijo, valor in filas:
+        series[metrica][etiquetas][sufijo] = valor
+
+    lineas = []
+    for nombre, metrica in sorted(REGISTRO.items()):
+        lineas.append(f'# HELP {nombre} {metrica.ayuda}')
+        lineas.append(f'# TYPE {nombre} {metrica.tipo}')
+        for etiquetas, valores in sorted(series[nombre].items()):
+            pares = json.loads(etiquetas)
+            if metrica.tipo == 'counter':
+                lineas.append(f'{nombre}{_etiquetas_texto(pares)} {_formatear(valores[""])}')
+                continue
+            # Todas las cubetas en orden creciente, también las vacías, y después _sum y _count
+            for limite in metrica.cubetas:
+                le = _formatear(limite)
+                lineas.append(
+                    f'{nombre}_bucket{_etiquetas_texto(pares + [["le", le]])} {_formatear(valores.get(f"le={le}", 0))}'
+                )
+            lineas.append(f'{nombre}_sum{_etiquetas_texto(pares)} {_formatear(valores["sum"])}')
+            lineas.append(f'{nombre}_count{_etiquetas_texto(pares)} {_formatear(valores["count"])}')
+    return '\n'.join(lineas) + '\n'
+
+
+def reiniciar():
+    """Borra todas las métricas acumuladas (útil en tests y tras un despliegue)."""
+    with _cerrojo:
+        _pendiente.clear()
+    _conexion().execute('DELETE FROM muestra')
+
+
+class MetricasMiddleware:
+    """Observa la latencia de cada petición por vista (METRICAS=False lo desactiva)."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        inicio = time.perf_counter()
+        response = self.get_response(request)
+        self._observar(request, inicio)
+        return response
+
+    async def __acall__(self, request):
+        inicio = time.perf_counter()
+        response = await self.get_response(request)
+        self._observar(request, inicio)
+        return response
+
+    def _observar(self, request, inicio):
+        coincidencia = getattr(request, 'resolver_match', None)
+        if coincidencia and coincidencia.view_name != 'metricas':
+            PETICION_DURACION.observar(
+                time.perf_counter() - inicio, vista=coincidencia.view_name, metodo=request.method,
+            )
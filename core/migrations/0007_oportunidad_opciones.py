@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-19 17:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_alter_oportunidad_options_preferencia_farmacia_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oportunidad',
+            name='opciones',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.9 on 2026-10-19 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_oportunidad_opciones'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='preferencia',
+            name='core_prefer_farmaci_96edee_idx',
+        ),
+        migrations.AddIndex(
+            model_name='oportunidad',
+            index=models.Index(fields=['farmacia_id', 'grupo_homogeneo'], name='core_oportu_farmaci_2a164d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='preferencia',
+            index=models.Index(fields=['farmacia_id', 'grupo_homogeneo', 'activo'], name='core_prefer_farmaci_aba67f_idx'),
+        ),
+    ]
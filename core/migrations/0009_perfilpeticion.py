@@ -0,0 +1,43 @@
+# Generated by Django 5.2.9 on 2026-10-19 17:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_remove_preferencia_core_prefer_farmaci_96edee_idx_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PerfilPeticion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('creado', models.DateTimeField(auto_now_add=True)),
+                ('farmacia_id', models.CharField(blank=True, max_length=50)),
+                ('metodo', models.CharField(max_length=10)),
+                ('ruta', models.CharField(max_length=500)),
+                ('vista', models.CharField(blank=True, max_length=100)),
+                ('estado', models.PositiveSmallIntegerField(default=0)),
+                ('modo', models.CharField(choices=[('muestreo', 'Muestreo de pilas'), ('determinista', 'Determinista (cProfile)')], max_length=20)),
+                ('aleatorio', models.BooleanField(default=False, help_text='Capturado por el muestreo aleatorio de tráfico')),
+                ('duracion_ms', models.FloatField()),
+                ('num_consultas', models.PositiveIntegerField(default=0)),
+                ('bd_ms', models.FloatField(default=0)),
+                ('funciones', models.JSONField(default=list)),
+                ('consultas', models.JSONField(default=list)),
+                ('pilas', models.TextField(blank=True)),
+                ('pstats', models.BinaryField(blank=True, null=True)),
+                ('usuario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'perfil de petición',
+                'verbose_name_plural': 'perfiles de petición',
+                'ordering': ['-creado'],
+            },
+        ),
+    ]
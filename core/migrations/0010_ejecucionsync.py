@@ -0,0 +1,43 @@
+# Generated by Django 5.2.9 on 2026-10-19 17:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_perfilpeticion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EjecucionSync',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('farmacia_id', models.CharField(max_length=50)),
+                ('segmento', models.CharField(choices=[('AH', 'AH'), ('EFP', 'EFP')], max_length=3)),
+                ('fecha_desde', models.DateField(blank=True, null=True)),
+                ('fecha_hasta', models.DateField(blank=True, null=True)),
+                ('inicio', models.DateTimeField()),
+                ('fin', models.DateTimeField(blank=True, null=True)),
+                ('conexion_s', models.FloatField(default=0)),
+                ('ejecucion_s', models.FloatField(default=0)),
+                ('descarga_s', models.FloatField(default=0)),
+                ('transformacion_s', models.FloatField(default=0)),
+                ('escritura_s', models.FloatField(default=0)),
+                ('total_s', models.FloatField(default=0)),
+                ('filas_leidas', models.PositiveIntegerField(default=0)),
+                ('filas_escritas', models.PositiveIntegerField(default=0)),
+                ('bytes_resultado', models.PositiveBigIntegerField(default=0, help_text='Tamaño aproximado del resultado (texto)')),
+                ('id_consulta', models.CharField(blank=True, help_text='Query ID en el warehouse', max_length=100)),
+                ('error_tipo', models.CharField(blank=True, max_length=100)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name': 'ejecución de sincronización',
+                'verbose_name_plural': 'ejecuciones de sincronización',
+                'ordering': ['-inicio'],
+                'indexes': [models.Index(fields=['farmacia_id', 'segmento', 'inicio'], name='core_ejecuc_farmaci_3432f1_idx')],
+            },
+        ),
+    ]
@@ -18,8 +18,30 @@ class CompetidoresStatsMixin:
     - margen_pct: DecimalField con el margen porcentual
     - penetracion_pct: DecimalField (solo para Oportunidad de AH)
     - codigo_nacional: CharField con el CN del producto recomendado
+    - opciones: JSONField con la lista de productos elegibles (precalculada)
     """
     
+    def calcular_opciones(self):
+        """
+        Lista de productos elegibles como preferencia para el grupo.
+        
+        Se calcula al sincronizar y se guarda en el campo `opciones`, así la
+        configuración no tiene que parsear `a_sustituir` en cada petición.
+        
+        Returns:
+            list: Recomendado + competidores, sin duplicados y ordenados
+        """
+        opciones = [self.producto_recomendado]
+        for c in self.get_competidores_stats():
+            # Evitamos duplicados si el recomendado sale en la lista
+            if c['nombre'] not in opciones:
+                opciones.append(c['nombre'])
+        return sorted(opciones)
+    
+    def get_opciones(self):
+        """Opciones precalculadas o, si la fila es anterior a ese campo, calculadas al vuelo."""
+        return getattr(self, 'opciones', None) or self.calcular_opciones()
+    
     def get_competidores_stats(self):
         """
         Parsea el campo a_sustituir y devuelve estadísticas calculadas.
@@ -23,11 +23,17 @@ class Oportunidad(CompetidoresStatsMixin, models.Model):
     ahorro_potencial = models.DecimalField(max_digits=10, decimal_places=2)
     codigo_nacional = models.CharField(max_length=20, blank=True, null=True, help_text="CN del producto recomendado")
     farmacia_id = models.CharField(max_length=50, default='HF280050001')
+    # Productos elegibles como preferencia (se calcula al sincronizar)
+    opciones = models.JSONField(default=list, blank=True)
 
     class Meta:
         ordering = ['-ahorro_potencial']
+        # Sin unique_together: grupo_homogeneo es el principio activo y puede
+        # repetirse en una farmacia (varias agrupaciones con el mismo principio)
         indexes = [
             models.Index(fields=['farmacia_id', 'ahorro_potencial']),
+            # configuracion: grupos de la farmacia ordenados por nombre
+            models.Index(fields=['farmacia_id', 'grupo_homogeneo']),
         ]
 
     def __str__(self):
@@ -44,8 +50,94 @@ class Preferencia(models.Model):
     class Meta:
         unique_together = ('grupo_homogeneo', 'farmacia_id')
         indexes = [
-            models.Index(fields=['farmacia_id', 'activo']),
+            # Búsqueda por farmacia + grupo(s) con el filtro de activo resuelto en el índice
+            models.Index(fields=['farmacia_id', 'grupo_homogeneo', 'activo']),
         ]
 
     def __str__(self):
-        return f"{self.grupo_homogeneo} -> {self.laboratorio_preferente}"
\ No newline at end of file
+        return f"{self.grupo_homogeneo} -> {self.laboratorio_preferente}"
+
+
+class PerfilPeticion(models.Model):
+    """Perfil de rendimiento de una petición (ver core/perfilador.py)."""
+
+    MODOS = [
+        ('muestreo', 'Muestreo de pilas'),
+        ('determinista', 'Determinista (cProfile)'),
+    ]
+
+    creado = models.DateTimeField(auto_now_add=True)
+    usuario = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
+    farmacia_id = models.CharField(max_length=50, blank=True)
+    metodo = models.CharField(max_length=10)
+    ruta = models.CharField(max_length=500)
+    vista = models.CharField(max_length=100, blank=True)
+    estado = models.PositiveSmallIntegerField(default=0)
+    modo = models.CharField(max_length=20, choices=MODOS)
+    aleatorio = models.BooleanField(default=False, help_text="Capturado por el muestreo aleatorio de tráfico")
+    duracion_ms = models.FloatField()
+    num_consultas = models.PositiveIntegerField(default=0)
+    bd_ms = models.FloatField(default=0)
+    # [{'funcion', 'propio_ms', 'total_ms', 'llamadas'}] ordenadas por total
+    funciones = models.JSONField(default=list)
+    # [{'sql', 'ms'}] en orden de ejecución
+    consultas = models.JSONField(default=list)
+    # Pilas colapsadas ("a;b;c N"), listas para flamegraph.pl o speedscope
+    pilas = models.TextField(blank=True)
+    # Volcado de cProfile (mismo formato que pstats.dump_stats / snakeviz)
+    pstats = models.BinaryField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-creado']
+        verbose_name = 'perfil de petición'
+        verbose_name_plural = 'perfiles de petición'
+
+    def __str__(self):
+        return f"{self.metodo} {self.ruta} ({self.duracion_ms:.0f} ms)"
+
+
+class EjecucionSync(models.Model):
+    """Histórico de sincronizaciones desde Databricks, con el tiempo de cada fase."""
+
+    SEGMENTOS = [('AH', 'AH'), ('EFP', 'EFP')]
+    # Fases en orden; cada una tiene su campo `<fase>_s`
+    FASES = ('conexion', 'ejecucion', 'descarga', 'transformacion', 'escritura')
+
+    farmacia_id = models.CharField(max_length=50)
+    segmento = models.CharField(max_length=3, choices=SEGMENTOS)
+    fecha_desde = models.DateField(null=True, blank=True)
+    fecha_hasta = models.DateField(null=True, blank=True)
+    inicio = models.DateTimeField()
+    fin = models.DateTimeField(null=True, blank=True)
+
+    # Segundos por fase: abrir conexión, ejecutar la consulta, descargar filas,
+    # convertirlas a modelos y escribirlas en la base de datos local
+    conexion_s = models.FloatField(default=0)
+    ejecucion_s = models.FloatField(default=0)
+    descarga_s = models.FloatField(default=0)
+    transformacion_s = models.FloatField(default=0)
+    escritura_s = models.FloatField(default=0)
+    total_s = models.FloatField(default=0)
+
+    filas_leidas = models.PositiveIntegerField(default=0)
+    filas_escritas = models.PositiveIntegerField(default=0)
+    bytes_resultado = models.PositiveBigIntegerField(default=0, help_text="Tamaño aproximado del resultado (texto)")
+    id_consulta = models.CharField(max_length=100, blank=True, help_text="Query ID en el warehouse")
+
+    error_tipo = models.CharField(max_length=100, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-inicio']
+        indexes = [
+            models.Index(fields=['farmacia_id', 'segmento', 'inicio']),
+        ]
+        verbose_name = 'ejecución de sincronización'
+        verbose_name_plural = 'ejecuciones de sincronización'
+
+    def __str__(self):
+        return f"{self.segmento} {self.farmacia_id} {self.inicio:%Y-%m-%d %H:%M}"
+
+    @property
+    def correcta(self):
+        return not self.error_tipo
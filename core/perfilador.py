@@ -0,0 +1,223 @@
+# core/perfilador.py
+"""
+Perfilado bajo demanda de peticiones concretas.
+
+Un usuario staff puede perfilar cualquier petición añadiendo `?_perfil=1`
+(o la cabecera `X-Perfil: 1`). Hay dos modos:
+
+    - muestreo (por defecto): un hilo lee la pila del hilo de la petición
+      cada PERFIL_INTERVALO_MS. Coste bajo y constante; da pilas colapsadas
+      para un flamegraph y el tiempo aproximado por función.
+    - determinista (`?_perfil=cprofile`): cProfile mide todas las llamadas.
+      Exacto pero ralentiza la petición; el volcado se abre con snakeviz.
+
+Además, PERFIL_FRACCION_ALEATORIA (0.0-1.0) perfila por muestreo esa
+fracción del tráfico real, para cazar páginas lentas que no se reproducen
+en local. El resultado (funciones principales, SQL con duraciones y pilas)
+se guarda en `PerfilPeticion` y se descarga desde el admin.
+"""
+import cProfile
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+from .models import PerfilPeticion
+
+# Funciones que se guardan en el resumen de cada perfil
+TOP_FUNCIONES = 40
+
+
+def _ruta_corta(ruta):
+    """Ruta relativa al proyecto o a site-packages, para que las etiquetas sean legibles."""
+    for base in (str(settings.BASE_DIR), *sys.path):
+        if base and ruta.startswith(base):
+            return os.path.relpath(ruta, base)
+    return ruta
+
+
+def _etiqueta(code):
+    """Nombre legible de una función: `funcion (ruta/corta.py:línea)`."""
+    return f"{code.co_name} ({_ruta_corta(code.co_filename)}:{code.co_firstlineno})"
+
+
+class MuestreadorPilas:
+    """
+    Muestrea la pila de un hilo a intervalos fijos desde otro hilo.
+
+    Usa `sys._current_frames()`, así que no instrumenta ninguna llamada: el
+    hilo perfilado corre a velocidad normal salvo por el GIL que toma el
+    muestreador en cada lectura.
+    """
+
+    def __init__(self, id_hilo, intervalo):
+        self.id_hilo = id_hilo
+        self.intervalo = intervalo
+        self.pilas = Counter()
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._bucle, name='perfilador', daemon=True)
+
+    def __enter__(self):
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        self._hilo.join()
+
+    def _bucle(self):
+        while not self._parar.wait(self.intervalo):
+            frame = sys._current_frames().get(self.id_hilo)
+            pila = []
+            while frame is not None:
+                pila.append(_etiqueta(frame.f_code))
+                frame = frame.f_back
+            if pila:
+                self.pilas[tuple(reversed(pila))] += 1
+
+    def colapsadas(self):
+        """Pilas en formato colapsado (una línea "raíz;...;hoja muestras")."""
+        return '\n'.join(f"{';'.join(pila)} {n}" for pila, n in self.pilas.most_common())
+
+    def funciones(self):
+        """Tiempo propio (en la hoja) y total (en cualquier punto de la pila) por función."""
+        propio, total = Counter(), Counter()
+        for pila, n in self.pilas.items():
+            propio[pila[-1]] += n
+            for funcion in set(pila):
+                total[funcion] += n
+        ms = self.intervalo * 1000
+        return [
+            {'funcion': f, 'propio_ms': round(propio[f] * ms, 1), 'total_ms': round(n * ms, 1), 'llamadas': None}
+            for f, n in total.most_common(TOP_FUNCIONES)
+        ]
+
+
+def _funciones_cprofile(perfil):
+    estadisticas = pstats.Stats(perfil)
+    filas = []
+    for (ruta, linea, nombre), (_, llamadas, propio, total, _) in estadisticas.stats.items():
+        filas.append({
+            'funcion': f"{nombre} ({_ruta_corta(ruta)}:{linea})",
+            'propio_ms': round(propio * 1000, 2),
+            'total_ms': round(total * 1000, 2),
+            'llamadas': llamadas,
+        })
+    return sorted(filas, key=lambda f: f['total_ms'], reverse=True)[:TOP_FUNCIONES]
+
+
+class _CapturaSQL:
+    """execute_wrapper que guarda cada consulta con su duración."""
+
+    def __init__(self):
+        self.consultas = []
+
+    def __call__(self, execute, sql, params, many, context):
+        inicio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if len(self.consultas) < settings.PERFIL_MAX_CONSULTAS:
+                self.consultas.append({'sql': sql, 'ms': round((time.perf_counter() - inicio) * 1000, 3)})
+
+
+def _modo_solicitado(request):
+    """'muestreo', 'determinista' o None según el parámetro/cabecera del staff."""
+    valor = request.GET.get('_perfil') or request.headers.get('X-Perfil')
+    if not valor or not request.user.is_staff:
+        return None
+    return 'determinista' if valor in ('cprofile', 'determinista') else 'muestreo'
+
+
+def _recortar_historico():
+    """Borra los perfiles más antiguos por encima de PERFIL_MAX_GUARDADOS."""
+    corte = (
+        PerfilPeticion.objects.order_by('-id')
+        .values_list('id', flat=True)[settings.PERFIL_MAX_GUARDADOS:settings.PERFIL_MAX_GUARDADOS + 1]
+    )
+    if corte:
+        PerfilPeticion.objects.filter(id__lte=corte[0]).delete()
+
+
+class PerfiladorMiddleware:
+    """
+    Perfila la petición si lo pide un usuario staff o si cae en la fracción aleatoria.
+
+    Va después de AuthenticationMiddleware (necesita `request.user`). Si la
+    petición no se perfila, el coste es una consulta al diccionario GET y,
+    con muestreo aleatorio activo, un `random.random()`.
+
+    Las peticiones asíncronas (servidor ASGI) no se perfilan: el muestreador y
+    cProfile siguen a un hilo, y en el bucle de eventos se mezclarían varias
+    peticiones a la vez.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.get_response(request)
+        modo = _modo_solicitado(request)
+        aleatorio = False
+        if modo is None and settings.PERFIL_FRACCION_ALEATORIA and random.random() < settings.PERFIL_FRACCION_ALEATORIA:
+            modo, aleatorio = 'muestreo', True
+        if modo is None:
+            return self.get_response(request)
+
+        captura = _CapturaSQL()
+        with connections['default'].execute_wrapper(captura):
+            inicio = time.perf_counter()
+            if modo == 'determinista':
+                perfil = cProfile.Profile()
+                perfil.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    perfil.disable()
+            else:
+                with MuestreadorPilas(threading.get_ident(), settings.PERFIL_INTERVALO_MS / 1000) as muestreador:
+                    response = self.get_response(request)
+            duracion_ms = (time.perf_counter() - inicio) * 1000
+
+        if modo == 'determinista':
+            perfil.create_stats()
+            # El volcado antes del resumen: pstats.Stats() se queda con perfil.stats y lo vacía
+            volcado = marshal.dumps(perfil.stats)
+            datos = {'funciones': _funciones_cprofile(perfil), 'pstats': volcado}
+        else:
+            datos = {'funciones': muestreador.funciones(), 'pilas': muestreador.colapsadas()}
+
+        coincidencia = getattr(request, 'resolver_match', None)
+        registro = PerfilPeticion.objects.create(
+            usuario=request.user if request.user.is_authenticated else None,
+            farmacia_id=request.session.get('farmacia_activa', ''),
+            metodo=request.method,
+            ruta=request.get_full_path()[:500],
+            vista=coincidencia.view_name if coincidencia else '',
+            estado=response.status_code,
+            modo=modo,
+            aleatorio=aleatorio,
+            duracion_ms=round(duracion_ms, 2),
+            num_consultas=len(captura.consultas),
+            bd_ms=round(sum(c['ms'] for c in captura.consultas), 2),
+            consultas=captura.consultas,
+            **datos,
+        )
+        _recortar_historico()
+        if not aleatorio:
+            response['X-Perfil-Id'] = str(registro.pk)
+        return response
@@ -0,0 +1,241 @@
+# core/preferencias.py
+"""
+Preferencias en bloque, compartidas por AH y EFP.
+
+Guardado masivo, exportación/importación CSV y copia entre farmacias son la
+misma operación en las dos apps; solo cambian el modelo y el campo que
+identifica el grupo. Cada app describe los suyos con un `TipoPreferencia`
+(`PREFERENCIAS_AH` en core/services.py, `PREFERENCIAS_EFP` en
+efp/services.py) y llama a estas funciones.
+
+También están aquí los ayudantes de las vistas de preferencias (destino
+`next` seguro y mensajes con el resultado), para que cualquier cambio en
+ellos valga para las dos apps.
+"""
+import csv
+import io
+
+from django.contrib import messages
+from django.db import transaction
+from django.utils.http import url_has_allowed_host_and_scheme
+
+from .cache_utils import incrementar_version
+
+# Errores que se muestran como mensajes flash; el resto se resume en uno
+MAX_AVISOS = 10
+
+
+class TipoPreferencia:
+    """
+    Modelos y campos de las preferencias de una app.
+
+    Args:
+        modelo: Modelo de las preferencias (Preferencia, PreferenciaEFP)
+        modelo_oportunidad: Modelo con las opciones de cada grupo (`get_opciones()`)
+        campo_grupo (str): Campo del grupo en los dos modelos
+        clave (str): Clave del grupo en los cambios y en los errores
+        campo_producto (str): Campo del producto elegido
+        tipo_grupo (type): str o int; si no se puede convertir, el cambio es un error
+        con_activo (bool): La preferencia tiene el campo `activo`
+        columna_nombre (str): Campo de la oportunidad que se exporta como referencia (opcional)
+        etiqueta_grupo (str): Prefijo del grupo en los mensajes de error
+    """
+
+    def __init__(self, modelo, modelo_oportunidad, campo_grupo, clave, campo_producto,
+                 tipo_grupo=str, con_activo=False, columna_nombre='', etiqueta_grupo=''):
+        self.modelo = modelo
+        self.modelo_oportunidad = modelo_oportunidad
+        self.campo_grupo = campo_grupo
+        self.clave = clave
+        self.campo_producto = campo_producto
+        self.tipo_grupo = tipo_grupo
+        self.con_activo = con_activo
+        self.columna_nombre = columna_nombre
+        self.etiqueta_grupo = etiqueta_grupo
+
+    @property
+    def columnas_csv(self):
+        columnas = [self.campo_grupo]
+        if self.columna_nombre:
+            columnas.append(self.columna_nombre)
+        columnas.append(self.campo_producto)
+        if self.con_activo:
+            columnas.append('activo')
+        return columnas
+
+    def grupo(self, valor):
+        """Grupo normalizado. Lanza TypeError o ValueError si no es válido."""
+        if self.tipo_grupo is str:
+            return (valor or '').strip()
+        return self.tipo_grupo(valor)
+
+
+def guardar_masivo(tipo, farmacia_id, cambios):
+    """
+    Aplica de una vez muchas preferencias de una farmacia.
+
+    Todas las elecciones se validan contra las opciones disponibles de sus
+    grupos con una sola consulta. Las válidas se escriben en una única
+    transacción: un upsert (`bulk_create` con `update_conflicts`) para las
+    que fijan producto y un borrado en bloque para las que vuelven al
+    automático (producto vacío). Las inválidas se devuelven sin aplicar.
+
+    Args:
+        tipo (TipoPreferencia): AH o EFP
+        farmacia_id (str): ID de la farmacia
+        cambios (list): dicts {tipo.clave: grupo, 'producto': str[, 'activo': bool]}
+
+    Returns:
+        tuple: (num_aplicadas, errores) con errores como lista de dicts {tipo.clave, 'error'}
+    """
+    errores = []
+    validos = []
+    for cambio in cambios:
+        try:
+            validos.append((tipo.grupo(cambio.get(tipo.clave)), cambio))
+        except (TypeError, ValueError):
+            errores.append({tipo.clave: cambio.get(tipo.clave), 'error': 'Identificador no válido'})
+
+    opciones_por_grupo = {
+        getattr(op, tipo.campo_grupo): set(op.get_opciones())
+        for op in tipo.modelo_oportunidad.objects.filter(
+            farmacia_id=farmacia_id, **{f'{tipo.campo_grupo}__in': {g for g, _ in validos}}
+        )
+    }
+
+    # Un objeto por grupo: si un grupo se repite, gana la última elección
+    a_guardar = {}
+    a_borrar = set()
+    for grupo, cambio in validos:
+        producto = (cambio.get('producto') or '').strip()
+        if grupo not in opciones_por_grupo:
+            errores.append({tipo.clave: grupo, 'error': 'Grupo inexistente en esta farmacia'})
+            continue
+        if not producto:
+            a_borrar.add(grupo)
+            a_guardar.pop(grupo, None)
+            continue
+        if producto not in opciones_por_grupo[grupo]:
+            errores.append({tipo.clave: grupo, 'error': f'"{producto}" no es una alternativa del grupo'})
+            continue
+        campos = {'farmacia_id': farmacia_id, tipo.campo_grupo: grupo, tipo.campo_producto: producto}
+        if tipo.con_activo:
+            campos['activo'] = bool(cambio.get('activo', True))
+        a_guardar[grupo] = tipo.modelo(**campos)
+        a_borrar.discard(grupo)
+
+    if a_guardar or a_borrar:
+        with transaction.atomic():
+            if a_guardar:
+                tipo.modelo.objects.bulk_create(
+                    list(a_guardar.values()),
+                    update_conflicts=True,
+                    unique_fields=['farmacia_id', tipo.campo_grupo],
+                    update_fields=[tipo.campo_producto] + (['activo'] if tipo.con_activo else []),
+                )
+            if a_borrar:
+                tipo.modelo.objects.filter(
+                    farmacia_id=farmacia_id, **{f'{tipo.campo_grupo}__in': a_borrar}
+                ).delete()
+        incrementar_version(farmacia_id)
+
+    return len(a_guardar) + len(a_borrar), errores
+
+
+def exportar_csv(tipo, farmacia_id):
+    """
+    Exporta las preferencias de una farmacia como CSV (columnas `tipo.columnas_csv`).
+
+    La columna de nombre, si la hay, es solo una referencia para quien edite
+    el fichero; al importar se usa el campo del grupo.
+
+    Returns:
+        str: Texto del CSV
+    """
+    nombres = {}
+    if tipo.columna_nombre:
+        nombres = dict(tipo.modelo_oportunidad.objects.filter(farmacia_id=farmacia_id).values_list(
+            tipo.campo_grupo, tipo.columna_nombre
+        ))
+    salida = io.StringIO()
+    writer = csv.writer(salida)
+    writer.writerow(tipo.columnas_csv)
+    for p in tipo.modelo.objects.filter(farmacia_id=farmacia_id).order_by(tipo.campo_grupo):
+        grupo = getattr(p, tipo.campo_grupo)
+        fila = [grupo]
+        if tipo.columna_nombre:
+            fila.append(nombres.get(grupo, ''))
+        fila.append(getattr(p, tipo.campo_producto))
+        if tipo.con_activo:
+            fila.append(int(p.activo))
+        writer.writerow(fila)
+    return salida.getvalue()
+
+
+def leer_csv(tipo, contenido):
+    """
+    Convierte un CSV exportado con `exportar_csv` en cambios.
+
+    Args:
+        tipo (TipoPreferencia): AH o EFP
+        contenido (str): Texto del CSV
+
+    Returns:
+        list: dicts listos para `guardar_masivo`
+    """
+    cambios = []
+    for fila in csv.DictReader(io.StringIO(contenido)):
+        cambio = {tipo.clave: fila.get(tipo.campo_grupo, ''), 'producto': fila.get(tipo.campo_producto, '')}
+        if tipo.con_activo:
+            activo = (fila.get('activo') or '1').strip().lower()
+            cambio['activo'] = activo not in ('0', 'false', 'no', '')
+        cambios.append(cambio)
+    return cambios
+
+
+def copiar(tipo, origen, destinos):
+    """
+    Copia las preferencias de una farmacia a otras.
+
+    Cada destino valida las elecciones contra sus propias oportunidades, así
+    que los grupos o productos que no existen allí se saltan.
+
+    Args:
+        tipo (TipoPreferencia): AH o EFP
+        origen (str): Farmacia de la que se copian las preferencias
+        destinos (list): Farmacias destino
+
+    Returns:
+        dict: {destino: (num_aplicadas, errores)}
+    """
+    cambios = []
+    for p in tipo.modelo.objects.filter(farmacia_id=origen):
+        cambio = {tipo.clave: getattr(p, tipo.campo_grupo), 'producto': getattr(p, tipo.campo_producto)}
+        if tipo.con_activo:
+            cambio['activo'] = p.activo
+        cambios.append(cambio)
+    return {
+        destino: guardar_masivo(tipo, destino, cambios)
+        for destino in destinos if destino != origen
+    }
+
+
+# --- AYUDANTES DE LAS VISTAS ---
+
+def siguiente_seguro(request, por_defecto):
+    """`next` del formulario si es de este sitio; si no, `por_defecto` (evita redirecciones abiertas)."""
+    siguiente = request.POST.get('next')
+    if siguiente and url_has_allowed_host_and_scheme(
+        siguiente, allowed_hosts={request.get_host()}, require_https=request.is_secure(),
+    ):
+        return siguiente
+    return por_defecto
+
+
+def avisar_resultado(request, tipo, aplicadas, errores):
+    """Mensajes flash con el resultado de una operación masiva de preferencias."""
+    messages.success(request, f"{aplicadas} preferencias actualizadas.")
+    for e in errores[:MAX_AVISOS]:
+        messages.warning(request, f"{tipo.etiqueta_grupo}{e[tipo.clave]}: {e['error']}")
+    if len(errores) > MAX_AVISOS:
+        messages.warning(request, f"... y {len(errores) - MAX_AVISOS} errores más.")
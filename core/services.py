@@ -1,10 +1,29 @@
 import os
-from django.db import transaction
-from .models import Oportunidad
-from .db_utils import databricks_connection, bulk_create_or_update, get_farmacias_activas, parse_percentage_string, parse_currency_string
-from dotenv import load_dotenv
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Sum, Q
+from .models import Oportunidad, Preferencia
+from efp.models import OportunidadEFP
+from efp.services import (
+    resumen_dashboard_efp, facetas_familias_efp, listar_datos_brutos_efp, banco_preguntas_efp,
+    sincronizar_efp_desde_databricks,
+)
+from .db_utils import bulk_create_or_update, registrar_ejecucion_sync, ejecutar_consulta_medida, get_farmacias_activas, parse_percentage_string, parse_currency_string
+from .cache_utils import cache_por_farmacia, incrementar_version, PREFIJO
+from . import preferencias
+from .preferencias import TipoPreferencia
 
-load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+CLAVE_FARMACIAS_CLOUD = f"{PREFIJO}:farmacias_cloud"
+CLAVE_FARMACIAS_LOCALES = f"{PREFIJO}:farmacias_locales"
 
 def sincronizar_desde_databricks(farmacia_id, fecha_inicio, fecha_fin):
     """
@@ -80,32 +99,41 @@ def sincronizar_desde_databricks(farmacia_id, fecha_inicio, fecha_fin):
         ORDER BY SUM(Unidades * (Mejor_Margen_Eur - Margen_Unit_Eur)) DESC
         """
         
-        with databricks_connection() as (connection, cursor):
-            cursor.execute(query)
-            rows = cursor.fetchall()
-        
-        # Procesar y crear objetos
-        objs = []
-        for row in rows:
-            margen_clean = parse_percentage_string(row[4])
-            penet_clean = parse_percentage_string(row[5])
-            ahorro_clean = parse_currency_string(row[7])
-            cn_clean = str(row[8]) if row[8] else ""
+        with registrar_ejecucion_sync(farmacia_id, 'AH', fecha_inicio, fecha_fin) as medicion:
+            rows = ejecutar_consulta_medida(query, medicion)
+
+            with medicion.fase('transformacion'):
+                # Procesar y crear objetos
+                objs = []
+                for row in rows:
+                    margen_clean = parse_percentage_string(row[4])
+                    penet_clean = parse_percentage_string(row[5])
+                    ahorro_clean = parse_currency_string(row[7])
+                    cn_clean = str(row[8]) if row[8] else ""
             
-            objs.append(Oportunidad(
-                farmacia_id=farmacia_id,
-                grupo_homogeneo=row[0],
-                producto_recomendado=row[1],
-                pvp_medio=float(row[2]),
-                puc_medio=float(row[3]),
-                margen_pct=margen_clean,
-                penetracion_pct=penet_clean,
-                a_sustituir=row[6],
-                ahorro_potencial=ahorro_clean,
-                codigo_nacional=cn_clean
-            ))
+                    objs.append(Oportunidad(
+                        farmacia_id=farmacia_id,
+                        grupo_homogeneo=row[0],
+                        producto_recomendado=row[1],
+                        pvp_medio=float(row[2]),
+                        puc_medio=float(row[3]),
+                        margen_pct=margen_clean,
+                        penetracion_pct=penet_clean,
+                        a_sustituir=row[6],
+                        ahorro_potencial=ahorro_clean,
+                        codigo_nacional=cn_clean
+                    ))
         
-        num_created = bulk_create_or_update(Oportunidad, farmacia_id, objs)
+                # Precalculamos las opciones de preferencia de cada grupo
+                for obj in objs:
+                    obj.opciones = obj.calcular_opciones()
+
+            with medicion.fase('escritura'):
+                num_created = bulk_create_or_update(Oportunidad, farmacia_id, objs)
+                # Los datos de la farmacia han cambiado: invalidamos su caché
+                incrementar_version(farmacia_id)
+                cache.delete(CLAVE_FARMACIAS_LOCALES)
+            medicion.ejecucion.filas_escritas = num_created
         return num_created, None
 
     except Exception as e:
@@ -120,4 +148,412 @@ def obtener_farmacias_cloud():
     Returns:
         tuple: (lista_farmacias, error_message)
     """
-    return get_farmacias_activas()
\ No newline at end of file
+    return get_farmacias_activas()
+
+
+def obtener_farmacias_cloud_cacheado(refrescar=False):
+    """
+    Como `obtener_farmacias_cloud`, pero guardando la lista en la caché compartida.
+
+    Antes se guardaba en la sesión de cada usuario (una lista larga que viajaba
+    en cada petición); la lista es la misma para todos, así que vive en caché.
+    Los errores no se cachean.
+
+    Args:
+        refrescar (bool): Ir siempre a Databricks y renovar la lista cacheada
+
+    Returns:
+        tuple: (lista_farmacias, error_message)
+    """
+    lista = None if refrescar else cache.get(CLAVE_FARMACIAS_CLOUD)
+    if lista is not None:
+        return lista, None
+    lista, error = obtener_farmacias_cloud()
+    if not error:
+        cache.set(CLAVE_FARMACIAS_CLOUD, lista, settings.FARMA_CACHE_TIMEOUT)
+    return lista, error
+
+
+def farmacias_cloud_cacheadas():
+    """
+    Lista de farmacias del warehouse solo si ya está en la caché compartida.
+
+    Para páginas que no deben esperar a Databricks (dashboard de staff): si
+    falta, la pide el navegador al endpoint asíncrono `farmacias_cloud`.
+
+    Returns:
+        list | None: IDs de farmacia, o None si no está cacheada
+    """
+    return cache.get(CLAVE_FARMACIAS_CLOUD)
+
+
+def farmacias_locales():
+    """
+    IDs de las farmacias con datos AH en la base de datos local (selector de la cabecera).
+
+    El DISTINCT recorre toda la tabla de oportunidades, así que se guarda en la
+    caché compartida; la sincronización AH la invalida.
+
+    Returns:
+        list: IDs de farmacia ordenados
+    """
+    lista = cache.get(CLAVE_FARMACIAS_LOCALES)
+    if lista is None:
+        lista = list(
+            Oportunidad.objects.values_list('farmacia_id', flat=True).distinct().order_by('farmacia_id')
+        )
+        cache.set(CLAVE_FARMACIAS_LOCALES, lista, settings.FARMA_CACHE_TIMEOUT)
+    return lista
+
+
+# --- CÁLCULOS CACHEADOS POR FARMACIA ---
+# Se invalidan solos al subir la versión de datos de la farmacia (ver cache_utils)
+
+@cache_por_farmacia('dashboard')
+def resumen_dashboard(farmacia_id):
+    """
+    Calcula los KPIs del dashboard principal (AH + EFP) de una farmacia.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+
+    Returns:
+        dict: total_ahorro, ahorro_mensual, top_5, total_grupos, total_marcas
+    """
+    oportunidades = Oportunidad.objects.filter(farmacia_id=farmacia_id)
+    efp_data = OportunidadEFP.objects.filter(farmacia_id=farmacia_id)
+
+    # Ahorro total (Suma de AH + EFP)
+    ahorro_ah = oportunidades.aggregate(Sum('ahorro_potencial'))['ahorro_potencial__sum'] or 0
+    ahorro_efp = efp_data.aggregate(Sum('ahorro_potencial'))['ahorro_potencial__sum'] or 0
+    total_ahorro = ahorro_ah + ahorro_efp
+
+    # Marcas a sustituir: solo necesitamos el texto de competidores
+    total_marcas = 0
+    for a_sustituir in oportunidades.values_list('a_sustituir', flat=True):
+        if a_sustituir:
+            total_marcas += len(a_sustituir.split(' || '))
+    for a_sustituir in efp_data.values_list('a_sustituir', flat=True):
+        if a_sustituir:
+            total_marcas += len(a_sustituir.split(' || '))
+
+    return {
+        'total_ahorro': total_ahorro,
+        'ahorro_mensual': total_ahorro / 12,
+        # Top 5 (Solo de AH por ahora)
+        'top_5': list(oportunidades.order_by('-ahorro_potencial')[:5]),
+        'total_grupos': oportunidades.count() + efp_data.count(),
+        'total_marcas': total_marcas,
+    }
+
+
+@cache_por_farmacia('buscador')
+def buscar_oportunidades(farmacia_id, query):
+    """Oportunidades AH de la farmacia cuyo grupo o competidores contienen `query`."""
+    return list(Oportunidad.objects.filter(farmacia_id=farmacia_id).filter(
+        Q(a_sustituir__icontains=query) |
+        Q(grupo_homogeneo__icontains=query)
+    ))
+
+
+@cache_por_farmacia('datos_brutos')
+def listar_datos_brutos(farmacia_id, orden):
+    """Todas las oportunidades AH de la farmacia ordenadas por `orden` (ya validado)."""
+    return list(Oportunidad.objects.filter(farmacia_id=farmacia_id).order_by(orden))
+
+
+@cache_por_farmacia('competidores')
+def competidores_oportunidad(farmacia_id, pk):
+    """
+    Desglose de competidores de una oportunidad AH (fragmento que se carga al abrirla).
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+        pk (int): ID de la oportunidad
+
+    Returns:
+        dict | None: oportunidad y competidores, o None si no es de la farmacia
+    """
+    oportunidad = Oportunidad.objects.filter(farmacia_id=farmacia_id, pk=pk).first()
+    if oportunidad is None:
+        return None
+    return {'oportunidad': oportunidad, 'competidores': oportunidad.get_competidores_stats()}
+
+
+@cache_por_farmacia('tip_del_dia')
+def tip_del_dia(farmacia_id):
+    """
+    Frase del tip del día: una oportunidad de más de 500 € de la farmacia, al azar.
+
+    Se elige por desplazamiento (COUNT + OFFSET sobre el índice) en vez de con
+    order_by('?'), que ordenaba al azar toda la farmacia en cada página.
+
+    Returns:
+        str: Texto del tip (con <b>)
+    """
+    candidatas = Oportunidad.objects.filter(farmacia_id=farmacia_id, ahorro_potencial__gt=500)
+    total = candidatas.count()
+    if not total:
+        return "Revisa los márgenes de los genéricos, ¡cada céntimo cuenta!"
+    oportunidad = candidatas.order_by('-ahorro_potencial')[random.randrange(total)]
+
+    competidor = "la marca"
+    stats = oportunidad.get_competidores_stats()
+    if stats:
+        competidor = stats[0]['nombre']  # Cogemos el primer competidor
+    return (
+        f"Sustituyendo <b>{competidor}</b> por <b>{oportunidad.producto_recomendado[:20]}...</b> "
+        f"aumentas el margen un <b>{oportunidad.margen_pct}%</b>."
+    )
+
+
+@cache_por_farmacia('banco_preguntas')
+def banco_preguntas_ah(farmacia_id):
+    """
+    Prepara todas las preguntas de examen AH posibles de una farmacia.
+
+    Las preferencias activas se cargan en una sola consulta y cada grupo con
+    rivales distintos de la respuesta correcta se convierte en una pregunta.
+    El examen solo tiene que sortear sobre esta lista cacheada.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+
+    Returns:
+        list: dicts con item, respuesta_correcta, origen y rivales
+    """
+    preferencias = {
+        p.grupo_homogeneo: p.laboratorio_preferente
+        for p in Preferencia.objects.filter(farmacia_id=farmacia_id, activo=True)
+    }
+
+    banco = []
+    for item in Oportunidad.objects.filter(farmacia_id=farmacia_id):
+        if item.grupo_homogeneo in preferencias:
+            respuesta_correcta = preferencias[item.grupo_homogeneo]
+            origen = "Preferencia"
+        else:
+            respuesta_correcta = item.producto_recomendado
+            origen = "Algoritmo"
+
+        posibles_rivales = sorted(set(
+            c['nombre'] for c in item.get_competidores_stats()
+            if c['nombre'].strip().upper() != respuesta_correcta.strip().upper()
+        ))
+
+        if posibles_rivales:
+            banco.append({
+                'item': item,
+                'respuesta_correcta': respuesta_correcta,
+                'origen': origen,
+                'rivales': posibles_rivales,
+            })
+
+    return banco
+
+
+def _candidatos_ah(pregunta):
+    """Respuesta + rivales en orden alfabético (el orden al que apuntan los índices en sesión)."""
+    return sorted([pregunta['respuesta_correcta']] + pregunta['rivales'])
+
+
+def generar_pregunta_ah(farmacia_id):
+    """
+    Sortea una pregunta de examen AH del banco cacheado.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+
+    Returns:
+        dict | None: item, opciones, respuesta_correcta, origen y la forma
+                     compacta para la sesión (id_pregunta, indices)
+    """
+    banco = banco_preguntas_ah(farmacia_id)
+    if not banco:
+        return None
+
+    pregunta = random.choice(banco)
+    candidatos = _candidatos_ah(pregunta)
+    idx_correcta = candidatos.index(pregunta['respuesta_correcta'])
+    otros = [i for i in range(len(candidatos)) if i != idx_correcta]
+    indices = [idx_correcta] + random.sample(otros, min(len(otros), 2))
+    random.shuffle(indices)
+    return _montar_pregunta_ah(pregunta, candidatos, indices)
+
+
+def recuperar_pregunta_ah(farmacia_id, id_pregunta, indices):
+    """
+    Reconstruye una pregunta AH a partir de su forma compacta guardada en sesión.
+
+    Returns:
+        dict | None: La pregunta, o None si ya no existe (p. ej. tras una sincronización)
+    """
+    for pregunta in banco_preguntas_ah(farmacia_id):
+        if pregunta['item'].id == id_pregunta:
+            candidatos = _candidatos_ah(pregunta)
+            if all(0 <= i < len(candidatos) for i in indices):
+                return _montar_pregunta_ah(pregunta, candidatos, indices)
+            return None
+    return None
+
+
+def _montar_pregunta_ah(pregunta, candidatos, indices):
+    return {
+        'id_pregunta': pregunta['item'].id,
+        'indices': indices,
+        'item': pregunta['item'],
+        'opciones': [candidatos[i] for i in indices],
+        'respuesta_correcta': pregunta['respuesta_correcta'],
+        'origen': pregunta['origen'],
+    }
+
+
+# --- PREFERENCIAS EN BLOQUE ---
+# La lógica es común con EFP (core/preferencias.py)
+
+PREFERENCIAS_AH = TipoPreferencia(
+    Preferencia, Oportunidad, campo_grupo='grupo_homogeneo', clave='grupo',
+    campo_producto='laboratorio_preferente', con_activo=True,
+)
+
+
+def guardar_preferencias_masivo(farmacia_id, cambios):
+    """
+    Aplica de una vez muchas preferencias de AH de una farmacia (ver `preferencias.guardar_masivo`).
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+        cambios (list): dicts {'grupo': str, 'producto': str, 'activo': bool}
+
+    Returns:
+        tuple: (num_aplicadas, errores) con errores como lista de dicts {'grupo', 'error'}
+    """
+    return preferencias.guardar_masivo(PREFERENCIAS_AH, farmacia_id, cambios)
+
+
+def exportar_preferencias_csv(farmacia_id):
+    """
+    Exporta las preferencias de AH de una farmacia como CSV.
+
+    Returns:
+        str: CSV con columnas grupo_homogeneo, laboratorio_preferente, activo
+    """
+    return preferencias.exportar_csv(PREFERENCIAS_AH, farmacia_id)
+
+
+def leer_preferencias_csv(contenido):
+    """Convierte un CSV exportado con `exportar_preferencias_csv` en cambios."""
+    return preferencias.leer_csv(PREFERENCIAS_AH, contenido)
+
+
+def copiar_preferencias(origen, destinos):
+    """
+    Copia las preferencias de AH de una farmacia a otras (validando en cada destino).
+
+    Returns:
+        dict: {destino: (num_aplicadas, errores)}
+    """
+    return preferencias.copiar(PREFERENCIAS_AH, origen, destinos)
+
+
+# --- PRECALENTADO DE CACHÉ ---
+
+def precalentar_cache(farmacia_id):
+    """
+    Calcula y deja en caché las vistas principales de una farmacia.
+
+    Se llama al terminar una sincronización y al cambiar de farmacia, para
+    que el primer usuario no pague el coste de la caché fría. Cubre el
+    resumen del dashboard (con su top 5), las familias del dashboard EFP,
+    los bancos de preguntas de examen y los listados de datos brutos con
+    su orden por defecto. Los fragmentos de plantilla se rellenan en el
+    primer render, que con estos datos ya calculados es inmediato.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+
+    Returns:
+        float: Segundos empleados
+    """
+    inicio = time.perf_counter()
+    resumen_dashboard(farmacia_id)
+    facetas_familias_efp(farmacia_id)
+    resumen_dashboard_efp(farmacia_id, 'TODAS', 1)
+    banco_preguntas_ah(farmacia_id)
+    banco_preguntas_efp(farmacia_id)
+    listar_datos_brutos(farmacia_id, '-ahorro_potencial')
+    listar_datos_brutos_efp(farmacia_id, '-ahorro_potencial')
+    return time.perf_counter() - inicio
+
+
+# Pocos hilos: el precalentado es trabajo de fondo y no debe competir con las peticiones
+_ejecutor_precalentado = ThreadPoolExecutor(max_workers=2, thread_name_prefix='precalentar')
+_en_curso = set()
+_en_curso_lock = threading.Lock()
+
+
+def _precalentar_tarea(farmacia_id):
+    try:
+        segundos = precalentar_cache(farmacia_id)
+        logger.info("Caché de %s precalentada en %.2fs", farmacia_id, segundos)
+    except Exception:
+        logger.exception("Error precalentando la caché de %s", farmacia_id)
+    finally:
+        with _en_curso_lock:
+            _en_curso.discard(farmacia_id)
+        # Cada hilo abre su propia conexión: la cerramos al terminar
+        connections.close_all()
+
+
+def precalentar_en_segundo_plano(farmacia_id):
+    """
+    Lanza `precalentar_cache` en un hilo sin bloquear la petición.
+
+    Si ya hay un precalentado en curso para esa farmacia no se encola otro.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+
+    Returns:
+        bool: True si se ha encolado el precalentado
+    """
+    with _en_curso_lock:
+        if farmacia_id in _en_curso:
+            return False
+        _en_curso.add(farmacia_id)
+    _ejecutor_precalentado.submit(_precalentar_tarea, farmacia_id)
+    return True
+
+
+# --- IMPORTACIÓN COMPLETA ---
+
+def importar_farmacia(farmacia_id, fecha_inicio, fecha_fin, progreso=None):
+    """
+    Sincroniza AH y EFP de una farmacia y deja su caché precalentada.
+
+    Es lo que hace el botón "Importar": la vista síncrona lo ejecuta en la
+    petición y la asíncrona como trabajo en segundo plano (core/asincrono.py).
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+        fecha_inicio (str): Fecha inicio (YYYY-MM-DD)
+        fecha_fin (str): Fecha fin (YYYY-MM-DD)
+        progreso (callable): Recibe el nombre de cada fase al empezarla
+
+    Returns:
+        dict: {'farmacia_id', 'ah', 'efp', 'errores': {'AH': str, 'EFP': str}}
+    """
+    progreso = progreso or (lambda fase: None)
+    resultado = {'farmacia_id': farmacia_id, 'errores': {}}
+    for segmento, sincronizar in (('AH', sincronizar_desde_databricks), ('EFP', sincronizar_efp_desde_databricks)):
+        progreso(f"Sincronizando {segmento}")
+        num, error = sincronizar(farmacia_id, fecha_inicio, fecha_fin)
+        resultado[segmento.lower()] = num
+        if error:
+            resultado['errores'][segmento] = error
+
+    if not resultado['errores']:
+        progreso("Precalentando caché")
+        precalentar_cache(farmacia_id)
+    return resultado
+
@@ -0,0 +1,38 @@
+# core/test_runner.py
+"""
+Runner de tests que aparta los ficheros SQLite de ejecución.
+
+Con la configuración por defecto la caché compartida, el warehouse local y
+las métricas viven en BASE_DIR; los tests los llevan a un directorio
+temporal para no ensuciar el repositorio ni tocar los de un servidor donde
+se ejecuten.
+"""
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class DiscoverRunnerFarma(DiscoverRunner):
+    """DiscoverRunner con caché, warehouse local y métricas en un directorio temporal."""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._directorio = tempfile.mkdtemp(prefix='farma-tests-')
+        cache_defecto = dict(settings.CACHES['default'])
+        if cache_defecto['BACKEND'] == 'core.cache_backends.SQLiteCache':
+            cache_defecto['LOCATION'] = os.path.join(self._directorio, 'cache.sqlite3')
+        self._ajustes = override_settings(
+            CACHES={**settings.CACHES, 'default': cache_defecto},
+            WAREHOUSE_LOCAL_PATH=os.path.join(self._directorio, 'warehouse_local.sqlite3'),
+            METRICAS_PATH=os.path.join(self._directorio, 'metricas.sqlite3'),
+        )
+        self._ajustes.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._ajustes.disable()
+        shutil.rmtree(self._directorio, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
@@ -1,3 +1,1311 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import multiprocessing
+import os
+import pstats
+import re
+import shutil
+import tempfile
+import threading
+import time
+from importlib import import_module
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import Permission, User
+from django.contrib.sessions.backends import signed_cookies
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.core.handlers.asgi import ASGIHandler
+from django.http import HttpResponse, StreamingHttpResponse
+from django.middleware.csrf import get_token
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core import instrumentacion, metricas
+from core.benchmarks import cliente_de_farmacia, sembrar_datos
+from core.cache_backends import SQLiteCache
+from core.cache_utils import estadisticas_cache, obtener_version
+from core.checks import comprobar_cache_compartida
+from core.compresion import CompresionMiddleware, elegir_codificacion, minificar_html
+from core.estado_examen import EstadoExamen
+from core.datos_sinteticos import cargar_en_django, generar_farmacia, ids_farmacias, ids_grupos_efp
+from core.db_utils import bulk_create_or_update
+from core.management.commands.benchmark_arranque import medir_arranque
+from core.models import EjecucionSync, Oportunidad, PerfilFarmacia, PerfilPeticion, Preferencia
+from core.services import (
+    CLAVE_FARMACIAS_CLOUD, copiar_preferencias, guardar_preferencias_masivo, listar_datos_brutos, resumen_dashboard,
+    sincronizar_desde_databricks,
+)
+from core.warehouse_local import FARMACIAS_DEMO, traducir_sql
+from efp.models import PreferenciaEFP
+
+FARMACIA = 'HFTEST'
+TABLAS = ('core_oportunidad', 'core_preferencia', 'efp_oportunidadefp', 'efp_preferenciaefp')
+
+
+def plan_consulta(sql, params=()):
+    """
+    Plan de ejecución de una consulta SQL (EXPLAIN QUERY PLAN en SQLite, EXPLAIN en PostgreSQL).
+
+    En PostgreSQL se desactivan los Seq Scan para que, con pocos datos de
+    prueba, solo aparezcan cuando de verdad no hay un índice utilizable.
+
+    Args:
+        sql (str): Consulta SELECT
+        params (tuple): Parámetros de la consulta (vacío si el SQL ya los lleva)
+
+    Returns:
+        list: Una línea de texto por nodo del plan
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+        else:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [str(fila[-1]) for fila in cursor.fetchall()]
+
+
+def plan_queryset(queryset):
+    """Plan de ejecución de un QuerySet."""
+    return plan_consulta(*queryset.query.sql_with_params())
+
+
+def recorridos_completos(plan):
+    """Líneas del plan que leen una tabla de datos entera (sin índice)."""
+    tablas = '|'.join(TABLAS)
+    if connection.vendor == 'postgresql':
+        patron = re.compile(rf'Seq Scan on ({tablas})\b')
+        return [linea for linea in plan if patron.search(linea)]
+    patron = re.compile(rf'^SCAN (TABLE )?({tablas})\b')
+    return [linea for linea in plan if patron.search(linea) and 'USING' not in linea]
+
+
+def ordenaciones_temporales(plan):
+    """Líneas del plan que ordenan en memoria en vez de recorrer un índice ya ordenado."""
+    if connection.vendor == 'postgresql':
+        return [linea for linea in plan if re.search(r'^\s*(->\s*)?Sort\b', linea)]
+    return [linea for linea in plan if 'TEMP B-TREE FOR ORDER BY' in linea]
+
+
+class PlanesConsultaMixin:
+    """
+    Siembra dos farmacias, recorre vistas y comprueba el plan de cada consulta.
+
+    Cada test de vista hace GET con la caché vacía (para que las consultas se
+    ejecuten de verdad), captura el SQL y falla si alguna consulta sobre las
+    tablas de oportunidades/preferencias hace un recorrido completo.
+    """
+
+    num_grupos = 300
+
+    @classmethod
+    def setUpTestData(cls):
+        sembrar_datos(FARMACIA, cls.num_grupos)
+        sembrar_datos('HFOTRA', cls.num_grupos, semilla=1)
+        Preferencia.objects.bulk_create(
+            Preferencia(farmacia_id=FARMACIA, grupo_homogeneo=f'GRUPO {i}', laboratorio_preferente=f'MARCA {i}-0')
+            for i in range(0, cls.num_grupos, 3)
+        )
+        PreferenciaEFP.objects.bulk_create(
+            PreferenciaEFP(farmacia_id=FARMACIA, id_agrupacion=i + 1, producto_preferido=f'RIVAL {i}-0')
+            for i in range(0, cls.num_grupos, 3)
+        )
+        # Usuario normal con farmacia asignada: el dashboard de admin consultaría Databricks
+        cls.usuario = User.objects.create_user('planes', 'planes@example.com', 'planes')
+        PerfilFarmacia.objects.create(user=cls.usuario, farmacia_id=FARMACIA)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.usuario)
+        sesion = self.client.session
+        sesion['farmacia_activa'] = FARMACIA
+        sesion.save()
+        # Con cookies firmadas la clave de sesión cambia al guardar
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = sesion.session_key
+
+    def consultas_de(self, url):
+        with CaptureQueriesContext(connection) as consultas:
+            respuesta = self.client.get(url)
+        self.assertLess(respuesta.status_code, 400, url)
+        return [
+            q['sql'] for q in consultas.captured_queries
+            if q['sql'].lstrip().upper().startswith('SELECT') and any(t in q['sql'] for t in TABLAS)
+        ]
+
+    def assertSinRecorridosCompletos(self, url):
+        consultas = self.consultas_de(url)
+        self.assertTrue(consultas, f'{url} no ha consultado ninguna tabla de datos')
+        for sql in consultas:
+            plan = plan_consulta(sql)
+            with self.subTest(url=url, sql=sql):
+                self.assertFalse(recorridos_completos(plan), '\n'.join(plan))
+
+    def assertUsaIndiceOrdenado(self, queryset):
+        plan = plan_queryset(queryset)
+        self.assertFalse(recorridos_completos(plan), '\n'.join(plan))
+        self.assertFalse(ordenaciones_temporales(plan), '\n'.join(plan))
+
+
+class PlanesConsultaAHTests(PlanesConsultaMixin, TestCase):
+
+    def test_vistas_sin_recorridos_completos(self):
+        for url in (
+            '/',
+            '/buscador/?q=MARCA',
+            '/datos-brutos/',
+            '/datos-brutos/?order=grupo_homogeneo',
+            '/datos-brutos/?order=-margen_pct',
+            '/entrenamiento/',
+            '/examen/',
+            '/configuracion/',
+            '/configuracion/?q=GRUPO 1',
+            '/configuracion/exportar/',
+        ):
+            self.assertSinRecorridosCompletos(url)
+
+    def test_configuracion_ordena_por_indice(self):
+        self.assertUsaIndiceOrdenado(
+            Oportunidad.objects.filter(farmacia_id=FARMACIA).order_by('grupo_homogeneo')
+        )
+
+    def test_top_ahorro_ordena_por_indice(self):
+        self.assertUsaIndiceOrdenado(
+            Oportunidad.objects.filter(farmacia_id=FARMACIA).order_by('-ahorro_potencial')[:5]
+        )
+
+    def test_tip_del_dia_usa_indice(self):
+        plan = plan_queryset(Oportunidad.objects.filter(farmacia_id=FARMACIA, ahorro_potencial__gt=500))
+        self.assertFalse(recorridos_completos(plan), '\n'.join(plan))
+
+    def test_preferencias_por_grupo_usan_indice(self):
+        plan = plan_queryset(Preferencia.objects.filter(
+            farmacia_id=FARMACIA, grupo_homogeneo__in=['GRUPO 1', 'GRUPO 2'], activo=True
+        ))
+        self.assertFalse(recorridos_completos(plan), '\n'.join(plan))
+
+    def test_exportar_preferencias_ordena_por_indice(self):
+        self.assertUsaIndiceOrdenado(
+            Preferencia.objects.filter(farmacia_id=FARMACIA).order_by('grupo_homogeneo')
+        )
+
+
+class WarehouseLocalMixin:
+    """Sincroniza contra un warehouse local nuevo (DATABRICKS_BACKEND=local) en un directorio temporal."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        directorio = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, directorio)
+        ajustes = override_settings(
+            DATABRICKS_BACKEND='local', WAREHOUSE_LOCAL_PATH=str(Path(directorio) / 'warehouse.sqlite3'),
+        )
+        ajustes.enable()
+        cls.addClassCleanup(ajustes.disable)
+
+
+class SincronizacionLocalAHTests(WarehouseLocalMixin, TestCase):
+
+    def test_traduce_dialecto_spark(self):
+        sql = traducir_sql(
+            "SELECT array_join(collect_list(CAST(CAST(x AS DECIMAL(10,2)) AS STRING)), ' || ') "
+            "FROM cat_farma.datavaultperformance.bridge_dispensacion WHERE fecha >= DATE '2024-01-01'"
+        )
+        self.assertEqual(
+            sql,
+            "SELECT coalesce(group_concat(CAST(printf('%.2f', x) AS TEXT), ' || '), '') "
+            "FROM bridge_dispensacion WHERE fecha >= '2024-01-01'",
+        )
+
+    def test_sincroniza_con_la_consulta_real(self):
+        farmacia = FARMACIAS_DEMO[0]
+        num, error = sincronizar_desde_databricks(farmacia, '2024-01-01', '2024-12-31')
+
+        self.assertIsNone(error)
+        self.assertGreater(num, 0)
+        self.assertEqual(Oportunidad.objects.filter(farmacia_id=farmacia).count(), num)
+        oportunidad = Oportunidad.objects.filter(farmacia_id=farmacia).order_by('-ahorro_potencial').first()
+        self.assertGreater(oportunidad.ahorro_potencial, 10)
+        self.assertTrue(oportunidad.codigo_nacional)
+        self.assertRegex(oportunidad.a_sustituir, r'^.+ \(\d+\|\d+%\|\d+\)')
+
+        ejecucion = EjecucionSync.objects.get()
+        self.assertTrue(ejecucion.correcta)
+        self.assertEqual(ejecucion.filas_escritas, num)
+        self.assertTrue(ejecucion.id_consulta.startswith('local-'))
+
+    def test_admite_principio_activo_repetido(self):
+        # Dos agrupaciones con el mismo principio activo (p. ej. 20 y 40 mg) son dos filas
+        campos = dict(farmacia_id=FARMACIA, grupo_homogeneo='OMEPRAZOL', producto_recomendado='X',
+                      pvp_medio=1, puc_medio=1, margen_pct=1, penetracion_pct=1, a_sustituir='',
+                      ahorro_potencial=1)
+        num = bulk_create_or_update(Oportunidad, FARMACIA, [Oportunidad(**campos), Oportunidad(**campos)])
+
+        self.assertEqual(num, 2)
+        self.assertEqual(Oportunidad.objects.filter(farmacia_id=FARMACIA, grupo_homogeneo='OMEPRAZOL').count(), 2)
+
+
+class InvalidacionCacheTests(WarehouseLocalMixin, TestCase):
+    """Una sincronización o un cambio de preferencias deja de servir los datos cacheados de la farmacia."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_sincronizar_invalida_el_dashboard(self):
+        farmacia = FARMACIAS_DEMO[0]
+        self.assertEqual(resumen_dashboard(farmacia)['total_grupos'], 0)
+
+        num, error = sincronizar_desde_databricks(farmacia, '2024-01-01', '2024-12-31')
+
+        self.assertIsNone(error)
+        self.assertEqual(resumen_dashboard(farmacia)['total_grupos'], num)
+
+    def test_guardar_preferencias_invalida_los_datos(self):
+        cargar_en_django([FARMACIA], grupos_ah=5, ids_efp=ids_grupos_efp(1), semilla=3)
+        oportunidad = Oportunidad.objects.filter(farmacia_id=FARMACIA).order_by('pk').first()
+        antes = listar_datos_brutos(FARMACIA, 'pk')[0].ahorro_potencial
+
+        # Un cambio en la base de datos sin subir la versión no se ve (sigue cacheado)
+        Oportunidad.objects.filter(pk=oportunidad.pk).update(ahorro_potencial=antes + 1000)
+        self.assertEqual(listar_datos_brutos(FARMACIA, 'pk')[0].ahorro_potencial, antes)
+
+        guardar_preferencias_masivo(FARMACIA, [
+            {'grupo': oportunidad.grupo_homogeneo, 'producto': oportunidad.get_opciones()[0], 'activo': True},
+        ])
+        self.assertEqual(listar_datos_brutos(FARMACIA, 'pk')[0].ahorro_potencial, antes + 1000)
+
+    def test_un_acierto_no_escribe_en_la_cache(self):
+        cargar_en_django([FARMACIA], grupos_ah=5, ids_efp=ids_grupos_efp(1), semilla=3)
+        resumen_dashboard(FARMACIA)
+        antes = estadisticas_cache(['dashboard'])['dashboard']
+
+        backend = caches['default']
+        with mock.patch.object(backend, 'add') as add, mock.patch.object(backend, 'incr') as incr, \
+                mock.patch.object(backend, 'set') as set_:
+            resumen_dashboard(FARMACIA)
+        self.assertFalse(add.called or incr.called or set_.called)
+
+        despues = estadisticas_cache(['dashboard'])['dashboard']
+        self.assertEqual((despues['hits'], despues['misses']), (antes['hits'] + 1, antes['misses']))
+
+    def test_un_fallo_lee_la_cache_una_sola_vez(self):
+        cargar_en_django([FARMACIA], grupos_ah=5, ids_efp=ids_grupos_efp(1), semilla=3)
+        antes = estadisticas_cache(['dashboard'])['dashboard']
+        backend = caches['default']
+        with mock.patch.object(backend, 'get', wraps=backend.get) as get:
+            resumen_dashboard(FARMACIA)
+        lecturas = [c for c in get.call_args_list if ':dashboard:' in c.args[0]]
+        # La de get_or_set y, con SQLiteCache, la de comprobar tras tomar el cerrojo
+        limite = 2 if isinstance(backend, SQLiteCache) else 1
+        self.assertLessEqual(len(lecturas), limite, lecturas)
+
+        # Si otro worker la rellena mientras tanto no se calcula: cuenta como acierto
+        with mock.patch.object(backend, 'get_or_set', return_value={'total_grupos': 0}):
+            resumen_dashboard(FARMACIA)
+        despues = estadisticas_cache(['dashboard'])['dashboard']
+        self.assertEqual((despues['hits'], despues['misses']), (antes['hits'] + 1, antes['misses'] + 1))
+
+    @skipUnless(settings.CACHES['default']['BACKEND'] == 'core.cache_backends.SQLiteCache',
+                 'Solo con la caché compartida')
+    def test_la_invalidacion_llega_a_los_demas_workers(self):
+        farmacia = FARMACIAS_DEMO[0]
+        self.assertEqual(resumen_dashboard(farmacia)['total_grupos'], 0)
+
+        # Otro worker: su propia instancia del backend (y su conexión) sobre el mismo fichero
+        otro_worker = SQLiteCache(settings.CACHES['default']['LOCATION'], {})
+        with mock.patch('core.cache_utils.cache', otro_worker):
+            num, _ = sincronizar_desde_databricks(farmacia, '2024-01-01', '2024-12-31')
+
+        self.assertEqual(resumen_dashboard(farmacia)['total_grupos'], num)
+
+
+def _incrementar_en_proceso(ruta, veces):
+    """Proceso hijo de SQLiteCacheTests: su propia instancia y conexión sobre el mismo fichero."""
+    backend = SQLiteCache(ruta, {})
+    for _ in range(veces):
+        backend.incr('contador')
+
+
+class SQLiteCacheTests(SimpleTestCase):
+    """Backend de caché compartido entre procesos (core/cache_backends.py)."""
+
+    def setUp(self):
+        directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directorio)
+        self.ruta = str(Path(directorio) / 'cache.sqlite3')
+        self.cache = SQLiteCache(self.ruta, {})
+
+    def en_hilos(self, funcion, num=8):
+        """Ejecuta `funcion()` a la vez en `num` hilos y devuelve sus resultados."""
+        barrera = threading.Barrier(num)
+        resultados = []
+
+        def hilo():
+            barrera.wait()
+            resultados.append(funcion())
+
+        hilos = [threading.Thread(target=hilo) for _ in range(num)]
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        return resultados
+
+    def test_add_e_incr_atomicos_entre_hilos(self):
+        self.assertEqual(self.en_hilos(lambda: self.cache.add('unica', os.getpid())).count(True), 1)
+
+        self.cache.set('contador', 0, None)
+        self.en_hilos(lambda: [self.cache.incr('contador') for _ in range(25)])
+        self.assertEqual(self.cache.get('contador'), 200)
+
+    def test_incr_atomico_entre_procesos(self):
+        self.cache.set('contador', 0, None)
+        contexto = multiprocessing.get_context('fork')
+        procesos = [contexto.Process(target=_incrementar_en_proceso, args=(self.ruta, 50)) for _ in range(4)]
+        for p in procesos:
+            p.start()
+        for p in procesos:
+            p.join(60)
+            self.assertEqual(p.exitcode, 0)
+        self.assertEqual(self.cache.get('contador'), 200)
+
+    def test_caducidad(self):
+        self.cache.set('corta', 1, 0.05)
+        self.cache.set('larga', 2, 60)
+        self.assertTrue(self.cache.has_key('corta'))
+        time.sleep(0.1)
+
+        self.assertIsNone(self.cache.get('corta'))
+        self.assertFalse(self.cache.has_key('corta'))
+        self.assertEqual(self.cache.get('larga'), 2)
+        with self.assertRaises(ValueError):
+            self.cache.incr('corta')
+        # add ocupa una clave caducada pero no una vigente
+        self.assertTrue(self.cache.add('corta', 3))
+        self.assertFalse(self.cache.add('larga', 3))
+        self.assertEqual((self.cache.get('corta'), self.cache.get('larga')), (3, 2))
+
+    def test_touch(self):
+        self.cache.set('clave', 1, 0.05)
+        self.assertTrue(self.cache.touch('clave', None))
+        time.sleep(0.1)
+        self.assertEqual(self.cache.get('clave'), 1)
+
+        self.cache.set('otra', 1, 0.05)
+        time.sleep(0.1)
+        self.assertFalse(self.cache.touch('otra', 60))
+        self.assertFalse(self.cache.touch('inexistente', 60))
+
+    def test_desalojo_por_numero_de_entradas(self):
+        cache = SQLiteCache(self.ruta, {'OPTIONS': {'MAX_ENTRIES': 10, 'CULL_FREQUENCY': 4}})
+        cache.CULL_CADA = 1
+        for i in range(11):
+            cache.set(f'k{i}', i, 60)
+            time.sleep(0.002)  # `accessed` estrictamente creciente
+
+        # Con 11 entradas se borran max(11 // 4, 11 - 10) = 2, las menos usadas
+        presentes = [i for i in range(11) if cache.has_key(f'k{i}')]
+        self.assertEqual(presentes, list(range(2, 11)))
+
+    def test_desalojo_por_tamano(self):
+        cache = SQLiteCache(self.ruta, {'OPTIONS': {'MAX_SIZE': 10_000}})
+        cache.CULL_CADA = 1
+        for i in range(12):
+            cache.set(f'k{i}', 'x' * 1000, 60)
+            time.sleep(0.002)
+
+        tamano = cache._conexion().execute('SELECT SUM(size) FROM cache').fetchone()[0]
+        self.assertLessEqual(tamano, 10_000)
+        self.assertTrue(cache.has_key('k11'))
+        self.assertFalse(cache.has_key('k0'))
+
+    def test_get_or_set_calcula_una_sola_vez(self):
+        llamadas = []
+
+        def calcular():
+            llamadas.append(1)
+            time.sleep(0.1)
+            return 'valor'
+
+        self.assertEqual(set(self.en_hilos(lambda: self.cache.get_or_set('clave', calcular, 60))), {'valor'})
+        self.assertEqual(len(llamadas), 1)
+
+    def test_get_or_set_con_cerrojo_caducado(self):
+        cache = SQLiteCache(self.ruta, {'OPTIONS': {'LOCK_TIMEOUT': 0.2}})
+        # Un proceso tomó el cerrojo y murió sin calcular ni soltarlo
+        cache.add('clave:__cerrojo__', 12345, timeout=0.2)
+
+        inicio = time.monotonic()
+        self.assertEqual(cache.get_or_set('clave', lambda: 'valor', 60), 'valor')
+        self.assertGreaterEqual(time.monotonic() - inicio, 0.2)
+        self.assertEqual(cache.get('clave'), 'valor')
+
+
+def _responder_en_proceso(veces):
+    """Proceso hijo de MetricasTests: acumula en su memoria y vuelca al fichero compartido."""
+    for _ in range(veces):
+        metricas.EXAMEN_RESPUESTAS.inc(examen='ah', resultado='acierto')
+    metricas.volcar(forzar=True)
+
+
+@override_settings(METRICAS=True)
+class MetricasTests(SimpleTestCase):
+    """Registro de métricas compartido entre procesos (core/metricas.py)."""
+
+    def setUp(self):
+        metricas.reiniciar()
+
+    def muestras_guardadas(self):
+        return metricas._conexion().execute('SELECT COUNT(*) FROM muestra').fetchone()[0]
+
+    def test_formato_de_exposicion(self):
+        metricas.EXAMEN_RESPUESTAS.inc(2, examen='ah', resultado='acierto')
+        metricas.EXAMEN_RESPUESTAS.inc(examen='e"f\\p', resultado='fallo')
+        for segundos in (0.3, 0.7, 700):
+            metricas.SYNC_DURACION.observar(segundos, origen='ah', fase='total', farmacia='HF1', estado='ok')
+
+        lineas = metricas.exponer().splitlines()
+
+        self.assertIn('# TYPE farma_examen_respuestas_total counter', lineas)
+        self.assertIn('farma_examen_respuestas_total{examen="ah",resultado="acierto"} 2', lineas)
+        self.assertIn('farma_examen_respuestas_total{examen="e\\"f\\\\p",resultado="fallo"} 1', lineas)
+        self.assertIn('# TYPE farma_sync_duracion_segundos histogram', lineas)
+        etiquetas = 'origen="ah",fase="total",farmacia="HF1",estado="ok"'
+        histograma = [l for l in lineas if l.startswith('farma_sync_duracion_segundos_') and etiquetas in l]
+        # Todas las cubetas (acumuladas, en orden creciente) y después _sum y _count
+        cubetas = ['0.1', '0.5', '1', '2.5', '5', '10', '30', '60', '120', '300', '600', '+Inf']
+        acumulados = [0, 1, 2, 2, 2, 2, 2, 2, 2, 2, 2, 3]
+        self.assertEqual(histograma, [
+            f'farma_sync_duracion_segundos_bucket{{{etiquetas},le="{le}"}} {n}' for le, n in zip(cubetas, acumulados)
+        ] + [
+            f'farma_sync_duracion_segundos_sum{{{etiquetas}}} 701',
+            f'farma_sync_duracion_segundos_count{{{etiquetas}}} 3',
+        ])
+
+    def test_suma_los_procesos(self):
+        contexto = multiprocessing.get_context('fork')
+        procesos = [contexto.Process(target=_responder_en_proceso, args=(5,)) for _ in range(3)]
+        for p in procesos:
+            p.start()
+        for p in procesos:
+            p.join(60)
+            self.assertEqual(p.exitcode, 0)
+        metricas.EXAMEN_RESPUESTAS.inc(examen='ah', resultado='acierto')
+
+        self.assertIn('farma_examen_respuestas_total{examen="ah",resultado="acierto"} 16', metricas.exponer())
+
+    def test_sincronizacion_fallida_registra_su_duracion(self):
+        fases = {'conexion': 0.2, 'ejecucion': 3.0}
+        metricas.registrar_sync('ah', 'HF1', fases, 10, 10)
+        metricas.registrar_sync('ah', 'HF1', fases, error='OperationalError')
+        exposicion = metricas.exponer()
+
+        for estado in ('ok', 'error'):
+            self.assertIn(
+                f'farma_sync_duracion_segundos_count{{origen="ah",fase="total",farmacia="HF1",estado="{estado}"}} 1',
+                exposicion,
+            )
+        self.assertIn('farma_sync_errores_total{origen="ah",farmacia="HF1"} 1', exposicion)
+        self.assertIn('farma_sync_filas_leidas_total{origen="ah",farmacia="HF1"} 10', exposicion)
+
+    @override_settings(METRICAS=False, METRICAS_VOLCADO_S=0)
+    def test_desactivadas_no_crean_el_fichero(self):
+        ruta = Path(tempfile.mkdtemp()) / 'metricas.sqlite3'
+        self.addCleanup(shutil.rmtree, ruta.parent)
+        with override_settings(METRICAS_PATH=str(ruta)):
+            metricas.EXAMEN_RESPUESTAS.inc(examen='ah', resultado='acierto')
+            metricas.PETICION_DURACION.observar(0.1, vista='dashboard', metodo='GET')
+            metricas.volcar(forzar=True)
+            self.assertEqual(self.client.get('/metricas/').status_code, 404)
+        self.assertFalse(ruta.exists())
+
+    @override_settings(METRICAS_VOLCADO_S=60)
+    def test_volcado_espaciado(self):
+        metricas.volcar(forzar=True)
+        for _ in range(10):
+            metricas.EXAMEN_RESPUESTAS.inc(examen='ah', resultado='acierto')
+        # Aún no han pasado METRICAS_VOLCADO_S: todo sigue en memoria
+        self.assertEqual(self.muestras_guardadas(), 0)
+
+        metricas.volcar(forzar=True)
+        self.assertEqual(self.muestras_guardadas(), 1)
+
+    @override_settings(METRICAS_VOLCADO_S=0)
+    def test_volcado_fuera_del_bucle_asyncio(self):
+        hilos = []
+        conexion = metricas._conexion
+
+        def registrar_hilo():
+            hilos.append(threading.current_thread().name)
+            return conexion()
+
+        async def vista():
+            metricas.EXAMEN_RESPUESTAS.inc(examen='ah', resultado='acierto')
+
+        with mock.patch.object(metricas, '_conexion', registrar_hilo):
+            asyncio.run(vista())
+            metricas._hilo_volcado.submit(lambda: None).result()  # Espera al volcado encargado
+
+        self.assertTrue(hilos)
+        self.assertTrue(all(nombre.startswith('metricas') for nombre in hilos), hilos)
+        self.assertEqual(self.muestras_guardadas(), 1)
+
+
+class EstadoExamenTests(TestCase):
+
+    def test_ida_y_vuelta_por_la_sesion(self):
+        for motor in ('cached_db', 'signed_cookies'):
+            with self.subTest(motor=motor):
+                almacen = import_module(f'django.contrib.sessions.backends.{motor}').SessionStore
+                sesion = almacen()
+                estado = EstadoExamen(sesion, 'examen_ah')
+                self.assertFalse(estado.iniciado)
+                estado.aciertos, estado.total = 3, 5
+                estado.pregunta = [17, [2, 0, 3, 1]]
+                estado.resultado = [16, [1, 3, 0, 2], 2]
+                estado.guardar()
+                sesion.save()
+
+                leida = almacen(session_key=sesion.session_key)
+                recuperado = EstadoExamen(leida, 'examen_ah')
+                self.assertTrue(recuperado.iniciado)
+                self.assertEqual(
+                    [recuperado.aciertos, recuperado.total, recuperado.pregunta, recuperado.resultado],
+                    [3, 5, [17, [2, 0, 3, 1]], [16, [1, 3, 0, 2], 2]],
+                )
+                # Guardar sin cambios no marca la sesión como modificada
+                recuperado.guardar()
+                self.assertFalse(leida.modified)
+
+    def test_estado_corrupto_empieza_de_cero(self):
+        estado = EstadoExamen({'examen_ah': {'aciertos': 1}}, 'examen_ah')
+        self.assertEqual([estado.aciertos, estado.total, estado.pregunta, estado.resultado], [0, 0, None, None])
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_la_sesion_cabe_en_una_cookie(self):
+        cargar_en_django([FARMACIA], grupos_ah=30, ids_efp=ids_grupos_efp(14), semilla=4)
+        usuario = User.objects.create_user('examinado', password='x')
+        PerfilFarmacia.objects.create(user=usuario, farmacia_id=FARMACIA)
+        cliente = cliente_de_farmacia(usuario, FARMACIA)
+        cache.clear()
+
+        for _ in range(10):
+            for url in ('/examen/', '/efp/examen/'):
+                cliente.get(url)
+                cliente.post(url, {'opcion': 1})
+                cliente.get(url)  # EFP: la corrección se muestra en la siguiente visita
+        sesion = signed_cookies.SessionStore(session_key=cliente.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertEqual(EstadoExamen(sesion, 'examen_ah').total, 10)
+        self.assertEqual(EstadoExamen(sesion, 'examen_efp').total, 10)
+        # Límite de los navegadores: 4096 bytes por cookie, nombre y atributos incluidos
+        self.assertLess(len(cliente.cookies[settings.SESSION_COOKIE_NAME].output(header='')), 4096)
+
+    def test_escrituras_de_sesion_por_respuesta(self):
+        cargar_en_django([FARMACIA], grupos_ah=30, semilla=4)
+        usuario = User.objects.create_user('examinado', password='x')
+        PerfilFarmacia.objects.create(user=usuario, farmacia_id=FARMACIA)
+        # Solo con cookies firmadas responder no escribe en django_session
+        for motor, escribe in (('cached_db', True), ('signed_cookies', False)):
+            with self.subTest(motor=motor), override_settings(
+                SESSION_ENGINE=f'django.contrib.sessions.backends.{motor}'
+            ):
+                cliente = cliente_de_farmacia(usuario, FARMACIA)
+                cliente.get('/examen/')
+                with CaptureQueriesContext(connection) as consultas:
+                    cliente.post('/examen/', {'opcion': 1})
+                escrituras = [
+                    c['sql'] for c in consultas
+                    if 'django_session' in c['sql'] and c['sql'].lstrip().startswith(('INSERT', 'UPDATE'))
+                ]
+                self.assertEqual(bool(escrituras), escribe, escrituras)
+
+
+class InstrumentacionTests(TestCase):
+    """Cabecera Server-Timing y percentiles por vista (core/instrumentacion.py)."""
+
+    def setUp(self):
+        cache.clear()
+        instrumentacion.reiniciar_resumen()
+
+    @override_settings(INSTRUMENTACION=True)
+    def test_server_timing_cuenta_las_consultas(self):
+        cargar_en_django([FARMACIA], grupos_ah=10, ids_efp=ids_grupos_efp(1), semilla=5)
+        usuario = User.objects.create_user('instrumentado', password='x')
+        PerfilFarmacia.objects.create(user=usuario, farmacia_id=FARMACIA)
+        cliente = cliente_de_farmacia(usuario, FARMACIA)
+
+        with self.assertLogs('core.instrumentacion', 'INFO') as logs:
+            with CaptureQueriesContext(connection) as consultas:
+                respuesta = cliente.get('/datos-brutos/')
+            num_consultas = len(consultas)
+            # Segunda vez: los datos salen de la caché
+            segunda = cliente.get('/datos-brutos/')
+
+        timing = respuesta['Server-Timing']
+        self.assertRegex(timing, rf'db;dur=[\d.]+;desc="{num_consultas} consultas"')
+        self.assertRegex(timing, r'tpl;dur=[\d.]+')
+        self.assertRegex(timing, r'cache;desc="0 aciertos / [1-9]\d* fallos"')
+        self.assertRegex(timing, r'total;dur=[\d.]+')
+        self.assertRegex(segunda['Server-Timing'], r'cache;desc="[1-9]\d* aciertos / 0 fallos"')
+
+        linea = json.loads(logs.records[0].getMessage())
+        self.assertEqual(
+            (linea['vista'], linea['consultas'], linea['farmacia']), ('datos_brutos', num_consultas, FARMACIA),
+        )
+        vistas = {f['vista']: f for f in instrumentacion.resumen_por_vista()}
+        self.assertEqual(vistas['datos_brutos']['n'], 2)
+
+    def test_sin_instrumentacion_no_hay_cabecera(self):
+        self.assertFalse(self.client.get('/login/').has_header('Server-Timing'))
+
+    @override_settings(METRICAS_VOLCADO_S=60)
+    def test_percentiles_por_vista(self):
+        instrumentacion.volcar_muestras()
+        for ms in range(1, 101):
+            instrumentacion._guardar_muestra('vista_x', {
+                'total_ms': ms, 'consultas': 3, 'bd_ms': 1.0, 'databricks_ms': 0, 'plantillas_ms': 2.0,
+            })
+        # Aún en la memoria del proceso: nada escrito en la caché compartida
+        self.assertIsNone(cache.get(instrumentacion._CLAVE_VISTAS))
+
+        fila, = instrumentacion.resumen_por_vista()
+        self.assertEqual(fila, {
+            'vista': 'vista_x', 'n': 100, 'p50_ms': 50.5, 'p95_ms': 95.0, 'p99_ms': 99.0, 'max_ms': 100,
+            'consultas': 3.0, 'bd_ms': 1.0, 'plantillas_ms': 2.0,
+        })
+
+    def test_ventana_de_varios_volcados(self):
+        # Cada volcado (de este u otro worker) es un lote nuevo; el resumen usa los más recientes
+        for lote in range(3):
+            for ms in range(100):
+                instrumentacion._guardar_muestra('vista_x', {
+                    'total_ms': lote * 100 + ms, 'consultas': 0, 'bd_ms': 0, 'databricks_ms': 0, 'plantillas_ms': 0,
+                })
+            instrumentacion.volcar_muestras()
+
+        with mock.patch.object(instrumentacion, 'MUESTRAS_POR_VISTA', 250):
+            fila, = instrumentacion.resumen_por_vista()
+        self.assertEqual((fila['n'], fila['max_ms']), (250, 299))
+        self.assertEqual(instrumentacion.resumen_por_vista()[0]['n'], 300)
+
+        instrumentacion.reiniciar_resumen()
+        self.assertEqual(instrumentacion.resumen_por_vista(), [])
+
+
+class PerfiladorTests(TestCase):
+    """Perfilado bajo demanda (core/perfilador.py) y descarga desde el admin."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cargar_en_django([FARMACIA], grupos_ah=10, ids_efp=ids_grupos_efp(1), semilla=6)
+        cls.usuario = User.objects.create_user('sin_staff', password='x')
+        PerfilFarmacia.objects.create(user=cls.usuario, farmacia_id=FARMACIA)
+        cls.staff = User.objects.create_superuser('perfilador', password='x')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_sin_staff_no_se_perfila(self):
+        respuesta = cliente_de_farmacia(self.usuario, FARMACIA).get('/datos-brutos/?_perfil=1')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertFalse(respuesta.has_header('X-Perfil-Id'))
+        self.assertFalse(PerfilPeticion.objects.exists())
+
+    @override_settings(PERFIL_INTERVALO_MS=0.5)
+    def test_staff_muestreo(self):
+        cliente = cliente_de_farmacia(self.staff, FARMACIA)
+        respuesta = cliente.get('/datos-brutos/?_perfil=1')
+
+        perfil = PerfilPeticion.objects.get(pk=respuesta['X-Perfil-Id'])
+        self.assertEqual((perfil.modo, perfil.vista, perfil.estado, perfil.aleatorio),
+                         ('muestreo', 'datos_brutos', 200, False))
+        self.assertEqual((perfil.usuario, perfil.farmacia_id), (self.staff, FARMACIA))
+        self.assertGreater(perfil.num_consultas, 0)
+        self.assertEqual(perfil.num_consultas, len(perfil.consultas))
+        self.assertIsNone(perfil.pstats)
+
+        descarga = cliente.get(reverse('admin:core_perfilpeticion_descargar', args=[perfil.pk, 'sql']))
+        self.assertEqual(json.loads(descarga.content), perfil.consultas)
+        self.assertIn('attachment', descarga['Content-Disposition'])
+
+    def test_staff_cprofile_y_descarga(self):
+        cliente = cliente_de_farmacia(self.staff, FARMACIA)
+        respuesta = cliente.get('/datos-brutos/', HTTP_X_PERFIL='cprofile')
+
+        perfil = PerfilPeticion.objects.get(pk=respuesta['X-Perfil-Id'])
+        self.assertEqual(perfil.modo, 'determinista')
+        self.assertTrue(any(f['funcion'].startswith('datos_brutos (core/views.py') for f in perfil.funciones))
+
+        descarga = cliente.get(reverse('admin:core_perfilpeticion_descargar', args=[perfil.pk, 'pstats']))
+        with tempfile.NamedTemporaryFile(suffix='.prof') as fichero:
+            fichero.write(descarga.content)
+            fichero.flush()
+            self.assertTrue(pstats.Stats(fichero.name).stats)
+        # Un perfil de cProfile no tiene pilas colapsadas
+        self.assertEqual(
+            cliente.get(reverse('admin:core_perfilpeticion_descargar', args=[perfil.pk, 'pilas'])).status_code, 404,
+        )
+
+    def test_descarga_exige_permiso_de_ver_perfiles(self):
+        perfil = PerfilPeticion.objects.get(
+            pk=cliente_de_farmacia(self.staff, FARMACIA).get('/datos-brutos/?_perfil=1')['X-Perfil-Id']
+        )
+        url = reverse('admin:core_perfilpeticion_descargar', args=[perfil.pk, 'sql'])
+        staff = User.objects.create_user('staff_sin_permisos', password='x', is_staff=True)
+        self.assertEqual(cliente_de_farmacia(staff, FARMACIA).get(url).status_code, 403)
+
+        staff.user_permissions.add(Permission.objects.get(codename='view_perfilpeticion'))
+        staff = User.objects.get(pk=staff.pk)  # Sin la caché de permisos
+        self.assertEqual(cliente_de_farmacia(staff, FARMACIA).get(url).status_code, 200)
+
+    @override_settings(PERFIL_FRACCION_ALEATORIA=1.0)
+    def test_fraccion_aleatoria(self):
+        respuesta = cliente_de_farmacia(self.usuario, FARMACIA).get('/datos-brutos/')
+        self.assertFalse(respuesta.has_header('X-Perfil-Id'))
+        self.assertTrue(PerfilPeticion.objects.get().aleatorio)
+
+    @override_settings(PERFIL_MAX_GUARDADOS=3)
+    def test_recorta_el_historico(self):
+        cliente = cliente_de_farmacia(self.staff, FARMACIA)
+        ids = [int(cliente.get('/datos-brutos/?_perfil=1')['X-Perfil-Id']) for _ in range(5)]
+        self.assertEqual(sorted(PerfilPeticion.objects.values_list('id', flat=True)), ids[-3:])
+
+
+class PreferenciasMasivasTests(TestCase):
+    """Exportar/importar CSV, copiar entre farmacias y el `next` de los formularios."""
+
+    OTRA = 'HFTEST2'
+
+    @classmethod
+    def setUpTestData(cls):
+        cargar_en_django([FARMACIA, cls.OTRA], grupos_ah=12, fraccion_preferencias=0.5, semilla=3)
+        cls.usuario = User.objects.create_user('preferencias', password='x')
+        cls.staff = User.objects.create_user('preferencias_staff', password='x', is_staff=True)
+
+    @staticmethod
+    def preferencias(farmacia_id):
+        return set(Preferencia.objects.filter(farmacia_id=farmacia_id).values_list(
+            'grupo_homogeneo', 'laboratorio_preferente', 'activo'
+        ))
+
+    def test_exportar_e_importar_csv(self):
+        cliente = cliente_de_farmacia(self.usuario, FARMACIA)
+        antes = self.preferencias(FARMACIA)
+        self.assertTrue(antes)
+
+        respuesta = cliente.get(reverse('exportar_preferencias'))
+        self.assertEqual(respuesta['Content-Type'], 'text/csv; charset=utf-8')
+        Preferencia.objects.filter(farmacia_id=FARMACIA).delete()
+
+        archivo = SimpleUploadedFile('preferencias.csv', b'\xef\xbb\xbf' + respuesta.content)  # Con BOM, como Excel
+        respuesta = cliente.post(reverse('importar_preferencias'), {'archivo': archivo})
+        self.assertRedirects(respuesta, reverse('configuracion'), fetch_redirect_response=False)
+        self.assertEqual(self.preferencias(FARMACIA), antes)
+
+    def test_importar_csv_no_utf8(self):
+        cliente = cliente_de_farmacia(self.usuario, FARMACIA)
+        antes = self.preferencias(FARMACIA)
+        archivo = SimpleUploadedFile('preferencias.csv', 'grupo_homogeneo\nÑ'.encode('latin-1'))
+        respuesta = cliente.post(reverse('importar_preferencias'), {'archivo': archivo}, follow=True)
+        self.assertContains(respuesta, 'UTF-8')
+        self.assertEqual(self.preferencias(FARMACIA), antes)
+
+    def test_copiar_preferencias(self):
+        Preferencia.objects.filter(farmacia_id=self.OTRA).delete()
+        origen = {g: (lab, activo) for g, lab, activo in self.preferencias(FARMACIA)}
+
+        resultados = copiar_preferencias(FARMACIA, [self.OTRA, FARMACIA])
+        # La farmacia de origen no se copia sobre sí misma
+        self.assertEqual(list(resultados), [self.OTRA])
+        aplicadas, errores = resultados[self.OTRA]
+        self.assertEqual(aplicadas + len(errores), len(origen))
+        copiadas = self.preferencias(self.OTRA)
+        self.assertEqual(len(copiadas), aplicadas)
+        for grupo, laboratorio, activo in copiadas:
+            self.assertEqual(origen[grupo], (laboratorio, activo))
+
+    def test_copiar_solo_staff(self):
+        Preferencia.objects.filter(farmacia_id=self.OTRA).delete()
+        datos = {'destinos': f' {self.OTRA} , '}
+
+        respuesta = cliente_de_farmacia(self.usuario, FARMACIA).post(reverse('copiar_preferencias'), datos)
+        self.assertEqual(respuesta.status_code, 302)
+        self.assertFalse(self.preferencias(self.OTRA))
+
+        respuesta = cliente_de_farmacia(self.staff, FARMACIA).post(reverse('copiar_preferencias'), datos)
+        self.assertRedirects(respuesta, reverse('configuracion'), fetch_redirect_response=False)
+        self.assertTrue(self.preferencias(self.OTRA))
+
+    def test_next_solo_del_propio_sitio(self):
+        cliente = cliente_de_farmacia(self.usuario, FARMACIA)
+        for siguiente, destino in (
+            ('/datos-brutos/?pagina=2', '/datos-brutos/?pagina=2'),
+            ('https://evil.example/', reverse('configuracion')),
+            ('//evil.example/', reverse('configuracion')),
+            ('', reverse('configuracion')),
+        ):
+            with self.subTest(next=siguiente):
+                respuesta = cliente.post(reverse('preferencias_masivo'), {'next': siguiente})
+                self.assertRedirects(respuesta, destino, fetch_redirect_response=False)
+
+
+class ComprobacionesArranqueTests(SimpleTestCase):
+
+    @override_settings(DEBUG=False, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_locmem_sin_debug_es_un_error(self):
+        self.assertEqual([e.id for e in comprobar_cache_compartida(None)], ['core.E001'])
+        with mock.patch.dict('os.environ', {'WEB_CONCURRENCY': '1'}):
+            self.assertEqual(comprobar_cache_compartida(None), [])
+
+    def test_la_cache_por_defecto_es_compartida(self):
+        self.assertEqual(comprobar_cache_compartida(None), [])
+
+
+class DatosSinteticosTests(TestCase):
+
+    def test_datos_reproducibles_por_farmacia(self):
+        ids_efp = ids_grupos_efp(2)
+        una = generar_farmacia('HF280050002', 20, ids_efp, semilla=7)
+        otra = generar_farmacia('HF280050002', 20, ids_efp, semilla=7)
+        self.assertEqual(
+            [(o.grupo_homogeneo, o.a_sustituir, o.ahorro_potencial) for o in una['ah']],
+            [(o.grupo_homogeneo, o.a_sustituir, o.ahorro_potencial) for o in otra['ah']],
+        )
+        self.assertEqual({o.familia for o in una['efp']}, {'SISTEMA RESPIRATORIO', 'SISTEMA DIGESTIVO'})
+
+    def test_carga_masiva(self):
+        farmacias = ids_farmacias(3)
+        totales = cargar_en_django(farmacias, grupos_ah=30, ids_efp=ids_grupos_efp(1), fraccion_preferencias=0.5)
+
+        self.assertEqual(totales['ah'], 90)
+        self.assertEqual(Oportunidad.objects.filter(farmacia_id__in=farmacias).count(), 90)
+        self.assertEqual(Preferencia.objects.count(), totales['preferencias'])
+        oportunidad = Oportunidad.objects.filter(farmacia_id='HF280050001').first()
+        self.assertEqual(len(oportunidad.get_competidores_stats()), 5)
+
+
+# Farmacias de las pruebas de número de consultas: misma forma de datos, volumen muy distinto
+PEQUENA, GRANDE = 'HF280050001', 'HF280050002'
+
+
+class NumeroConsultasMixin(WarehouseLocalMixin):
+    """
+    Cota de consultas SQL por vista, con la caché vacía y a dos escalas.
+
+    La farmacia pequeña tiene 8 grupos AH, 2 competidores y una familia EFP; la
+    grande, 150 grupos, 6 competidores y las 14 familias (ambas con la mitad de
+    grupos con preferencia). Una vista correcta hace las mismas consultas en las
+    dos: si el número crece con los datos hay un N+1.
+
+    Las sesiones van en cookies firmadas: se cuentan las consultas de la
+    vista, no las de guardar la sesión (dependen de SESSION_BACKEND).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        ajustes = override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+        ajustes.enable()
+        cls.addClassCleanup(ajustes.disable)
+
+    @classmethod
+    def setUpTestData(cls):
+        cargar_en_django([PEQUENA], grupos_ah=8, ids_efp=ids_grupos_efp(1), competidores=2,
+                         fraccion_preferencias=0.5, semilla=1)
+        cargar_en_django([GRANDE], grupos_ah=150, ids_efp=ids_grupos_efp(14), competidores=6,
+                         fraccion_preferencias=0.5, semilla=2)
+        cls.usuarios = {}
+        for farmacia_id in (PEQUENA, GRANDE):
+            usuario = User.objects.create_user(f'consultas_{farmacia_id}', password='x')
+            PerfilFarmacia.objects.create(user=usuario, farmacia_id=farmacia_id)
+            cls.usuarios[farmacia_id] = usuario
+
+    def contar_consultas(self, farmacia_id, metodo, url, datos=None, preparar=None, **extra):
+        """
+        Consultas SQL de una petición con la caché recién vaciada.
+
+        Args:
+            preparar (callable): Recibe el cliente y se ejecuta antes de medir (p. ej. pedir la pregunta)
+
+        Returns:
+            int: Número de consultas
+        """
+        cache.clear()
+        cliente = cliente_de_farmacia(self.usuarios[farmacia_id], farmacia_id)
+        if preparar:
+            preparar(cliente)
+        with CaptureQueriesContext(connection) as consultas:
+            if datos is None:
+                respuesta = getattr(cliente, metodo)(url, **extra)
+            else:
+                respuesta = getattr(cliente, metodo)(url, datos, **extra)
+        self.assertLess(respuesta.status_code, 400, f"{metodo.upper()} {url} -> {respuesta.status_code}")
+        return len(consultas)
+
+    def assertConsultasConstantes(self, maximo, metodo, url, datos=None, **extra):
+        """
+        Comprueba que la petición hace las mismas consultas en las dos farmacias y no más de `maximo`.
+
+        `url` y `datos` pueden ser funciones de la farmacia (para usar sus pk o grupos).
+        """
+        por_farmacia = {}
+        for farmacia_id in (PEQUENA, GRANDE):
+            por_farmacia[farmacia_id] = self.contar_consultas(
+                farmacia_id, metodo,
+                url(farmacia_id) if callable(url) else url,
+                datos(farmacia_id) if callable(datos) else datos,
+                **extra,
+            )
+        self.assertEqual(
+            por_farmacia[PEQUENA], por_farmacia[GRANDE], f"{url}: las consultas dependen del volumen de datos"
+        )
+        self.assertLessEqual(por_farmacia[GRANDE], maximo, f"{url}: más consultas de las esperadas")
+
+
+class NumeroConsultasAHTests(NumeroConsultasMixin, TestCase):
+
+    def test_vistas_de_lectura(self):
+        for url, maximo in (
+            ('/', 9),
+            ('/buscador/?q=OMEPRAZOL', 3),
+            ('/datos-brutos/', 3),
+            ('/entrenamiento/', 5),
+            ('/examen/', 4),
+            ('/configuracion/', 5),
+            ('/configuracion/exportar/', 2),
+        ):
+            with self.subTest(url=url):
+                self.assertConsultasConstantes(maximo, 'get', url)
+
+    def test_opciones_configuracion(self):
+        self.assertConsultasConstantes(
+            2, 'get',
+            lambda f: f"/configuracion/opciones/{Oportunidad.objects.filter(farmacia_id=f).first().pk}/",
+        )
+
+    def test_fragmento_competidores(self):
+        for formato in ('tooltip', 'tabla'):
+            with self.subTest(formato=formato):
+                self.assertConsultasConstantes(
+                    2, 'get',
+                    lambda f: f"/fragmentos/competidores/{Oportunidad.objects.filter(farmacia_id=f).first().pk}/"
+                              f"?formato={formato}",
+                )
+
+    def test_fragmentos_fuera_de_la_pagina(self):
+        cliente = cliente_de_farmacia(self.usuarios[GRANDE], GRANDE)
+        oportunidad = Oportunidad.objects.filter(farmacia_id=GRANDE).order_by('-ahorro_potencial').first()
+        competidor = next(c for c in oportunidad.get_competidores_stats() if not c['es_campeon'])
+
+        # La página solo lleva el resumen y la URL del desglose
+        pagina = cliente.get('/datos-brutos/').content.decode()
+        self.assertNotIn(f"CN: {competidor['cn']}", pagina)
+        url = f"/fragmentos/competidores/{oportunidad.pk}/?formato=tabla&amp;v={obtener_version(GRANDE)}"
+        self.assertIn(url, pagina)
+
+        fragmento = cliente.get(url.replace('&amp;', '&'))
+        self.assertContains(fragmento, competidor['nombre'])
+        self.assertIn('private', fragmento['Cache-Control'])
+        # Versión antigua o sin versión: no se guarda en el navegador
+        self.assertFalse(cliente.get(f"/fragmentos/competidores/{oportunidad.pk}/").has_header('Cache-Control'))
+
+        otra = Oportunidad.objects.filter(farmacia_id=PEQUENA).first()
+        self.assertEqual(cliente.get(f"/fragmentos/competidores/{otra.pk}/").status_code, 404)
+        self.assertEqual(cliente.get(f"/fragmentos/competidores/{oportunidad.pk}/?formato=x").status_code, 404)
+
+    def test_responder_examen(self):
+        self.assertConsultasConstantes(1, 'post', '/examen/', {'opcion': 0}, preparar=lambda c: c.get('/examen/'))
+
+    def test_preferencias_masivo(self):
+        # Un cambio por grupo: la grande guarda casi 20 veces más preferencias en las mismas consultas
+        def cambios(farmacia_id):
+            return {'preferencias': [
+                {'grupo': o.grupo_homogeneo, 'producto': o.producto_recomendado, 'activo': True}
+                for o in Oportunidad.objects.filter(farmacia_id=farmacia_id)
+            ]}
+        self.assertConsultasConstantes(
+            6, 'post', '/configuracion/masivo/', cambios, content_type='application/json',
+        )
+
+    def test_importar(self):
+        # Solo staff puede importar
+        User.objects.filter(pk__in=[u.pk for u in self.usuarios.values()]).update(is_staff=True)
+        # Las dos farmacias están en el warehouse local: la sincronización reescribe la pequeña y la grande
+        self.assertConsultasConstantes(
+            27, 'post', '/importar/', lambda f: {'farmacia_input': f, 'fecha_inicio': '2024-01-01',
+                                                 'fecha_fin': '2024-12-31'},
+        )
+
+    def test_dashboard_de_administracion(self):
+        admin = User.objects.create_superuser('consultas_admin', password='x')
+        self.usuarios = {PEQUENA: admin, GRANDE: admin}
+        # Con la caché vacía el selector sale de las farmacias locales (un DISTINCT
+        # que queda cacheado) en lugar de esperar a la lista de Databricks
+        self.assertConsultasConstantes(9, 'get', '/')
+
+    def test_dashboard_de_administracion_no_espera_a_databricks(self):
+        admin = User.objects.create_superuser('consultas_admin', password='x')
+        cache.clear()
+        cliente = cliente_de_farmacia(admin, GRANDE)
+        with mock.patch('core.services.obtener_farmacias_cloud') as warehouse:
+            html = cliente.get('/').content.decode()
+            warehouse.assert_not_called()
+        # Selector con las farmacias locales y la lista de Databricks pedida desde el navegador
+        self.assertIn(f'value="{PEQUENA}"', html)
+        self.assertIn(reverse('farmacias_cloud'), html)
+
+        cache.set(CLAVE_FARMACIAS_CLOUD, ['HF999'], 60)
+        html = cliente.get('/').content.decode()
+        self.assertIn('value="HF999"', html)
+        self.assertNotIn(reverse('farmacias_cloud'), html)
+
+    def test_importar_no_espera_a_databricks(self):
+        admin = User.objects.create_superuser('importar_admin', password='x')
+        cache.clear()
+        cliente = cliente_de_farmacia(admin, GRANDE)
+        with mock.patch('core.services.obtener_farmacias_cloud') as warehouse:
+            html = cliente.get('/importar/').content.decode()
+            warehouse.assert_not_called()
+        self.assertIn('Cargando farmacias de Databricks', html)
+        self.assertIn(f'cargarFarmacias("{reverse("farmacias_cloud")}")', html)
+
+    def test_context_processor_cacheado(self):
+        cliente = cliente_de_farmacia(self.usuarios[GRANDE], GRANDE)
+        cliente.get('/buscador/?q=OMEPRAZOL')
+        with CaptureQueriesContext(connection) as consultas:
+            cliente.get('/buscador/?q=OMEPRAZOL')
+        sql = ' '.join(c['sql'] for c in consultas)
+        self.assertNotIn('DISTINCT', sql)
+        self.assertNotIn('RANDOM()', sql)
+
+
+class ImportacionAsincronaTests(WarehouseLocalMixin, TransactionTestCase):
+    """Vistas async de importación: el trabajo corre en el pool del warehouse (otro hilo y otra conexión)."""
+
+    def setUp(self):
+        cache.clear()
+        self.usuario = User.objects.create_user('asincrono', password='x', is_staff=True)
+        self.client.force_login(self.usuario)
+
+    def esperar(self, url, segundos=60):
+        limite = time.monotonic() + segundos
+        while time.monotonic() < limite:
+            estado = self.client.get(url).json()
+            if estado['estado'] in ('terminado', 'error'):
+                return estado
+            time.sleep(0.1)
+        self.fail(f"El trabajo no ha terminado en {segundos} s")
+
+    def test_cadena_de_middlewares_asincrona(self):
+        # Si algún middleware solo fuera síncrono, Django adaptaría la cadena (un hilo por petición)
+        with self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    def test_lanza_importacion_y_consulta_progreso(self):
+        farmacia = FARMACIAS_DEMO[1]
+        respuesta = self.client.post('/importar/lanzar/', {
+            'farmacia_input': farmacia, 'fecha_inicio': '2024-01-01', 'fecha_fin': '2024-12-31',
+        })
+        self.assertEqual(respuesta.status_code, 202)
+
+        estado = self.esperar(respuesta.json()['estado_url'])
+        self.assertEqual(estado['estado'], 'terminado', estado)
+        self.assertEqual(estado['resultado']['errores'], {})
+        self.assertEqual(Oportunidad.objects.filter(farmacia_id=farmacia).count(), estado['resultado']['ah'])
+        self.assertEqual(self.client.session['farmacia_activa'], farmacia)
+
+        # El progreso solo lo ve quien lanzó la importación
+        self.client.force_login(User.objects.create_user('otro', password='x', is_staff=True))
+        self.assertEqual(self.client.get(respuesta.json()['estado_url']).status_code, 404)
+
+    def test_importar_solo_staff(self):
+        self.client.force_login(User.objects.create_user('sin_staff', password='x'))
+        datos = {'farmacia_input': FARMACIAS_DEMO[0], 'fecha_inicio': '2024-01-01', 'fecha_fin': '2024-12-31'}
+        for metodo, url in (
+            ('post', '/importar/'), ('get', '/importar/'), ('post', '/importar/lanzar/'),
+            ('get', '/importar/trabajos/x/'), ('get', '/importar/farmacias/'),
+        ):
+            with self.subTest(url=url, metodo=metodo):
+                respuesta = getattr(self.client, metodo)(url, datos if metodo == 'post' else None)
+                self.assertEqual(respuesta.status_code, 302)
+                self.assertIn('/admin/login/', respuesta['Location'])
+        self.assertFalse(Oportunidad.objects.exists())
+
+    def test_faltan_campos(self):
+        respuesta = self.client.post('/importar/lanzar/', {'farmacia_input': FARMACIAS_DEMO[0]})
+        self.assertEqual(respuesta.status_code, 400)
+
+    def test_refrescar_lista_de_farmacias(self):
+        datos = self.client.get('/importar/farmacias/?refrescar=1').json()
+        self.assertIsNone(datos['error'])
+        self.assertEqual(sorted(datos['farmacias']), sorted(FARMACIAS_DEMO))
+
+
+class ArranqueTests(SimpleTestCase):
+
+    def test_el_worker_no_importa_el_conector_de_databricks(self):
+        # Un proceso nuevo que carga la aplicación y todas las vistas, como un worker de gunicorn
+        self.assertFalse(medir_arranque()['databricks'])
+
+    def test_el_worker_no_importa_los_benchmarks(self):
+        # El middleware de instrumentación no debe arrastrar core.benchmarks ni django.test
+        self.assertFalse(medir_arranque()['benchmarks'])
+
+
+class FicherosEstaticosYMediaTests(SimpleTestCase):
+
+    def setUp(self):
+        directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directorio)
+        self.media = Path(directorio) / 'media'
+        (self.media / 'efp_imagenes' / 'variantes').mkdir(parents=True)
+        (self.media / 'efp_imagenes' / '700000.jpg').write_bytes(b'foto')
+        (self.media / 'efp_imagenes' / 'variantes' / '700000-64.0123456789.webp').write_bytes(b'variante')
+        (self.media / 'efp_imagenes' / 'manifiesto.json').write_text('{}')
+        (self.media / 'efp_imagenes' / 'variantes' / 'variantes.json').write_text('{}')
+        (self.media / 'privado.jpg').write_bytes(b'otra')
+        estaticos = Path(directorio) / 'static'
+        estaticos.mkdir()
+        ajustes = override_settings(MEDIA_ROOT=str(self.media), STATIC_ROOT=str(estaticos))
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+
+    def test_media_con_etag_y_cache(self):
+        respuesta = self.client.get('/media/efp_imagenes/700000.jpg')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(b''.join(respuesta.streaming_content), b'foto')
+        self.assertEqual(respuesta['Content-Type'], 'image/jpeg')
+        self.assertIn(f'max-age={settings.MEDIA_MAX_AGE}', respuesta['Cache-Control'])
+        self.assertNotIn('immutable', respuesta['Cache-Control'])
+
+        # Visita repetida: 304 sin cuerpo
+        repetida = self.client.get('/media/efp_imagenes/700000.jpg', HTTP_IF_NONE_MATCH=respuesta['ETag'])
+        self.assertEqual(repetida.status_code, 304)
+        self.assertEqual(repetida['ETag'], respuesta['ETag'])
+
+        variante = self.client.get('/media/efp_imagenes/variantes/700000-64.0123456789.webp')
+        self.assertIn('immutable', variante['Cache-Control'])
+        self.assertEqual(variante['Content-Type'], 'image/webp')
+
+    def test_media_rechaza_rutas_fuera_de_media_root(self):
+        for url in ('/media/efp_imagenes/799999.jpg', '/media/../config/settings.py', '/media/efp_imagenes/'):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+        self.assertEqual(self.client.post('/media/efp_imagenes/700000.jpg').status_code, 405)
+
+    def test_media_solo_sirve_fotos(self):
+        for url in (
+            '/media/efp_imagenes/manifiesto.json',
+            '/media/efp_imagenes/variantes/variantes.json',
+            '/media/privado.jpg',
+            '/media/efp_imagenes/../privado.jpg',
+        ):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+
+    @override_settings(MEDIA_X_ACCEL_REDIRECT='/media-interna/')
+    def test_media_delega_en_nginx(self):
+        respuesta = self.client.get('/media/efp_imagenes/700000.jpg')
+        self.assertEqual(respuesta['X-Accel-Redirect'], '/media-interna/efp_imagenes/700000.jpg')
+        self.assertEqual(respuesta.content, b'')
+        self.assertIn('ETag', respuesta)
+
+    def test_estaticos_con_hash_precomprimidos_e_inmutables(self):
+        from django.contrib.staticfiles.storage import staticfiles_storage
+        from django.core.management import call_command
+
+        call_command('collectstatic', '--noinput', verbosity=0)
+        nombre = staticfiles_storage.stored_name('admin/css/base.css')
+        self.assertRegex(nombre, r'^admin/css/base\.[0-9a-f]{12}\.css$')
+
+        respuesta = self.client.get(f'/static/{nombre}', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', respuesta['Cache-Control'])
+
+
+class CompresionTests(SimpleTestCase):
+    HTML = '<html>\n    <body>\n' + '        <td class="text-end">1.234,56 €</td>\n' * 200 + '    </body>\n</html>'
+
+    def comprimir(self, respuesta, accept_encoding='gzip, deflate, br'):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return CompresionMiddleware(lambda r: respuesta)(request)
+
+    def test_gzip_y_umbral(self):
+        respuesta = self.comprimir(HttpResponse(self.HTML))
+        self.assertIn(respuesta['Content-Encoding'], ('gzip', 'br'))
+        self.assertIn('Accept-Encoding', respuesta['Vary'])
+        self.assertEqual(int(respuesta['Content-Length']), len(respuesta.content))
+        respuesta = self.comprimir(HttpResponse(self.HTML), 'gzip')
+        self.assertEqual(gzip.decompress(respuesta.content).decode(), self.HTML)
+
+        self.assertFalse(self.comprimir(HttpResponse('<p>corta</p>')).has_header('Content-Encoding'))
+        self.assertFalse(self.comprimir(HttpResponse(self.HTML), 'gzip;q=0, identity').has_header('Content-Encoding'))
+        self.assertFalse(
+            self.comprimir(HttpResponse(b'\xff' * 5000, content_type='image/jpeg')).has_header('Content-Encoding')
+        )
+
+    def test_streaming_sincrono_y_asincrono(self):
+        partes = [f'fila {i};'.encode() * 50 for i in range(20)]
+        respuesta = self.comprimir(StreamingHttpResponse(iter(partes), content_type='text/csv'), 'gzip')
+        self.assertEqual(respuesta['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(respuesta.streaming_content)), b''.join(partes))
+
+        async def generar():
+            for parte in partes:
+                yield parte
+
+        async def leer(respuesta):
+            return b''.join([parte async for parte in respuesta.streaming_content])
+
+        respuesta = self.comprimir(StreamingHttpResponse(generar(), content_type='text/csv'), 'gzip')
+        self.assertEqual(gzip.decompress(asyncio.run(leer(respuesta))), b''.join(partes))
+
+    def test_elegir_codificacion(self):
+        self.assertIsNone(elegir_codificacion(''))
+        self.assertIsNone(elegir_codificacion('identity'))
+        self.assertEqual(elegir_codificacion('gzip;q=0.5, br;q=0'), 'gzip')
+        self.assertEqual(elegir_codificacion('*'), elegir_codificacion('gzip, br'))
+        with mock.patch('core.compresion.brotli', object()):
+            self.assertEqual(elegir_codificacion('gzip, br'), 'br')
+            self.assertEqual(elegir_codificacion('gzip, br', permitir_brotli=False), 'gzip')
+            self.assertIsNone(elegir_codificacion('br', permitir_brotli=False))
+
+    def test_relleno_aleatorio_contra_breach(self):
+        # Como GZipMiddleware: la misma página no comprime siempre al mismo tamaño
+        tamanos = set()
+        for _ in range(20):
+            respuesta = self.comprimir(HttpResponse(self.HTML), 'gzip')
+            self.assertEqual(gzip.decompress(respuesta.content).decode(), self.HTML)
+            tamanos.add(len(respuesta.content))
+        self.assertGreater(len(tamanos), 1)
+
+    def test_pagina_con_token_csrf_sin_brotli(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='br, gzip')
+        with mock.patch('core.compresion.elegir_codificacion', wraps=elegir_codificacion) as elegir:
+            CompresionMiddleware(lambda r: HttpResponse(self.HTML))(request)
+            self.assertTrue(elegir.call_args.kwargs['permitir_brotli'])
+
+            get_token(request)
+            respuesta = CompresionMiddleware(lambda r: HttpResponse(self.HTML))(request)
+            self.assertFalse(elegir.call_args.kwargs['permitir_brotli'])
+        self.assertEqual(respuesta['Content-Encoding'], 'gzip')
+
+    def test_minificar_respeta_pre_y_script(self):
+        html = '<div>\n    <p>a</p>\n\n    <pre>\n    x\n</pre>\n  <script>\n    var t = `\n  y`;\n</script>\n</div>'
+        self.assertEqual(
+            minificar_html(html),
+            '<div>\n<p>a</p>\n<pre>\n    x\n</pre>\n<script>\n    var t = `\n  y`;\n</script>\n</div>',
+        )
+
+    @override_settings(MINIFICAR_HTML=True)
+    def test_minificar_debilita_el_etag(self):
+        original = HttpResponse(self.HTML)
+        original['ETag'] = '"abc"'
+        respuesta = self.comprimir(original, 'identity')
+        self.assertEqual(respuesta['ETag'], 'W/"abc"')
+        self.assertNotIn('\n        <td', respuesta.content.decode())
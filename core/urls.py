@@ -14,6 +14,17 @@ urlpatterns = [
     path('datos-brutos/', views.datos_brutos, name='datos_brutos'),
     path('examen/', views.examen, name='examen'),
     path('configuracion/', views.configuracion, name='configuracion'),
+    path('configuracion/opciones/<int:pk>/', views.opciones_configuracion, name='opciones_configuracion'),
+    path('fragmentos/competidores/<int:pk>/', views.fragmento_competidores, name='fragmento_competidores'),
+    path('configuracion/masivo/', views.preferencias_masivo, name='preferencias_masivo'),
+    path('configuracion/exportar/', views.exportar_preferencias, name='exportar_preferencias'),
+    path('configuracion/importar/', views.importar_preferencias, name='importar_preferencias'),
+    path('configuracion/copiar/', views.copiar_preferencias_view, name='copiar_preferencias'),
     path('cambiar-farmacia/', views.cambiar_farmacia, name='cambiar_farmacia'),
     path('importar/', views.importar, name='importar'),
+    path('importar/lanzar/', views.lanzar_importacion, name='lanzar_importacion'),
+    path('importar/trabajos/<str:trabajo_id>/', views.estado_importacion, name='estado_importacion'),
+    path('importar/farmacias/', views.farmacias_cloud, name='farmacias_cloud'),
+    path('rendimiento/', views.rendimiento, name='rendimiento'),
+    path('metricas/', views.metricas, name='metricas'),
 ]
\ No newline at end of file
@@ -1,15 +1,42 @@
 # core/views.py
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import JsonResponse, HttpResponse, FileResponse, Http404
+from django.urls import reverse
+from django.views.decorators.http import require_POST, require_safe
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.core.paginator import Paginator
 from django.db.models import Sum, Q
 from .models import Oportunidad, Preferencia
-from efp.models import OportunidadEFP
 from .forms import PreferenciaForm
-from .services import sincronizar_desde_databricks
-from efp.services import sincronizar_efp_desde_databricks
-from core.services import sincronizar_desde_databricks, obtener_farmacias_cloud
-import random
+from .services import (
+    resumen_dashboard, buscar_oportunidades, listar_datos_brutos, competidores_oportunidad,
+    generar_pregunta_ah, recuperar_pregunta_ah, precalentar_en_segundo_plano,
+    guardar_preferencias_masivo, exportar_preferencias_csv, leer_preferencias_csv, copiar_preferencias,
+    obtener_farmacias_cloud_cacheado, farmacias_cloud_cacheadas, farmacias_locales, importar_farmacia,
+    PREFERENCIAS_AH,
+)
+from .cache_utils import obtener_version, incrementar_version, estadisticas_cache, VISTAS_CACHEADAS
+from .metricas import EXAMEN_RESPUESTAS, exponer
+from .instrumentacion import resumen_por_vista, reiniciar_resumen, MUESTRAS_POR_VISTA
+from .estado_examen import EstadoExamen
+from .preferencias import avisar_resultado, siguiente_seguro
+from .asincrono import en_warehouse, estado_trabajo, lanzar_trabajo
+import hmac
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+from urllib.parse import quote
 
 @login_required(login_url='login')
 def dashboard(request):
@@ -17,10 +44,16 @@ def dashboard(request):
     farmacias_disponibles = []
     
     # --- 1. DETERMINAR QUÉ FARMACIA VER ---
+    cargar_farmacias_cloud = False
     if user.is_superuser or user.is_staff:
         es_admin = True
-        farmacias_disponibles, _ = obtener_farmacias_cloud()
-        
+        # Sin esperar a Databricks: lo que haya en caché o, si no hay nada, las
+        # farmacias locales mientras el navegador pide la lista a `farmacias_cloud`
+        farmacias_disponibles = farmacias_cloud_cacheadas()
+        if farmacias_disponibles is None:
+            farmacias_disponibles = farmacias_locales()
+            cargar_farmacias_cloud = True
+
         # Recuperar selección de sesión o usar la primera por defecto
         farmacia_activa = request.session.get('farmacia_activa')
         if not farmacia_activa and farmacias_disponibles:
@@ -35,45 +68,21 @@ def dashboard(request):
         except:
             return render(request, 'core/error_config.html', {'msg': 'Usuario sin farmacia asignada'})
 
-    # --- 2. OBTENER DATOS FILTRADOS ---
-    # Usamos farmacia_activa para filtrar TODO
-    oportunidades = Oportunidad.objects.filter(farmacia_id=farmacia_activa)
-    efp_data = OportunidadEFP.objects.filter(farmacia_id=farmacia_activa)
-
-    # --- 3. CÁLCULOS KPI (Fusionado de tu versión antigua) ---
-    # Ahorro total (Suma de AH + EFP)
-    ahorro_ah = oportunidades.aggregate(Sum('ahorro_potencial'))['ahorro_potencial__sum'] or 0
-    ahorro_efp = efp_data.aggregate(Sum('ahorro_potencial'))['ahorro_potencial__sum'] or 0
-    total_ahorro = ahorro_ah + ahorro_efp
-    
-    ahorro_mensual = total_ahorro / 12
-
-    # Top 5 (Solo de AH por ahora, o puedes mezclar)
-    top_5 = oportunidades.order_by('-ahorro_potencial')[:5]
-
-    total_grupos = oportunidades.count() + efp_data.count()
-
-    # Cálculo marcas a sustituir (AH)
-    total_marcas = 0
-    for op in oportunidades:
-        if op.a_sustituir:
-            total_marcas += len(op.a_sustituir.split(' || '))
-            
-    # Cálculo marcas a sustituir (EFP)
-    for op in efp_data:
-        if op.a_sustituir:
-            total_marcas += len(op.a_sustituir.split(' || '))
+    # --- 2. KPIs (cacheados por farmacia y versión de datos) ---
+    resumen = resumen_dashboard(farmacia_activa)
 
     context = {
         'farmacia_activa': farmacia_activa,
         'es_admin': es_admin,
         'farmacias_disponibles': farmacias_disponibles,
-        
-        'top_5': top_5,
-        'total_ahorro': total_ahorro,
-        'ahorro_mensual': ahorro_mensual,
-        'total_grupos': total_grupos,
-        'total_marcas': total_marcas,
+        'cargar_farmacias_cloud': cargar_farmacias_cloud,
+
+        'top_5': resumen['top_5'],
+        'total_ahorro': resumen['total_ahorro'],
+        'ahorro_mensual': resumen['ahorro_mensual'],
+        'total_grupos': resumen['total_grupos'],
+        'total_marcas': resumen['total_marcas'],
+        'version_datos': obtener_version(farmacia_activa),
         'active_tab': 'dashboard',
         'segmento': 'AH',
     }
@@ -87,6 +96,8 @@ def cambiar_farmacia(request):
         nueva_farmacia = request.POST.get('farmacia_id')
         if nueva_farmacia:
             request.session['farmacia_activa'] = nueva_farmacia
+            # Calentamos su caché en segundo plano mientras se sigue la redirección
+            precalentar_en_segundo_plano(nueva_farmacia)
     
     # Redirigimos a la página desde donde vino (o al dashboard por defecto)
     return redirect(request.META.get('HTTP_REFERER', 'dashboard'))
@@ -99,11 +110,8 @@ def buscador(request):
     resultados = []
     
     if query:
-        # Filtramos por Farmacia Y por coincidencia de texto
-        resultados = Oportunidad.objects.filter(farmacia_id=f_id).filter(
-            Q(a_sustituir__icontains=query) | 
-            Q(grupo_homogeneo__icontains=query)
-        )
+        # Filtramos por Farmacia Y por coincidencia de texto (resultado cacheado)
+        resultados = buscar_oportunidades(f_id, query)
     
     context = {
         'farmacia_activa': f_id,
@@ -134,12 +142,13 @@ def datos_brutos(request):
     # Si el parámetro no es válido, usamos el default
     orden_final = order_param if order_param in campos_validos else '-ahorro_potencial'
 
-    # 3. Consultar y Ordenar
-    datos = Oportunidad.objects.filter(farmacia_id=f_id).order_by(orden_final)
+    # 3. Consultar y Ordenar (resultado cacheado)
+    datos = listar_datos_brutos(f_id, orden_final)
     
     context = {
         'farmacia_activa': f_id,
         'datos': datos,
+        'version_datos': obtener_version(f_id),
         'active_tab': 'datos_brutos',
         'segmento': 'AH',
         'current_order': orden_final, # Pasamos el orden actual para pintar las flechas
@@ -205,41 +214,52 @@ def examen(request):
     f_id = request.session.get('farmacia_activa', 'HF280050001')
     MAX_PREGUNTAS = 10 
 
+    # Estado compacto en sesión: contadores + ids/índices (ver core/estado_examen.py)
+    estado = EstadoExamen(request.session, 'examen_ah')
+
     # 1. Reset limpio
-    if 'reset' in request.GET or 'aciertos' not in request.session:
-        request.session['aciertos'] = 0
-        request.session['total'] = 0
-        if 'pregunta_actual' in request.session:
-            del request.session['pregunta_actual']
+    if 'reset' in request.GET or not estado.iniciado:
+        estado.reiniciar()
         if 'reset' in request.GET:
             return redirect('examen')
 
     # 2. Procesar respuesta (POST) - Mostrar análisis del error
-    if request.method == 'POST' and 'opcion' in request.POST:
-        elegido = request.POST.get('opcion')
-        correcto = request.POST.get('correcto')
-        pregunta = request.POST.get('pregunta')
+    #    La opción llega como índice de la lista mostrada; la respuesta correcta
+    #    nunca sale del servidor.
+    if request.method == 'POST' and 'opcion' in request.POST and estado.pregunta:
+        pregunta = recuperar_pregunta_ah(f_id, *estado.pregunta)
+        try:
+            idx_elegido = int(request.POST.get('opcion'))
+        except (TypeError, ValueError):
+            idx_elegido = -1
         
-        if elegido and correcto:
-            request.session['total'] += 1 
+        if pregunta and 0 <= idx_elegido < len(pregunta['opciones']):
+            elegido = pregunta['opciones'][idx_elegido]
+            correcto = pregunta['respuesta_correcta']
+            marca_ask = pregunta['item'].grupo_homogeneo
+
+            estado.total += 1 
+            EXAMEN_RESPUESTAS.inc(examen='ah', resultado='acierto' if elegido == correcto else 'fallo')
             if elegido == correcto:
-                request.session['aciertos'] += 1
+                estado.aciertos += 1
                 mensaje = "¡Correcto! Has elegido la opción más rentable del grupo."
                 es_correcto = True
             else:
-                mensaje = f"Incorrecto. El paciente pide: {pregunta}. Tú elegiste: {elegido}. La opción óptima es: {correcto}"
+                mensaje = f"Incorrecto. El paciente pide: {marca_ask}. Tú elegiste: {elegido}. La opción óptima es: {correcto}"
                 es_correcto = False
+            estado.pregunta = None
+            estado.guardar()
             
             # Mostrar análisis inmediatamente
             context = {
                 'farmacia_activa': f_id,
                 'mensaje': mensaje,
                 'es_correcto': es_correcto,
-                'marca_ask': pregunta,
+                'marca_ask': marca_ask,
                 'seleccion_usuario': elegido,
                 'respuesta_correcta': correcto,
-                'aciertos': request.session['aciertos'],
-                'total': request.session['total'],
+                'aciertos': estado.aciertos,
+                'total': estado.total,
                 'mostrar_analisis_solo': True,  # Flag para mostrar SOLO análisis
                 'finalizado': False,
                 'active_tab': 'examen',
@@ -248,15 +268,15 @@ def examen(request):
             return render(request, 'core/examen.html', context)
 
     # 3. Game Over
-    if request.session['total'] >= MAX_PREGUNTAS and request.method == 'GET':
-        score = (request.session['aciertos'] / MAX_PREGUNTAS) * 100
+    if estado.total >= MAX_PREGUNTAS and request.method == 'GET':
+        score = (estado.aciertos / MAX_PREGUNTAS) * 100
         if score == 100: feedback = "¡Increíble! Eres un maestro de la sustitución."
         elif score >= 50: feedback = "Bien, pero sigue practicando."
         else: feedback = "Necesitas repasar."
         
         context = {
             'finalizado': True,
-            'aciertos': request.session['aciertos'],
+            'aciertos': estado.aciertos,
             'total': MAX_PREGUNTAS,
             'score': score,
             'feedback': feedback,
@@ -265,60 +285,24 @@ def examen(request):
         }
         return render(request, 'core/examen.html', context)
     
-    # 4. GENERAR NUEVA PREGUNTA (Solo en GET, no en POST)
-    items_qs = Oportunidad.objects.filter(farmacia_id=f_id)
-    
-    item_valido = None
-    distractores_reales = []
-    respuesta_correcta = ""
-    origen = ""
-
-    for _ in range(10): 
-        posible_item = items_qs.order_by('?').first()
-        if not posible_item: break
-
-        try:
-            pref = Preferencia.objects.get(
-                grupo_homogeneo=posible_item.grupo_homogeneo,
-                farmacia_id=f_id,
-                activo=True
-            )
-            respuesta_correcta = pref.laboratorio_preferente
-            origen = "Preferencia"
-        except Preferencia.DoesNotExist:
-            respuesta_correcta = posible_item.producto_recomendado
-            origen = "Algoritmo"
-
-        competencia_stats = posible_item.get_competidores_stats()
-        
-        posibles_rivales = list(set([
-            c['nombre'] for c in competencia_stats 
-            if c['nombre'].strip().upper() != respuesta_correcta.strip().upper()
-        ]))
-
-        if posibles_rivales:
-            item_valido = posible_item
-            num_distractores = min(len(posibles_rivales), 2)
-            distractores_reales = random.sample(posibles_rivales, num_distractores)
-            break
-    
-    if not item_valido:
-        return render(request, 'core/dashboard.html', {'active_tab': 'dashboard', 'segmento': 'AH'})
-
-    opciones = distractores_reales + [respuesta_correcta]
-    random.shuffle(opciones)
-
-    marca_ask = item_valido.grupo_homogeneo
+    # 4. GENERAR NUEVA PREGUNTA (o recuperar la que está sin responder)
+    # El banco de preguntas válidas está cacheado por farmacia y versión de datos
+    pregunta = recuperar_pregunta_ah(f_id, *estado.pregunta) if estado.pregunta else None
+    if not pregunta:
+        pregunta = generar_pregunta_ah(f_id)
+        if not pregunta:
+            return render(request, 'core/dashboard.html', {'active_tab': 'dashboard', 'segmento': 'AH'})
+        estado.pregunta = [pregunta['id_pregunta'], pregunta['indices']]
+        estado.guardar()
 
     context = {
         'farmacia_activa': f_id,
-        'item': item_valido,
-        'marca_ask': marca_ask,
-        'opciones': opciones,
-        'respuesta_correcta': respuesta_correcta,
-        'aciertos': request.session['aciertos'],
-        'total': request.session['total'],
-        'origen': origen,
+        'item': pregunta['item'],
+        'marca_ask': pregunta['item'].grupo_homogeneo,
+        'opciones': pregunta['opciones'],
+        'aciertos': estado.aciertos,
+        'total': estado.total,
+        'origen': pregunta['origen'],
         'mostrar_analisis_solo': False,
         'finalizado': False,
         'active_tab': 'examen',
@@ -327,19 +311,13 @@ def examen(request):
     return render(request, 'core/examen.html', context)
 
 # --- CONFIGURACIÓN ---
+GRUPOS_POR_PAGINA = 50
+
 def configuracion(request):
     f_id = request.session.get('farmacia_activa', 'HF280050001')
+    query = request.GET.get('q', '')
     
-    # 1. Obtenemos datos
-    oportunidades = Oportunidad.objects.filter(farmacia_id=f_id).order_by('grupo_homogeneo')
-    
-    # 2. Diccionario de preferencias existentes (filtrado por farmacia)
-    preferencias_dict = {
-        p.grupo_homogeneo: p 
-        for p in Preferencia.objects.filter(farmacia_id=f_id, activo=True)
-    }
-
-    # 3. Guardado (POST)
+    # 1. Guardado (POST)
     if request.method == 'POST':
         grupo = request.POST.get('grupo_hidden')
         producto_elegido = request.POST.get('producto_elegido') # Cambiamos nombre variable
@@ -351,26 +329,33 @@ def configuracion(request):
                 farmacia_id=f_id,
                 defaults={'laboratorio_preferente': producto_elegido, 'activo': is_active}
             )
-            return redirect('configuracion')
+            incrementar_version(f_id)
+            # Volvemos a la misma página y filtro
+            return redirect(request.get_full_path())
+
+    # 2. Página de grupos (filtrada por texto). Las opciones de cada fila
+    #    se cargan bajo demanda desde `opciones_configuracion`.
+    oportunidades = Oportunidad.objects.filter(farmacia_id=f_id).only(
+        'id', 'grupo_homogeneo', 'producto_recomendado', 'margen_pct'
+    ).order_by('grupo_homogeneo')
+    if query:
+        oportunidades = oportunidades.filter(grupo_homogeneo__icontains=query)
+
+    page_obj = Paginator(oportunidades, GRUPOS_POR_PAGINA).get_page(request.GET.get('page'))
+    
+    # 3. Preferencias existentes, solo de los grupos de la página
+    preferencias_dict = {
+        p.grupo_homogeneo: p 
+        for p in Preferencia.objects.filter(
+            farmacia_id=f_id, activo=True,
+            grupo_homogeneo__in=[op.grupo_homogeneo for op in page_obj],
+        )
+    }
 
     lista_config = []
     
-    for op in oportunidades:
-        # A. Construir lista de opciones (Recomendado + Competencia)
-        opciones_disponibles = []
-        
-        # 1. El Ganador actual (Opción por defecto del sistema)
-        opciones_disponibles.append(op.producto_recomendado)
-        
-        # 2. Los competidores (Los extraemos de la cadena de texto)
-        # Usamos el método helper que ya creamos en models.py
-        competidores_stats = op.get_competidores_stats()
-        for c in competidores_stats:
-            # Evitamos duplicados si el recomendado sale en la lista
-            if c['nombre'] not in opciones_disponibles: 
-                opciones_disponibles.append(c['nombre'])
-        
-        # B. Determinar selección actual
+    for op in page_obj:
+        # Determinar selección actual
         pref = preferencias_dict.get(op.grupo_homogeneo)
         
         if pref:
@@ -383,9 +368,9 @@ def configuracion(request):
             activo = True
 
         lista_config.append({
+            'id': op.id,
             'grupo': op.grupo_homogeneo,
             'valor_actual': valor_actual,
-            'opciones': sorted(opciones_disponibles), # Ordenamos alfabéticamente
             'es_manual': es_manual,
             'activo': activo,
             'margen': op.margen_pct
@@ -393,34 +378,128 @@ def configuracion(request):
 
     context = {
         'lista_config': lista_config,
+        'page_obj': page_obj,
+        'query': query,
         'active_tab': 'configuracion',
         'segmento': 'AH',
     }
     return render(request, 'core/configuracion.html', context)
 
-from .services import sincronizar_desde_databricks, obtener_farmacias_cloud # <--- Importar nuevo servicio
+@login_required(login_url='login')
+def opciones_configuracion(request, pk):
+    """Devuelve en JSON las opciones de preferencia de un grupo (carga diferida)."""
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    op = get_object_or_404(Oportunidad, pk=pk, farmacia_id=f_id)
+    return JsonResponse({'opciones': op.get_opciones()})
+
+# --- FRAGMENTOS (carga diferida) ---
+FRAGMENTOS_COMPETIDORES = {
+    'tooltip': 'core/fragmentos/competidores_tooltip.html',  # Dashboard
+    'tabla': 'core/fragmentos/competidores_tabla.html',      # Datos brutos
+}
+
 
+@login_required(login_url='login')
+def fragmento_competidores(request, pk):
+    """
+    HTML del desglose de competidores de un grupo, que la página pide al abrirlo.
+
+    `?formato=` elige la plantilla (ver FRAGMENTOS_COMPETIDORES). Las páginas
+    ponen la versión de datos en la URL (`v`): si es la actual, el navegador
+    puede guardar el fragmento hasta que cambien los datos.
+    """
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    plantilla = FRAGMENTOS_COMPETIDORES.get(request.GET.get('formato', 'tabla'))
+    detalle = competidores_oportunidad(f_id, pk)
+    if plantilla is None or detalle is None:
+        raise Http404("Fragmento no encontrado")
+    respuesta = render(request, plantilla, detalle)
+    if request.GET.get('v') == str(obtener_version(f_id)):
+        patch_cache_control(respuesta, private=True, max_age=settings.FARMA_CACHE_TIMEOUT)
+    return respuesta
+
+# --- PREFERENCIAS EN BLOQUE ---
+@login_required(login_url='login')
+def preferencias_masivo(request):
+    """
+    Guarda muchas preferencias de una vez.
+
+    Acepta un formulario (listas paralelas `grupo`/`producto` y `activo` con
+    los grupos activos) o JSON: {"preferencias": [{"grupo", "producto", "activo"}]}.
+    """
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    if request.method != 'POST':
+        return redirect('configuracion')
+
+    es_json = request.content_type == 'application/json'
+    if es_json:
+        try:
+            cambios = json.loads(request.body).get('preferencias', [])
+        except (ValueError, AttributeError):
+            return JsonResponse({'error': 'JSON no válido'}, status=400)
+        if not isinstance(cambios, list):
+            return JsonResponse({'error': '"preferencias" debe ser una lista'}, status=400)
+    else:
+        activos = set(request.POST.getlist('activo'))
+        cambios = [
+            {'grupo': g, 'producto': p, 'activo': g in activos}
+            for g, p in zip(request.POST.getlist('grupo'), request.POST.getlist('producto'))
+        ]
+
+    aplicadas, errores = guardar_preferencias_masivo(f_id, cambios)
+
+    if es_json:
+        return JsonResponse({'aplicadas': aplicadas, 'errores': errores})
+
+    avisar_resultado(request, PREFERENCIAS_AH, aplicadas, errores)
+    return redirect(siguiente_seguro(request, 'configuracion'))
+
+@login_required(login_url='login')
+def exportar_preferencias(request):
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    response = HttpResponse(exportar_preferencias_csv(f_id), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="preferencias_ah_{f_id}.csv"'
+    return response
+
+@login_required(login_url='login')
+def importar_preferencias(request):
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    archivo = request.FILES.get('archivo')
+    if request.method == 'POST' and archivo:
+        try:
+            cambios = leer_preferencias_csv(archivo.read().decode('utf-8-sig'))
+        except UnicodeDecodeError:
+            messages.error(request, "El fichero debe ser un CSV en UTF-8.")
+        else:
+            aplicadas, errores = guardar_preferencias_masivo(f_id, cambios)
+            avisar_resultado(request, PREFERENCIAS_AH, aplicadas, errores)
+    return redirect('configuracion')
+
+@staff_member_required
+def copiar_preferencias_view(request):
+    """Copia las preferencias de la farmacia activa a otras (solo admins)."""
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    if request.method == 'POST':
+        destinos = [d.strip() for d in request.POST.get('destinos', '').split(',') if d.strip()]
+        resultados = copiar_preferencias(f_id, destinos)
+        for destino, (aplicadas, errores) in resultados.items():
+            messages.info(request, f"{destino}: {aplicadas} preferencias copiadas, {len(errores)} omitidas.")
+    return redirect('configuracion')
+
+# --- IMPORTACIÓN (Solo Admins) ---
+# Escribe en la base de datos compartida los datos de cualquier farmacia
+@staff_member_required
 def importar(request):
     f_id = request.session.get('farmacia_activa', 'HF280050001')
 
     # --- OPTIMIZACIÓN: CACHÉ DE FARMACIAS ---
-    # Solo conectamos a Databricks si no tenemos la lista en la sesión
-    if 'lista_farmacias_cloud' in request.session:
-        lista_farmacias_cloud = request.session['lista_farmacias_cloud']
-        error_cloud = None
-    else:
-        # Si no está en caché, conectamos (tardará unos segundos)
-        lista_farmacias_cloud, error_cloud = obtener_farmacias_cloud()
-        if not error_cloud:
-            request.session['lista_farmacias_cloud'] = lista_farmacias_cloud
+    # La página no espera a Databricks: si la lista no está en la caché
+    # compartida, el navegador la pide al endpoint asíncrono `farmacias_cloud`
+    lista_farmacias_cloud = farmacias_cloud_cacheadas()
     # ----------------------------------------
     
     mensaje = None
     tipo_mensaje = ""
-    
-    if error_cloud:
-         mensaje = f"Error conectando a Databricks: {error_cloud}"
-         tipo_mensaje = "warning"
 
     if request.method == 'POST':
         farmacia_input = request.POST.get('farmacia_input')
@@ -428,22 +507,19 @@ def importar(request):
         fecha_fin = request.POST.get('fecha_fin')
 
         if farmacia_input and fecha_inicio and fecha_fin:
-            # 1. Sincronizar Medicamentos (Core)
-            # Asegúrate de que esta función devuelve (int, str)
-            num_ah, error_ah = sincronizar_desde_databricks(farmacia_input, fecha_inicio, fecha_fin)
-            
-            # 2. Sincronizar EFP (Nueva App)
-            num_efp, error_efp = sincronizar_efp_desde_databricks(farmacia_input, fecha_inicio, fecha_fin)
-            
-            if error_ah or error_efp:
+            # Sincroniza AH y EFP y precalienta la caché (lo mismo que el trabajo asíncrono)
+            resultado = importar_farmacia(farmacia_input, fecha_inicio, fecha_fin)
+            errores = resultado['errores']
+
+            if errores:
                 # Mostramos error si falla CUALQUIERA de los dos
                 err_msg = ""
-                if error_ah: err_msg += f"AH: {error_ah}. "
-                if error_efp: err_msg += f"EFP: {error_efp}."
+                if 'AH' in errores: err_msg += f"AH: {errores['AH']}. "
+                if 'EFP' in errores: err_msg += f"EFP: {errores['EFP']}."
                 mensaje = f"Hubo errores: {err_msg}"
                 tipo_mensaje = "danger"
             else:
-                mensaje = f"¡Éxito! Datos actualizados: {num_ah} grupos AH y {num_efp} categorías EFP."
+                mensaje = f"¡Éxito! Datos actualizados: {resultado['ah']} grupos AH y {resultado['efp']} categorías EFP."
                 tipo_mensaje = "success"
 
                 # Guardamos datos en sesión
@@ -461,9 +537,147 @@ def importar(request):
     context = {
         'farmacia_activa': f_id,
         'lista_farmacias': lista_farmacias_cloud,
+        'cargar_farmacias_cloud': lista_farmacias_cloud is None,
         'mensaje': mensaje,
         'tipo_mensaje': tipo_mensaje,
         'active_tab': 'configuracion',
         'segmento': 'AH',
     }
-    return render(request, 'core/importar.html', context)
\ No newline at end of file
+    return render(request, 'core/importar.html', context)
+
+# --- IMPORTACIÓN ASÍNCRONA (ASGI) ---
+# Con uvicorn estas vistas no ocupan un hilo mientras esperan a Databricks:
+# la llamada bloqueante va al pool acotado de core/asincrono.py.
+
+@staff_member_required
+async def farmacias_cloud(request):
+    """Lista de farmacias del warehouse en JSON; con `?refrescar=1` ignora la caché."""
+    lista, error = await en_warehouse(obtener_farmacias_cloud_cacheado, bool(request.GET.get('refrescar')))
+    return JsonResponse({'farmacias': lista, 'error': error})
+
+@staff_member_required
+@require_POST
+async def lanzar_importacion(request):
+    """Lanza la importación en segundo plano y devuelve el ID del trabajo (202)."""
+    farmacia_input = request.POST.get('farmacia_input')
+    fecha_inicio = request.POST.get('fecha_inicio')
+    fecha_fin = request.POST.get('fecha_fin')
+    if not (farmacia_input and fecha_inicio and fecha_fin):
+        return JsonResponse({'error': 'Por favor completa todos los campos.'}, status=400)
+
+    usuario = await request.auser()
+    trabajo_id = await sync_to_async(lanzar_trabajo)(
+        'importacion', importar_farmacia, farmacia_input, fecha_inicio, fecha_fin,
+        usuario=usuario.pk, fecha_inicio=fecha_inicio, fecha_fin=fecha_fin,
+    )
+    return JsonResponse(
+        {'trabajo': trabajo_id, 'estado_url': reverse('estado_importacion', args=[trabajo_id])}, status=202,
+    )
+
+@staff_member_required
+async def estado_importacion(request, trabajo_id):
+    """Progreso de una importación lanzada por el usuario (para consultarlo cada pocos segundos)."""
+    estado = await sync_to_async(estado_trabajo)(trabajo_id)
+    usuario = await request.auser()
+    if not estado or estado['tipo'] != 'importacion' or estado['usuario'] != usuario.pk:
+        return JsonResponse({'error': 'Trabajo no encontrado'}, status=404)
+
+    resultado = estado['resultado']
+    if estado['estado'] == 'terminado' and not resultado['errores']:
+        # Como en la importación síncrona: la farmacia importada pasa a ser la activa
+        await request.session.aset('farmacia_activa', resultado['farmacia_id'])
+        await request.session.aset('fecha_inicio', estado['fecha_inicio'])
+        await request.session.aset('fecha_fin', estado['fecha_fin'])
+    return JsonResponse({clave: estado[clave] for clave in ('estado', 'fase', 'resultado', 'error')})
+
+# --- RENDIMIENTO (Solo Admins) ---
+@staff_member_required
+def rendimiento(request):
+    """Percentiles por vista (INSTRUMENTACION=True) y tasa de acierto de la caché."""
+    if request.method == 'POST':
+        reiniciar_resumen()
+        messages.info(request, "Muestras de rendimiento borradas.")
+        return redirect('rendimiento')
+
+    context = {
+        'instrumentacion_activa': settings.INSTRUMENTACION,
+        'vistas': resumen_por_vista(),
+        'muestras_por_vista': MUESTRAS_POR_VISTA,
+        'cache_stats': sorted(estadisticas_cache(VISTAS_CACHEADAS).items()),
+        'active_tab': 'rendimiento',
+        'segmento': 'AH',
+    }
+    return render(request, 'core/rendimiento.html', context)
+
+
+# --- MÉTRICAS PROMETHEUS ---
+def metricas(request):
+    """
+    Métricas en formato texto de Prometheus.
+
+    Acceso para staff con sesión o con `Authorization: Bearer <METRICAS_TOKEN>`
+    (lo que usa el scraper de Prometheus). Con METRICAS=False no existe.
+    """
+    if not settings.METRICAS:
+        raise Http404("Métricas desactivadas")
+    token = settings.METRICAS_TOKEN
+    cabecera = request.headers.get('Authorization', '')
+    autorizado = (
+        (token and hmac.compare_digest(cabecera, f'Bearer {token}'))
+        or (request.user.is_authenticated and request.user.is_staff)
+    )
+    if not autorizado:
+        return HttpResponse('No autorizado', status=401, content_type='text/plain')
+    return HttpResponse(exponer(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# --- FICHEROS MEDIA (fotos de productos) ---
+# Variantes generadas por procesar_imagenes_efp: "<cn>-<ancho>.<hash>.<ext>"
+RE_NOMBRE_CON_HASH = re.compile(r'\.[0-9a-f]{10}\.[a-z0-9]+$')
+UN_ANO = 365 * 24 * 3600
+# Lo único público de MEDIA_ROOT: las fotos. El manifiesto del descargador y el
+# índice de variantes (URLs de origen, ETags, estado) se quedan dentro
+CARPETA_MEDIA_PUBLICA = 'efp_imagenes/'
+EXTENSIONES_MEDIA = ('.jpg', '.jpeg', '.webp', '.avif', '.png')
+
+
+@require_safe
+def servir_media(request, ruta):
+    """
+    Sirve un fichero de MEDIA_ROOT con ETag, Last-Modified y caché larga.
+
+    Una visita repetida solo cuesta un 304 (o nada, dentro del max-age). Con
+    MEDIA_X_ACCEL_REDIRECT la respuesta lleva solo las cabeceras y Nginx envía
+    el fichero; si no, se envía con FileResponse (sendfile en gunicorn).
+
+    Solo se sirven imágenes de efp_imagenes/; el resto de MEDIA_ROOT da 404.
+    """
+    normalizada = posixpath.normpath(ruta)
+    if not (normalizada.startswith(CARPETA_MEDIA_PUBLICA) and normalizada.lower().endswith(EXTENSIONES_MEDIA)):
+        raise Http404("Fichero no encontrado")
+    try:
+        completa = safe_join(settings.MEDIA_ROOT, ruta)
+        estado = os.stat(completa)
+    except (SuspiciousFileOperation, FileNotFoundError, NotADirectoryError):
+        raise Http404("Fichero no encontrado")
+    if not stat.S_ISREG(estado.st_mode):
+        raise Http404("Fichero no encontrado")
+
+    # Mismo formato que el ETag de Nginx: cambia si cambia la fecha o el tamaño
+    etag = f'"{estado.st_mtime_ns:x}-{estado.st_size:x}"'
+    respuesta = get_conditional_response(request, etag=etag, last_modified=int(estado.st_mtime))
+    if respuesta is None:
+        tipo, _ = mimetypes.guess_type(completa)
+        if settings.MEDIA_X_ACCEL_REDIRECT:
+            respuesta = HttpResponse(content_type=tipo or 'application/octet-stream')
+            respuesta['X-Accel-Redirect'] = settings.MEDIA_X_ACCEL_REDIRECT + quote(ruta)
+        else:
+            respuesta = FileResponse(open(completa, 'rb'), content_type=tipo)
+
+    respuesta['ETag'] = etag
+    respuesta['Last-Modified'] = http_date(estado.st_mtime)
+    if RE_NOMBRE_CON_HASH.search(ruta):
+        patch_cache_control(respuesta, public=True, max_age=UN_ANO, immutable=True)
+    else:
+        patch_cache_control(respuesta, public=True, max_age=settings.MEDIA_MAX_AGE)
+    return respuesta
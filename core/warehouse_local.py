@@ -0,0 +1,429 @@
+# core/warehouse_local.py
+"""
+Sustituto local de Databricks para desarrollo, tests y benchmarks.
+
+Con `DATABRICKS_BACKEND=local`, `databricks_connection()` devuelve una
+conexión a un fichero SQLite (WAREHOUSE_LOCAL_PATH) con las mismas tablas
+que usa la aplicación en `cat_farma.datavaultperformance`:
+
+    bridge_dispensacion, pip_medicamentos_financiados, map_idArticu_idEfp,
+    ref_efp, nom_farmacias
+
+Las consultas son las reales: `traducir_sql()` adapta lo justo del dialecto
+de Spark SQL (catálogo, literales DATE, CAST, collect_list...) y las funciones
+que SQLite no tiene (concat, format_number, regexp_replace) se registran en
+Python. Si el fichero no existe se crea con datos sintéticos reproducibles;
+para otra escala, `manage.py generar_datos_sinteticos --warehouse` lo
+recrea (y `--fixtures` guarda las tablas como .csv.gz para reproducirlo).
+"""
+import csv
+import gzip
+import json
+import os
+import random
+import re
+import sqlite3
+import uuid
+from datetime import date, timedelta
+
+from django.conf import settings
+
+# Columnas de cada tabla (mismos nombres que en Databricks)
+ESQUEMA = {
+    'bridge_dispensacion': (
+        ('fecha', 'TEXT'), ('FARMACIA_NOM', 'TEXT'), ('IdArticu', 'INTEGER'), ('Cantidad', 'REAL'),
+        ('ImporteBruto', 'REAL'), ('ImporteCoste', 'REAL'), ('PVP', 'REAL'),
+    ),
+    'pip_medicamentos_financiados': (
+        ('Codigo_Nacional', 'TEXT'), ('Nombre_Producto', 'TEXT'), ('Principio_Activo', 'TEXT'),
+        ('Codigo_Agrupacion', 'TEXT'), ('Estado', 'TEXT'),
+    ),
+    'map_idArticu_idEfp': (('id_articu', 'TEXT'), ('id_efp', 'INTEGER'), ('descripcion_articulo', 'TEXT')),
+    'ref_efp': (('idEfp', 'INTEGER'), ('descripcion_grupo', 'TEXT')),
+    'nom_farmacias': (('FARMACIA_NOM', 'TEXT'), ('ACTIVO', 'INTEGER')),
+}
+
+INDICES = (
+    'CREATE INDEX IF NOT EXISTS bd_farmacia_fecha ON bridge_dispensacion (FARMACIA_NOM, fecha)',
+    'CREATE INDEX IF NOT EXISTS pmf_cn ON pip_medicamentos_financiados (Codigo_Nacional)',
+    'CREATE INDEX IF NOT EXISTS map_articu ON map_idArticu_idEfp (id_articu)',
+)
+
+FARMACIAS_DEMO = ('HF280050001', 'HF280050002', 'HF280050003')
+
+PRINCIPIOS_ACTIVOS = (
+    'OMEPRAZOL', 'PARACETAMOL', 'IBUPROFENO', 'ATORVASTATINA', 'SIMVASTATINA', 'METFORMINA', 'AMLODIPINO',
+    'ENALAPRIL', 'LOSARTAN', 'PANTOPRAZOL', 'LORAZEPAM', 'ALPRAZOLAM', 'SERTRALINA', 'ESCITALOPRAM',
+    'BISOPROLOL', 'FUROSEMIDA', 'TRAMADOL', 'METAMIZOL', 'AMOXICILINA', 'AZITROMICINA', 'CLOPIDOGREL',
+    'TAMSULOSINA', 'LEVOTIROXINA', 'ROSUVASTATINA', 'GABAPENTINA', 'PREGABALINA', 'DULOXETINA',
+    'VALSARTAN', 'HIDROCLOROTIAZIDA', 'ALOPURINOL',
+)
+DOSIS_MG = (10, 20, 40, 5, 50, 100, 500, 1000)
+LABORATORIOS = ('CINFA', 'NORMON', 'KERN', 'STADA', 'TEVA', 'SANDOZ', 'MYLAN', 'RATIOPHARM', 'ARISTO', 'ALTER')
+MARCAS_EFP = ('FARMALIFE', 'SALUDPLUS', 'NATURCARE', 'DERMOVIT', 'BIOSANA', 'VITALIA', 'CUIDAMAX', 'ORTOFARMA')
+
+
+# --- DIALECTO ---
+
+def _argumentos(sql, apertura):
+    """
+    Argumentos de la llamada cuyo paréntesis de apertura está en `apertura`.
+
+    Returns:
+        tuple: (lista de argumentos como texto, posición tras el paréntesis de cierre)
+    """
+    nivel, actual, args, comilla = 0, [], [], None
+    for i in range(apertura, len(sql)):
+        c = sql[i]
+        if comilla:
+            actual.append(c)
+            if c == comilla:
+                comilla = None
+            continue
+        if c in ("'", '"'):
+            comilla = c
+        elif c == '(':
+            nivel += 1
+            if nivel == 1:
+                continue
+        elif c == ')':
+            nivel -= 1
+            if nivel == 0:
+                args.append(''.join(actual).strip())
+                return args, i + 1
+        elif c == ',' and nivel == 1:
+            args.append(''.join(actual).strip())
+            actual = []
+            continue
+        actual.append(c)
+    raise ValueError(f"Paréntesis sin cerrar en la consulta: {sql[apertura:apertura + 80]!r}")
+
+
+def _reescribir_llamadas(sql, nombre, reemplazo):
+    """Sustituye cada llamada `nombre(...)` (también anidadas) por `reemplazo(args)`."""
+    patron = re.compile(rf'\b{nombre}\s*\(', re.IGNORECASE)
+    salida, pos = [], 0
+    while True:
+        m = patron.search(sql, pos)
+        if m is None:
+            salida.append(sql[pos:])
+            return ''.join(salida)
+        args, fin = _argumentos(sql, m.end() - 1)
+        salida.append(sql[pos:m.start()])
+        salida.append(reemplazo([_reescribir_llamadas(a, nombre, reemplazo) for a in args]))
+        pos = fin
+
+
+_TIPOS = {'STRING': 'TEXT', 'DOUBLE': 'REAL', 'FLOAT': 'REAL', 'INT': 'INTEGER', 'BIGINT': 'INTEGER'}
+
+
+def _cast(args):
+    expresion, tipo = re.fullmatch(r'(.*)\s+AS\s+(\w+(?:\s*\([\d\s,]+\))?)', args[0], re.IGNORECASE | re.DOTALL).groups()
+    decimal = re.fullmatch(r'DECIMAL\s*\(\s*\d+\s*,\s*(\d+)\s*\)', tipo, re.IGNORECASE)
+    if decimal:
+        # Spark conserva los decimales al pasarlo a texto ("3.50"); SQLite no
+        return f"printf('%.{decimal.group(1)}f', {expresion})"
+    return f"CAST({expresion} AS {_TIPOS.get(tipo.upper(), tipo)})"
+
+
+def _array_join(args):
+    lista, separador = args
+    (elemento,), _ = _argumentos(lista, lista.index('('))
+    # collect_list ignora los NULL como group_concat, pero una lista vacía da '' y no NULL
+    return f"coalesce(group_concat({elemento}, {separador}), '')"
+
+
+def traducir_sql(query):
+    """
+    Adapta una consulta de Spark SQL (Databricks) a SQLite.
+
+    Args:
+        query (str): Consulta tal y como se envía a Databricks
+
+    Returns:
+        str: Consulta equivalente para el warehouse local
+    """
+    query = re.sub(r'\bcat_farma\.datavaultperformance\.', '', query)
+    query = re.sub(r"\bDATE\s+('[^']*')", r'\1', query, flags=re.IGNORECASE)
+    query = _reescribir_llamadas(query, 'CAST', _cast)
+    return _reescribir_llamadas(query, 'array_join', _array_join)
+
+
+def _texto(valor):
+    return valor if isinstance(valor, str) else str(valor)
+
+
+def _concat(*valores):
+    if any(v is None for v in valores):
+        return None
+    return ''.join(_texto(v) for v in valores)
+
+
+def _format_number(valor, decimales):
+    if valor is None:
+        return None
+    return f"{float(valor):,.{int(decimales)}f}"
+
+
+def _regexp_replace(valor, patron, reemplazo):
+    if valor is None:
+        return None
+    return re.sub(patron, reemplazo, _texto(valor))
+
+
+# --- CONEXIÓN (misma interfaz que databricks.sql) ---
+
+class CursorLocal:
+    """Cursor con la interfaz que usa la aplicación del cursor de databricks-sql-connector."""
+
+    def __init__(self, conexion):
+        self._cursor = conexion.cursor()
+        self.query_id = None
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def execute(self, operation, parameters=None):
+        self.query_id = f'local-{uuid.uuid4().hex[:16]}'
+        self._cursor.execute(traducir_sql(operation), parameters or ())
+        return self
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size or self._cursor.arraysize)
+
+    def close(self):
+        self._cursor.close()
+
+
+class ConexionLocal:
+    def __init__(self, conexion):
+        self._conexion = conexion
+
+    def cursor(self):
+        return CursorLocal(self._conexion)
+
+    def close(self):
+        self._conexion.close()
+
+
+def conectar(ruta=None):
+    """
+    Abre el warehouse local, creándolo con datos sintéticos si no existe.
+
+    Args:
+        ruta (str, optional): Fichero SQLite (por defecto WAREHOUSE_LOCAL_PATH)
+
+    Returns:
+        ConexionLocal: Conexión con `cursor()` y `close()` como la de Databricks
+    """
+    conn = sqlite3.connect(str(ruta or settings.WAREHOUSE_LOCAL_PATH), timeout=30, isolation_level=None)
+    conn.create_function('concat', -1, _concat, deterministic=True)
+    conn.create_function('format_number', 2, _format_number, deterministic=True)
+    conn.create_function('regexp_replace', 3, _regexp_replace, deterministic=True)
+
+    existe = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bridge_dispensacion'"
+    ).fetchone()
+    if not existe:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Otro proceso puede haberlo creado mientras esperábamos el bloqueo
+            if not conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bridge_dispensacion'"
+            ).fetchone():
+                crear_esquema(conn)
+                cargar_tablas(conn, generar_tablas())
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    return ConexionLocal(conn)
+
+
+# --- DATOS SINTÉTICOS ---
+
+def crear_esquema(conn):
+    """Crea (vacías) las tablas del warehouse local."""
+    for tabla, columnas in ESQUEMA.items():
+        conn.execute(f"DROP TABLE IF EXISTS {tabla}")
+        conn.execute(f"CREATE TABLE {tabla} ({', '.join(f'{c} {t}' for c, t in columnas)})")
+    for indice in INDICES:
+        conn.execute(indice)
+
+
+def cargar_tablas(conn, tablas):
+    """
+    Inserta filas en el warehouse local.
+
+    Args:
+        conn (sqlite3.Connection): Conexión al fichero del warehouse
+        tablas (dict): {tabla: iterable de tuplas en el orden de ESQUEMA}
+    """
+    for tabla, filas in tablas.items():
+        huecos = ', '.join('?' * len(ESQUEMA[tabla]))
+        conn.executemany(f"INSERT INTO {tabla} VALUES ({huecos})", filas)
+
+
+def grupos_efp():
+    """Grupos EFP de efp/data/efp_grupos.json (id, nombre, cn...)."""
+    ruta = os.path.join(settings.BASE_DIR, 'efp', 'data', 'efp_grupos.json')
+    with open(ruta, encoding='utf-8') as f:
+        return json.load(f)['grupos']
+
+
+def nombre_grupo_ah(indice):
+    """Principio activo y dosis del grupo homogéneo sintético número `indice` (únicos)."""
+    principio = PRINCIPIOS_ACTIVOS[indice % len(PRINCIPIOS_ACTIVOS)]
+    dosis = DOSIS_MG[(indice // len(PRINCIPIOS_ACTIVOS)) % len(DOSIS_MG)]
+    nombre = f"{principio} {dosis} MG"
+    if indice >= len(PRINCIPIOS_ACTIVOS) * len(DOSIS_MG):
+        nombre += f" ({indice})"
+    return nombre
+
+
+def generar_tablas(farmacias=FARMACIAS_DEMO, grupos_ah=60, ids_efp=None, competidores=4,
+                   desde=date(2024, 1, 1), dias=730, ventas_por_articulo=8, semilla=0):
+    """
+    Genera el contenido de las tablas del warehouse con datos reproducibles.
+
+    Cada grupo (AH por principio activo y EFP por indicación) tiene
+    `competidores` artículos con precios parecidos y márgenes distintos, para
+    que las consultas reales encuentren oportunidades de ahorro. Las
+    dispensaciones se generan bajo demanda (pueden ser millones de filas).
+
+    Args:
+        farmacias (iterable): IDs de farmacias activas
+        grupos_ah (int): Agrupaciones homogéneas a crear
+        ids_efp (iterable, optional): IDs de los grupos de efp_grupos.json a usar (todos si None)
+        competidores (int): Artículos por grupo
+        desde (date): Primera fecha de dispensación
+        dias (int): Días cubiertos por las dispensaciones
+        ventas_por_articulo (int): Filas de dispensación medias por farmacia y artículo
+        semilla (int): Semilla del generador
+
+    Returns:
+        dict: {tabla: iterable de tuplas en el orden de ESQUEMA}
+    """
+    rnd = random.Random(semilla)
+    farmacias = list(farmacias)
+    tablas = {tabla: [] for tabla in ESQUEMA}
+    articulos = []  # (cn, pvp, coste)
+
+    def _precios(base):
+        pvp = round(base * rnd.uniform(0.9, 1.1), 2)
+        return pvp, round(pvp * rnd.uniform(0.55, 0.85), 2)
+
+    # Agrupaciones homogéneas (medicamentos financiados)
+    cn = 100000
+    for g in range(grupos_ah):
+        principio = nombre_grupo_ah(g)
+        base = rnd.uniform(2, 30)
+        for laboratorio in rnd.sample(LABORATORIOS, min(competidores, len(LABORATORIOS))):
+            cn += rnd.randint(1, 40)
+            estado = 'BAJA' if rnd.random() < 0.05 else 'ALTA'
+            tablas['pip_medicamentos_financiados'].append(
+                (str(cn), f"{principio} {laboratorio} 28 COMPRIMIDOS", principio, f"{1000 + g},0", estado)
+            )
+            articulos.append((cn, *_precios(base)))
+
+    # Grupos EFP (los CN reales de efp_grupos.json, para que cuadren con las fotos)
+    seleccion = None if ids_efp is None else set(ids_efp)
+    vistos = set()
+    for grupo in grupos_efp():
+        if seleccion is not None and grupo['id'] not in seleccion:
+            continue
+        tablas['ref_efp'].append((grupo['id'], grupo['nombre']))
+        base = rnd.uniform(3, 25)
+        nuevos = [c for c in grupo['cn'] if c not in vistos][:competidores]
+        for cn_efp in nuevos:
+            vistos.add(cn_efp)
+            nombre = f"{rnd.choice(MARCAS_EFP)} {grupo['nombre'].split(' - ')[0]} {cn_efp}"
+            tablas['map_idArticu_idEfp'].append((cn_efp, grupo['id'], nombre))
+            articulos.append((int(cn_efp), *_precios(base)))
+
+    tablas['nom_farmacias'] = [(farmacia, 1) for farmacia in farmacias] + [('HF289999999', 0)]
+    tablas['bridge_dispensacion'] = _dispensaciones(
+        random.Random(semilla + 1), farmacias, articulos, desde, dias, ventas_por_articulo,
+    )
+    return tablas
+
+
+def _dispensaciones(rnd, farmacias, articulos, desde, dias, ventas_por_articulo):
+    """Cada farmacia vende ~80% del catálogo en fechas al azar."""
+    for farmacia in farmacias:
+        for cn_articulo, pvp, coste in articulos:
+            if rnd.random() > 0.8:
+                continue
+            for _ in range(rnd.randint(1, 2 * ventas_por_articulo - 1)):
+                cantidad = rnd.randint(1, 20)
+                fecha = desde + timedelta(days=rnd.randrange(dias))
+                yield (
+                    fecha.isoformat(), farmacia, cn_articulo, float(cantidad),
+                    round(cantidad * pvp, 2), round(cantidad * coste, 2), pvp,
+                )
+
+
+# --- FICHEROS DE FIXTURES ---
+
+def exportar_fixtures(tablas, directorio):
+    """
+    Escribe cada tabla en `<directorio>/<tabla>.csv.gz` (con cabecera).
+
+    Args:
+        tablas (dict): {tabla: iterable de tuplas}, p. ej. de `generar_tablas()`
+        directorio (str): Carpeta de destino (se crea si no existe)
+
+    Returns:
+        dict: {tabla: filas escritas}
+    """
+    os.makedirs(directorio, exist_ok=True)
+    escritas = {}
+    for tabla, filas in tablas.items():
+        with gzip.open(os.path.join(directorio, f'{tabla}.csv.gz'), 'wt', encoding='utf-8', newline='', compresslevel=1) as f:
+            escritor = csv.writer(f)
+            escritor.writerow([columna for columna, _ in ESQUEMA[tabla]])
+            escritas[tabla] = 0
+            for fila in filas:
+                escritor.writerow(fila)
+                escritas[tabla] += 1
+    return escritas
+
+
+def importar_fixtures(directorio, ruta=None):
+    """
+    Recrea el warehouse local a partir de los ficheros de `exportar_fixtures()`.
+
+    Los valores se leen como texto; la afinidad de tipo de cada columna de
+    SQLite los guarda como número donde corresponde.
+
+    Args:
+        directorio (str): Carpeta con los `<tabla>.csv.gz`
+        ruta (str, optional): Fichero SQLite (por defecto WAREHOUSE_LOCAL_PATH)
+    """
+    conn = sqlite3.connect(str(ruta or settings.WAREHOUSE_LOCAL_PATH), timeout=30, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        crear_esquema(conn)
+        for tabla in ESQUEMA:
+            with gzip.open(os.path.join(directorio, f'{tabla}.csv.gz'), 'rt', encoding='utf-8', newline='') as f:
+                lector = csv.reader(f)
+                next(lector)
+                cargar_tablas(conn, {tabla: lector})
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,275 @@
+# efp/descargas.py
+"""
+Descarga concurrente y reanudable de las fotos de producto EFP.
+
+Las ~4.800 URLs de efp/data/efp_fotos.csv se descargan con un pool de hilos
+(cada hilo con su sesión keep-alive), un límite de peticiones simultáneas por
+host, reintentos con espera exponencial ante errores de red, 429 y 5xx, y
+peticiones condicionales (If-None-Match / If-Modified-Since) para las fotos
+que ya están en disco.
+
+Cada fichero se escribe en un temporal de la misma carpeta y se renombra al
+terminar, así que nunca queda una foto a medias. El resultado de cada CN se
+guarda en un manifiesto JSON junto a las imágenes (estado, ETag,
+Last-Modified, tamaño); al relanzar solo se descargan las que faltan o han
+cambiado en el servidor.
+"""
+import csv
+import json
+import os
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import formatdate
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+
+CARPETA_IMAGENES = 'efp_imagenes'
+NOMBRE_MANIFIESTO = 'manifiesto.json'
+# Algunos servidores de imágenes rechazan el User-Agent por defecto de requests
+CABECERAS = {'User-Agent': 'Mozilla/5.0'}
+# Respuestas que merece la pena reintentar (además de los errores de red)
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+def carpeta_imagenes():
+    """Carpeta de las fotos EFP dentro de MEDIA_ROOT."""
+    return os.path.join(settings.MEDIA_ROOT, CARPETA_IMAGENES)
+
+
+def ruta_manifiesto(carpeta=None):
+    return os.path.join(carpeta or carpeta_imagenes(), NOMBRE_MANIFIESTO)
+
+
+def leer_catalogo_fotos(ruta_csv=None):
+    """
+    CN y URL de cada foto de efp_fotos.csv (las filas sin CN o sin URL http se ignoran).
+
+    Returns:
+        list: Tuplas (cn, url) sin CN repetidos
+    """
+    ruta_csv = ruta_csv or os.path.join(settings.BASE_DIR, 'efp', 'data', 'efp_fotos.csv')
+    fotos = {}
+    with open(ruta_csv, encoding='utf-8') as f:
+        for fila in csv.DictReader(f):
+            cn = (fila.get('Codigo Nacional') or '').strip()
+            url = (fila.get('Imagen_URL') or '').strip()
+            if cn and url.startswith('http'):
+                fotos.setdefault(cn, url)
+    return list(fotos.items())
+
+
+def leer_manifiesto(carpeta=None):
+    """
+    Estado guardado de cada CN: {cn: {'estado', 'url', 'etag', 'last_modified', 'bytes', 'actualizado', 'error'}}.
+
+    Returns:
+        dict: Vacío si todavía no hay manifiesto
+    """
+    try:
+        with open(ruta_manifiesto(carpeta), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _crear_temporal(carpeta):
+    """
+    Crea un temporal nuevo en `carpeta` con los permisos que daría open().
+
+    No se usa mkstemp: lo crea con 0600 y Nginx (otro usuario) no podría servir
+    las fotos. Con os.open(..., 0o666) se aplica la umask del proceso sin
+    tener que leerla (os.umask la cambiaría para todos los hilos).
+
+    Returns:
+        tuple: (descriptor, ruta)
+    """
+    while True:
+        temporal = os.path.join(carpeta, f'.descarga-{secrets.token_hex(8)}')
+        try:
+            return os.open(temporal, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666), temporal
+        except FileExistsError:
+            continue
+
+
+def escribir_atomico(ruta, contenido):
+    """Escribe `contenido` (bytes) en un temporal de la misma carpeta y lo renombra sobre `ruta`."""
+    descriptor, temporal = _crear_temporal(os.path.dirname(ruta))
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+    except BaseException:
+        os.unlink(temporal)
+        raise
+
+
+def guardar_manifiesto(manifiesto, carpeta=None):
+    contenido = json.dumps(manifiesto, indent=1, sort_keys=True).encode('utf-8')
+    escribir_atomico(ruta_manifiesto(carpeta), contenido)
+
+
+class DescargadorFotos:
+    """
+    Descarga un lote de fotos con hilos, límite por host y reintentos.
+
+    Uso:
+        descargador = DescargadorFotos(hilos=16, por_host=4)
+        totales = descargador.descargar(leer_catalogo_fotos())
+    """
+
+    def __init__(self, carpeta=None, hilos=16, por_host=4, reintentos=3, espera_base=0.5, timeout=10,
+                 solo_faltan=False, al_terminar=None):
+        """
+        Args:
+            carpeta (str): Carpeta de destino (por defecto MEDIA_ROOT/efp_imagenes)
+            hilos (int): Descargas simultáneas en total
+            por_host (int): Descargas simultáneas contra un mismo host
+            reintentos (int): Reintentos tras el primer intento fallido
+            espera_base (float): Segundos de la primera espera (se duplica en cada reintento)
+            timeout (float): Timeout de conexión y lectura de cada petición
+            solo_faltan (bool): No revalidar las fotos que ya están en disco
+            al_terminar (callable): Recibe (cn, estado) al acabar cada foto (progreso)
+        """
+        self.carpeta = carpeta or carpeta_imagenes()
+        self.hilos = max(hilos, 1)
+        self.por_host = max(por_host, 1)
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.timeout = timeout
+        self.solo_faltan = solo_faltan
+        self.al_terminar = al_terminar or (lambda cn, estado: None)
+        self._local = threading.local()
+        self._semaforos = {}
+        self._cerrojo = threading.Lock()
+
+    def _sesion(self):
+        # Una sesión por hilo: requests.Session no es segura entre hilos, y así
+        # cada hilo reutiliza sus conexiones keep-alive
+        if not hasattr(self._local, 'sesion'):
+            sesion = requests.Session()
+            sesion.headers.update(CABECERAS)
+            adaptador = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.por_host)
+            sesion.mount('http://', adaptador)
+            sesion.mount('https://', adaptador)
+            self._local.sesion = sesion
+        return self._local.sesion
+
+    def _semaforo(self, url):
+        host = urlsplit(url).netloc
+        with self._cerrojo:
+            if host not in self._semaforos:
+                self._semaforos[host] = threading.BoundedSemaphore(self.por_host)
+            return self._semaforos[host]
+
+    def _esperar(self, intento, respuesta=None):
+        espera = self.espera_base * 2 ** intento
+        retry_after = respuesta.headers.get('Retry-After', '') if respuesta is not None else ''
+        if retry_after.isdigit():
+            espera = max(espera, int(retry_after))
+        # Con jitter, para que los hilos que fallan a la vez no reintenten a la vez
+        time.sleep(espera * random.uniform(0.5, 1.0))
+
+    def _pedir(self, url, cabeceras):
+        """GET con reintentos; devuelve la última respuesta o relanza el último error de red."""
+        for intento in range(self.reintentos + 1):
+            ultimo = intento == self.reintentos
+            try:
+                with self._semaforo(url):
+                    respuesta = self._sesion().get(url, headers=cabeceras, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if ultimo:
+                    raise
+                self._esperar(intento)
+                continue
+            if respuesta.status_code not in ESTADOS_REINTENTABLES or ultimo:
+                return respuesta
+            self._esperar(intento, respuesta)
+
+    def descargar_una(self, cn, url, previo=None):
+        """
+        Descarga (o revalida) la foto de un CN.
+
+        Args:
+            previo (dict): Entrada del manifiesto de la ejecución anterior
+
+        Returns:
+            dict: Nueva entrada del manifiesto; 'estado' es 'descargada', 'sin_cambios',
+                'existente' (solo_faltan) o 'error'
+        """
+        previo = previo or {}
+        ruta = os.path.join(self.carpeta, f"{cn}.jpg")
+        entrada = {'url': url, 'etag': previo.get('etag'), 'last_modified': previo.get('last_modified'),
+                   'bytes': previo.get('bytes'), 'error': None, 'actualizado': time.time()}
+
+        cabeceras = {}
+        if os.path.exists(ruta):
+            if self.solo_faltan:
+                return {**entrada, 'estado': 'existente', 'bytes': entrada['bytes'] or os.path.getsize(ruta)}
+            if previo.get('url', url) == url:
+                if previo.get('etag'):
+                    cabeceras['If-None-Match'] = previo['etag']
+                # Fotos bajadas antes del manifiesto: la fecha del fichero sirve de validador
+                cabeceras['If-Modified-Since'] = previo.get('last_modified') or formatdate(
+                    os.path.getmtime(ruta), usegmt=True
+                )
+
+        try:
+            respuesta = self._pedir(url, cabeceras)
+        except requests.RequestException as e:
+            return {**entrada, 'estado': 'error', 'error': str(e)}
+
+        if respuesta.status_code == 304:
+            return {**entrada, 'estado': 'sin_cambios', 'bytes': entrada['bytes'] or os.path.getsize(ruta)}
+        if respuesta.status_code != 200:
+            return {**entrada, 'estado': 'error', 'error': f"HTTP {respuesta.status_code}"}
+        tipo = respuesta.headers.get('Content-Type', '')
+        if tipo and not tipo.startswith('image/'):
+            return {**entrada, 'estado': 'error', 'error': f"Content-Type {tipo}"}
+
+        escribir_atomico(ruta, respuesta.content)
+        return {
+            **entrada, 'estado': 'descargada', 'bytes': len(respuesta.content),
+            'etag': respuesta.headers.get('ETag'), 'last_modified': respuesta.headers.get('Last-Modified'),
+        }
+
+    def descargar(self, fotos, manifiesto=None):
+        """
+        Descarga un lote y actualiza el manifiesto (se guarda al final y cada 200 fotos).
+
+        Args:
+            fotos (list): Tuplas (cn, url), ver `leer_catalogo_fotos`
+            manifiesto (dict): Manifiesto de partida (por defecto el guardado en la carpeta)
+
+        Returns:
+            Counter: Fotos por estado
+        """
+        os.makedirs(self.carpeta, exist_ok=True)
+        manifiesto = leer_manifiesto(self.carpeta) if manifiesto is None else manifiesto
+        totales = Counter()
+
+        with ThreadPoolExecutor(max_workers=self.hilos, thread_name_prefix='fotos-efp') as ejecutor:
+            futuros = {
+                ejecutor.submit(self.descargar_una, cn, url, manifiesto.get(cn)): cn for cn, url in fotos
+            }
+            for i, futuro in enumerate(as_completed(futuros), 1):
+                cn = futuros[futuro]
+                entrada = futuro.result()
+                totales[entrada['estado']] += 1
+                # Un error transitorio no borra lo que sabíamos de una foto que sigue en disco
+                if entrada['estado'] == 'error' and cn in manifiesto and os.path.exists(
+                    os.path.join(self.carpeta, f"{cn}.jpg")
+                ):
+                    entrada = {**manifiesto[cn], 'error': entrada['error'], 'actualizado': entrada['actualizado']}
+                manifiesto[cn] = entrada
+                self.al_terminar(cn, entrada['estado'])
+                if i % 200 == 0:
+                    guardar_manifiesto(manifiesto, self.carpeta)
+
+        guardar_manifiesto(manifiesto, self.carpeta)
+        return totales
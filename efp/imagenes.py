@@ -0,0 +1,263 @@
+# efp/imagenes.py
+"""
+Variantes redimensionadas de las fotos de producto EFP.
+
+Las tarjetas EFP muestran las fotos a 40-220 px de ancho, pero cargaban el
+original. Tras la descarga (efp/descargas.py) se generan, para cada CN,
+versiones de varios anchos en WebP y en JPEG (para navegadores sin WebP)
+con el hash del original en el nombre, así que se pueden servir con caché
+inmutable y cambian de URL si cambia la foto.
+
+Las variantes y el índice `variantes.json` (CN -> ficheros por formato y
+ancho) viven en MEDIA_ROOT/efp_imagenes/variantes/. El tag `efp_imagen`
+(efp/templatetags/efp_tags.py) lee el índice una vez por proceso y lo vuelve
+a leer cuando cambia el fichero.
+
+Del mismo modo se mantiene en memoria qué CN tienen foto (manifiesto del
+descargador), para que las plantillas pinten directamente un placeholder en
+lugar de pedir una URL que daría 404 y cambiarla desde `onerror`.
+
+Pillow solo hace falta para generar las variantes (se importa al procesar);
+para servirlas basta con el índice.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+
+from .descargas import carpeta_imagenes, escribir_atomico, ruta_manifiesto
+
+# Anchos generados (px). Cubren las miniaturas de 40-60 px y las tarjetas de
+# ~120-220 px a 1x y 2x; nunca se amplía por encima del original.
+ANCHOS = (64, 128, 256)
+# WebP para los navegadores actuales y JPEG como alternativa dentro del <picture>
+FORMATOS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 6},
+    'jpg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+}
+CARPETA_VARIANTES = 'variantes'
+NOMBRE_INDICE = 'variantes.json'
+
+
+def carpeta_variantes():
+    return os.path.join(carpeta_imagenes(), CARPETA_VARIANTES)
+
+
+def url_imagen(nombre, *subcarpetas):
+    """URL pública de un fichero de MEDIA_ROOT/efp_imagenes (o de una subcarpeta)."""
+    return settings.MEDIA_URL + '/'.join(('efp_imagenes', *subcarpetas, nombre))
+
+
+def _anchos_para(ancho_original):
+    anchos = [a for a in ANCHOS if a < ancho_original]
+    if ancho_original <= ANCHOS[-1]:
+        anchos.append(ancho_original)  # El propio original, recomprimido pero sin ampliar
+    return anchos
+
+
+def procesar_imagen(cn, ruta_original, carpeta_salida, previo=None):
+    """
+    Genera las variantes de una foto si no existen ya para ese contenido.
+
+    Args:
+        cn (str): Código nacional
+        ruta_original (str): JPEG descargado
+        carpeta_salida (str): Carpeta de las variantes
+        previo (dict): Entrada del índice de la pasada anterior
+
+    Returns:
+        tuple: (estado, entrada del índice); estado es 'procesada', 'sin_cambios' o 'error'
+    """
+    with open(ruta_original, 'rb') as f:
+        contenido = f.read()
+    huella = hashlib.sha256(contenido).hexdigest()[:10]
+    if previo and previo.get('hash') == huella and all(
+        os.path.exists(os.path.join(carpeta_salida, nombre))
+        for por_ancho in previo['variantes'].values() for nombre in por_ancho.values()
+    ):
+        return 'sin_cambios', previo
+
+    from PIL import Image, ImageOps, UnidentifiedImageError  # Solo al procesar (ver docstring del módulo)
+
+    try:
+        with Image.open(ruta_original) as imagen:
+            imagen = ImageOps.exif_transpose(imagen).convert('RGB')
+    except (UnidentifiedImageError, OSError) as e:
+        return 'error', {'hash': huella, 'error': str(e)}
+
+    entrada = {'hash': huella, 'ancho': imagen.width, 'alto': imagen.height, 'variantes': {}}
+    for ancho in _anchos_para(imagen.width):
+        alto = max(round(imagen.height * ancho / imagen.width), 1)
+        reducida = imagen if ancho == imagen.width else imagen.resize((ancho, alto), Image.LANCZOS)
+        for extension, opciones in FORMATOS.items():
+            nombre = f"{cn}-{ancho}.{huella}.{extension}"
+            ruta = os.path.join(carpeta_salida, nombre)
+            if not os.path.exists(ruta):
+                temporal = f"{ruta}.{os.getpid()}.tmp"
+                reducida.save(temporal, **opciones)
+                os.replace(temporal, ruta)
+            entrada['variantes'].setdefault(extension, {})[str(ancho)] = nombre
+    return 'procesada', entrada
+
+
+def leer_indice(carpeta=None):
+    try:
+        with open(os.path.join(carpeta or carpeta_variantes(), NOMBRE_INDICE), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _borrar_obsoletas(carpeta, indice):
+    """Borra las variantes que ya no aparecen en el índice (fotos que han cambiado)."""
+    vigentes = {nombre for entrada in indice.values() for por_ancho in entrada.get('variantes', {}).values()
+                for nombre in por_ancho.values()}
+    borradas = 0
+    for nombre in os.listdir(carpeta):
+        if nombre != NOMBRE_INDICE and nombre not in vigentes:
+            os.remove(os.path.join(carpeta, nombre))
+            borradas += 1
+    return borradas
+
+
+def procesar_biblioteca(procesos=None, forzar=False, carpeta_origen=None, al_terminar=None):
+    """
+    Genera las variantes de todas las fotos en paralelo (un proceso por núcleo).
+
+    Args:
+        procesos (int): Procesos del pool (por defecto os.cpu_count())
+        forzar (bool): Regenerar aunque el contenido no haya cambiado
+        carpeta_origen (str): Carpeta de los originales (por defecto MEDIA_ROOT/efp_imagenes)
+        al_terminar (callable): Recibe (cn, estado) al acabar cada foto
+
+    Returns:
+        Counter: Fotos por estado y 'borradas' (variantes obsoletas eliminadas)
+    """
+    origen = carpeta_origen or carpeta_imagenes()
+    salida = os.path.join(origen, CARPETA_VARIANTES)
+    os.makedirs(salida, exist_ok=True)
+    al_terminar = al_terminar or (lambda cn, estado: None)
+    previo = {} if forzar else leer_indice(salida)
+    originales = sorted(
+        (nombre[:-4], os.path.join(origen, nombre)) for nombre in os.listdir(origen) if nombre.endswith('.jpg')
+    )
+
+    indice, totales = {}, Counter()
+    with ProcessPoolExecutor(max_workers=procesos or os.cpu_count()) as ejecutor:
+        futuros = {
+            ejecutor.submit(procesar_imagen, cn, ruta, salida, previo.get(cn)): cn for cn, ruta in originales
+        }
+        for futuro in as_completed(futuros):
+            cn = futuros[futuro]
+            estado, entrada = futuro.result()
+            totales[estado] += 1
+            if estado != 'error':
+                indice[cn] = entrada
+            al_terminar(cn, estado)
+
+    escribir_atomico(os.path.join(salida, NOMBRE_INDICE), json.dumps(indice, sort_keys=True).encode('utf-8'))
+    totales['borradas'] = _borrar_obsoletas(salida, indice)
+    return totales
+
+
+def _leer_json(ruta):
+    with open(ruta, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class IndiceEnMemoria:
+    """
+    Fichero leído una vez por proceso y releído cuando cambia su fecha de modificación.
+
+    Para no hacer un stat() por cada imagen de la página, la fecha se comprueba
+    como mucho una vez cada `intervalo` segundos.
+    """
+
+    def __init__(self, ruta, intervalo=2.0, cargar=None, vacio=dict):
+        """
+        Args:
+            ruta (callable): Devuelve la ruta del fichero (se evalúa en cada comprobación,
+                así sigue a los cambios de MEDIA_ROOT en los tests)
+            intervalo (float): Segundos entre comprobaciones
+            cargar (callable): Recibe la ruta y devuelve los datos (por defecto, el JSON del fichero)
+            vacio (callable): Datos cuando el fichero no existe o no se puede leer
+        """
+        self.ruta = ruta
+        self.intervalo = intervalo
+        self.cargar = cargar or _leer_json
+        self.vacio = vacio
+        self._cerrojo = threading.Lock()
+        self._datos = vacio()
+        self._firma = None
+        self._comprobado = 0.0
+
+    def datos(self):
+        ahora = time.monotonic()
+        ruta = self.ruta()
+        if ahora - self._comprobado < self.intervalo and self._firma and self._firma[0] == ruta:
+            return self._datos
+        with self._cerrojo:
+            try:
+                estado = os.stat(ruta)
+                firma = (ruta, estado.st_mtime_ns, estado.st_size)
+            except FileNotFoundError:
+                firma = (ruta, None, None)
+            if firma != self._firma:
+                try:
+                    self._datos = self.cargar(ruta)
+                except (OSError, ValueError):
+                    self._datos = self.vacio()
+                self._firma = firma
+            self._comprobado = ahora
+        return self._datos
+
+    def invalidar(self):
+        """Fuerza la comprobación en la próxima lectura."""
+        self._comprobado = 0.0
+
+
+indice_variantes = IndiceEnMemoria(lambda: os.path.join(carpeta_variantes(), NOMBRE_INDICE))
+
+
+# Estados del manifiesto de descargas con la foto en disco
+ESTADOS_CON_FOTO = {'descargada', 'sin_cambios', 'existente'}
+
+
+def _cns_del_manifiesto(ruta):
+    return frozenset(cn for cn, entrada in _leer_json(ruta).items() if entrada.get('estado') in ESTADOS_CON_FOTO)
+
+
+def _cns_de_la_carpeta(ruta):
+    return frozenset(nombre[:-4] for nombre in os.listdir(ruta) if nombre.endswith('.jpg'))
+
+
+# None mientras no haya manifiesto: entonces manda el listado de la carpeta,
+# que también se relee solo cuando cambia (añadir o borrar un fichero cambia
+# la fecha de modificación del directorio)
+manifiesto_fotos = IndiceEnMemoria(ruta_manifiesto, cargar=_cns_del_manifiesto, vacio=lambda: None)
+carpeta_fotos = IndiceEnMemoria(carpeta_imagenes, cargar=_cns_de_la_carpeta, vacio=frozenset)
+
+
+def fotos_disponibles():
+    """
+    CN que tienen foto en MEDIA_ROOT/efp_imagenes.
+
+    Sale del manifiesto que escribe el descargador (efp/descargas.py) o, si
+    todavía no hay manifiesto (fotos copiadas a mano), del listado de la carpeta.
+
+    Returns:
+        frozenset: Códigos nacionales
+    """
+    cns = manifiesto_fotos.datos()
+    return carpeta_fotos.datos() if cns is None else cns
+
+
+def tiene_foto(cn):
+    """True si el CN tiene foto original o variantes; así las plantillas no piden URLs que darían 404."""
+    cn = str(cn or '').strip()
+    return bool(cn) and (cn in fotos_disponibles() or cn in indice_variantes.datos())
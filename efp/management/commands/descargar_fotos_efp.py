@@ -1,73 +1,50 @@
-import csv
-import os
-import requests
-from django.core.management.base import BaseCommand
-from django.conf import settings
+import time
 
-class Command(BaseCommand):
-    help = 'Descarga imágenes de EFP desde el archivo CSV local en efp/data/'
-
-    def handle(self, *args, **kwargs):
-        # 1. Definir Rutas
-        # Ahora buscamos en la carpeta ordenada 'efp/data'
-        csv_path = os.path.join(settings.BASE_DIR, 'efp', 'data', 'efp_fotos.csv')
-        img_folder = os.path.join(settings.MEDIA_ROOT, 'efp_imagenes')
-
-        # Crear carpeta de destino si no existe
-        if not os.path.exists(img_folder):
-            os.makedirs(img_folder)
-            self.stdout.write(self.style.SUCCESS(f'Carpeta de imágenes creada: {img_folder}'))
-
-        # 2. Verificar CSV
-        if not os.path.exists(csv_path):
-            self.stdout.write(self.style.ERROR(f'No encuentro el archivo en: {csv_path}'))
-            return
+from django.core.management.base import BaseCommand, CommandError
 
-        self.stdout.write(f"Leyendo CSV desde: {csv_path}")
+from efp.descargas import DescargadorFotos, carpeta_imagenes, leer_catalogo_fotos
 
-        # 3. Procesar
-        with open(csv_path, 'r', encoding='utf-8') as f:
-            # Tu CSV parece estándar (separado por comas), DictReader lo detectará bien
-            reader = csv.DictReader(f)
-            
-            count = 0
-            errors = 0
-            skipped = 0
-            
-            for row in reader:
-                # Usamos .get() para evitar fallos si la columna se llama ligeramente distinto
-                cn = row.get('Codigo Nacional', '').strip()
-                url = row.get('Imagen_URL', '').strip()
 
-                if cn and url and url.startswith('http'):
-                    filename = f"{cn}.jpg"
-                    filepath = os.path.join(img_folder, filename)
-
-                    # Si ya existe, nos la saltamos para ganar tiempo
-                    if os.path.exists(filepath):
-                        skipped += 1
-                        continue
-
-                    try:
-                        # User-Agent para que no nos bloqueen por parecer un bot
-                        headers = {'User-Agent': 'Mozilla/5.0'}
-                        response = requests.get(url, headers=headers, timeout=10)
-                        
-                        if response.status_code == 200:
-                            with open(filepath, 'wb') as img_file:
-                                img_file.write(response.content)
-                            count += 1
-                            if count % 20 == 0:
-                                self.stdout.write(f"Descargadas: {count}...")
-                        else:
-                            self.stdout.write(self.style.WARNING(f'Error {response.status_code} URL para CN {cn}'))
-                            errors += 1
-                    except Exception as e:
-                        self.stdout.write(self.style.ERROR(f'Excepción en CN {cn}: {e}'))
-                        errors += 1
-                else:
-                    # Fila sin foto o sin CN válido
-                    pass
+class Command(BaseCommand):
+    help = 'Descarga (o revalida) las imágenes de EFP listadas en efp/data/efp_fotos.csv'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--csv', help='CSV con columnas "Codigo Nacional" e "Imagen_URL" (por defecto efp/data)')
+        parser.add_argument('--hilos', type=int, default=16, help='Descargas simultáneas')
+        parser.add_argument('--por-host', type=int, default=4, help='Descargas simultáneas contra un mismo host')
+        parser.add_argument('--reintentos', type=int, default=3, help='Reintentos por foto (espera exponencial)')
+        parser.add_argument('--timeout', type=float, default=10)
+        parser.add_argument('--solo-faltan', action='store_true',
+                            help='No revalidar las fotos que ya existen (sin peticiones condicionales)')
+        parser.add_argument('--limite', type=int, help='Descargar solo las N primeras del CSV')
+
+    def handle(self, *args, **options):
+        try:
+            fotos = leer_catalogo_fotos(options['csv'])
+        except FileNotFoundError as e:
+            raise CommandError(f'No encuentro el CSV: {e.filename}')
+        if options['limite']:
+            fotos = fotos[:options['limite']]
+        self.stdout.write(f"{len(fotos)} fotos en el CSV -> {carpeta_imagenes()}")
+
+        hechas = 0
+
+        def progreso(cn, estado):
+            nonlocal hechas
+            hechas += 1
+            if estado == 'error':
+                self.stdout.write(self.style.WARNING(f"Error en CN {cn}"))
+            if hechas % 200 == 0:
+                self.stdout.write(f"  {hechas}/{len(fotos)}...")
+
+        inicio = time.perf_counter()
+        totales = DescargadorFotos(
+            hilos=options['hilos'], por_host=options['por_host'], reintentos=options['reintentos'],
+            timeout=options['timeout'], solo_faltan=options['solo_faltan'], al_terminar=progreso,
+        ).descargar(fotos)
 
         self.stdout.write(self.style.SUCCESS('--------------------------------------------------'))
-        self.stdout.write(self.style.SUCCESS(f'FIN. Descargadas: {count} | Saltadas (ya existían): {skipped} | Errores: {errors}'))
\ No newline at end of file
+        self.stdout.write(self.style.SUCCESS(
+            f"FIN en {time.perf_counter() - inicio:.1f} s. Descargadas: {totales['descargada']} | "
+            f"Sin cambios: {totales['sin_cambios'] + totales['existente']} | Errores: {totales['error']}"
+        ))
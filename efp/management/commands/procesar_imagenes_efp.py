@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from efp.imagenes import ANCHOS, carpeta_variantes, procesar_biblioteca
+
+
+class Command(BaseCommand):
+    help = 'Genera miniaturas WebP/JPEG en varios anchos de las fotos EFP descargadas (en paralelo)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--procesos', type=int, help='Procesos en paralelo (por defecto, uno por núcleo)')
+        parser.add_argument('--forzar', action='store_true', help='Regenerar también las que no han cambiado')
+
+    def handle(self, *args, **options):
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            raise CommandError('Hace falta Pillow para procesar las imágenes: pip install Pillow')
+
+        inicio = time.perf_counter()
+        totales = procesar_biblioteca(procesos=options['procesos'], forzar=options['forzar'])
+        self.stdout.write(self.style.SUCCESS(
+            f"FIN en {time.perf_counter() - inicio:.1f} s -> {carpeta_variantes()} (anchos {ANCHOS}). "
+            f"Procesadas: {totales['procesada']} | Sin cambios: {totales['sin_cambios']} | "
+            f"Errores: {totales['error']} | Variantes obsoletas borradas: {totales['borradas']}"
+        ))
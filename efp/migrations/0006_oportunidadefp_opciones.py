@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-19 17:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efp', '0005_oportunidadefp_efp_oportun_farmaci_8d5429_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oportunidadefp',
+            name='opciones',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.9 on 2026-10-19 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efp', '0006_oportunidadefp_opciones'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='oportunidadefp',
+            index=models.Index(fields=['farmacia_id', 'ahorro_potencial'], name='efp_oportun_farmaci_2a1496_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='oportunidadefp',
+            index=models.Index(fields=['farmacia_id', 'nombre_grupo'], name='efp_oportun_farmaci_f8b2fd_idx'),
+        ),
+    ]
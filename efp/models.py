@@ -27,12 +27,17 @@ class OportunidadEFP(CompetidoresStatsMixin, models.Model):
     
     # Competidores (String parseable)
     a_sustituir = models.TextField(blank=True)
+    # Productos elegibles como preferencia (se calcula al sincronizar)
+    opciones = models.JSONField(default=list, blank=True)
 
     class Meta:
         ordering = ['-ahorro_potencial']
         unique_together = ('farmacia_id', 'id_agrupacion')
         indexes = [
             models.Index(fields=['farmacia_id', 'familia']),
+            # Orden por defecto (dashboard, datos brutos) y orden de configuracion
+            models.Index(fields=['farmacia_id', 'ahorro_potencial']),
+            models.Index(fields=['farmacia_id', 'nombre_grupo']),
         ]
 
     def __str__(self):
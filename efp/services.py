@@ -1,13 +1,18 @@
 # efp/services.py
 import os
 import json
+import math
 import random
+from decimal import Decimal
 from django.conf import settings
-from .models import OportunidadEFP
-from core.db_utils import databricks_connection, bulk_create_or_update, parse_percentage_string
-from dotenv import load_dotenv
+from django.core.paginator import Paginator
+from .models import OportunidadEFP, PreferenciaEFP
+from django.db.models import Q, Count, Sum
+from core.db_utils import bulk_create_or_update, registrar_ejecucion_sync, ejecutar_consulta_medida
+from core.cache_utils import cache_por_farmacia, incrementar_version
+from core import preferencias
+from core.preferencias import TipoPreferencia
 
-load_dotenv()
 
 # Mapeo de Iconos para las 14 Superfamilias (Para usar en el Template luego)
 ICONOS_FAMILIAS = {
@@ -196,55 +201,292 @@ def sincronizar_efp_desde_databricks(farmacia_id, fecha_inicio, fecha_fin):
         ORDER BY SUM(Unidades * (Mejor_Margen_Eur - Margen_Unit_Eur)) DESC
         """
         
-        with databricks_connection() as (connection, cursor):
-            cursor.execute(query)
-            rows = cursor.fetchall()
-
-        objs = []
-        for row in rows:
-            id_g = int(row[0])
-            if id_g in mapa_jerarquia:
-                fam, nombre_bonito = mapa_jerarquia[id_g]
-                subfam = nombre_bonito
-            else:
-                fam = "OTRAS"
-                subfam = row[1] or "Desconocido"
-
-            objs.append(OportunidadEFP(
-                farmacia_id=farmacia_id,
-                id_agrupacion=int(row[0]),
-                nombre_grupo=subfam,
-                familia=fam,
-                subfamilia=subfam,
-                producto_recomendado=row[2],
-                pvp_medio=float(row[3] or 0),
-                margen_pct=float(row[4] or 0),
-                ahorro_potencial=float(row[5] or 0),
-                a_sustituir=row[6] or "",
-                codigo_nacional=str(row[7]) if row[7] else ""
-            ))
+        with registrar_ejecucion_sync(farmacia_id, 'EFP', fecha_inicio, fecha_fin) as medicion:
+            rows = ejecutar_consulta_medida(query, medicion)
+
+            with medicion.fase('transformacion'):
+                objs = []
+                for row in rows:
+                    id_g = int(row[0])
+                    if id_g in mapa_jerarquia:
+                        fam, nombre_bonito = mapa_jerarquia[id_g]
+                        subfam = nombre_bonito
+                    else:
+                        fam = "OTRAS"
+                        subfam = row[1] or "Desconocido"
+
+                    objs.append(OportunidadEFP(
+                        farmacia_id=farmacia_id,
+                        id_agrupacion=int(row[0]),
+                        nombre_grupo=subfam,
+                        familia=fam,
+                        subfamilia=subfam,
+                        producto_recomendado=row[2],
+                        pvp_medio=float(row[3] or 0),
+                        margen_pct=float(row[4] or 0),
+                        ahorro_potencial=float(row[5] or 0),
+                        a_sustituir=row[6] or "",
+                        codigo_nacional=str(row[7]) if row[7] else ""
+                    ))
         
-        num_created = bulk_create_or_update(OportunidadEFP, farmacia_id, objs)
+                # Precalculamos las opciones de preferencia de cada grupo
+                for obj in objs:
+                    obj.opciones = obj.calcular_opciones()
+
+            with medicion.fase('escritura'):
+                num_created = bulk_create_or_update(OportunidadEFP, farmacia_id, objs)
+                # Los datos de la farmacia han cambiado: invalidamos su caché
+                incrementar_version(farmacia_id)
+            medicion.ejecucion.filas_escritas = num_created
         return num_created, None
 
     except Exception as e:
         return 0, str(e)
     
-def generar_pregunta_examen(farmacia_id):
+# --- PREFERENCIAS EN BLOQUE ---
+# La lógica es común con AH (core/preferencias.py)
+
+PREFERENCIAS_EFP = TipoPreferencia(
+    PreferenciaEFP, OportunidadEFP, campo_grupo='id_agrupacion', clave='id_agrupacion',
+    campo_producto='producto_preferido', tipo_grupo=int, columna_nombre='nombre_grupo',
+    etiqueta_grupo='Grupo ',
+)
+
+
+def guardar_preferencias_efp_masivo(farmacia_id, cambios):
     """
-    Genera una pregunta donde TODAS las opciones pertenecen al MISMO grupo terapéutico.
-    Devuelve lista de OBJETOS (dicts) con nombre, cn y pvp.
+    Aplica de una vez muchas preferencias EFP de una farmacia (ver `preferencias.guardar_masivo`).
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+        cambios (list): dicts {'id_agrupacion': int, 'producto': str}
+                        (producto vacío = volver al automático)
+
+    Returns:
+        tuple: (num_aplicadas, errores) con errores como lista de dicts {'id_agrupacion', 'error'}
     """
-    # 1. Buscamos grupos que tengan competencia
-    qs = OportunidadEFP.objects.filter(farmacia_id=farmacia_id).exclude(a_sustituir="")
-    items_posibles = list(qs)
-    
-    if not items_posibles: return None
+    return preferencias.guardar_masivo(PREFERENCIAS_EFP, farmacia_id, cambios)
+
+
+def exportar_preferencias_efp_csv(farmacia_id):
+    """
+    Exporta las preferencias EFP de una farmacia como CSV.
+
+    El nombre del grupo se incluye solo como referencia para quien edite el
+    fichero; al importar se usa `id_agrupacion`.
+
+    Returns:
+        str: CSV con columnas id_agrupacion, nombre_grupo, producto_preferido
+    """
+    return preferencias.exportar_csv(PREFERENCIAS_EFP, farmacia_id)
+
+
+def leer_preferencias_efp_csv(contenido):
+    """Convierte un CSV exportado con `exportar_preferencias_efp_csv` en cambios."""
+    return preferencias.leer_csv(PREFERENCIAS_EFP, contenido)
+
+
+def copiar_preferencias_efp(origen, destinos):
+    """
+    Copia las preferencias EFP de una farmacia a otras (validando en cada destino).
+
+    Returns:
+        dict: {destino: (num_aplicadas, errores)}
+    """
+    return preferencias.copiar(PREFERENCIAS_EFP, origen, destinos)
+
+
+# --- CÁLCULOS CACHEADOS POR FARMACIA ---
+# Se invalidan solos al subir la versión de datos de la farmacia (ver core/cache_utils)
+
+# Tarjetas por página en el dashboard EFP
+TARJETAS_POR_PAGINA = 24
+
+
+@cache_por_farmacia('efp_familias')
+def facetas_familias_efp(farmacia_id):
+    """
+    Familias de la farmacia con su número de grupos y ahorro total.
+
+    Se resuelve con un único GROUP BY sobre el índice (farmacia_id, familia).
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+
+    Returns:
+        list: dicts {'familia', 'num', 'ahorro'} ordenados por familia
+    """
+    return list(
+        OportunidadEFP.objects.filter(farmacia_id=farmacia_id)
+        .values('familia')
+        .annotate(num=Count('id'), ahorro=Sum('ahorro_potencial'))
+        .order_by('familia')
+    )
+
+
+def aplicar_preferencias_efp(farmacia_id, oportunidades):
+    """
+    Sustituye el recomendado por la preferencia manual de cada grupo (en sitio).
+
+    Marca `es_preferido` en cada oportunidad; las preferencias se leen en una
+    sola consulta para todos los grupos de la lista.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+        oportunidades (list): OportunidadEFP a modificar
+    """
+    prefs = {
+        p.id_agrupacion: p.producto_preferido
+        for p in PreferenciaEFP.objects.filter(
+            farmacia_id=farmacia_id,
+            id_agrupacion__in=[o.id_agrupacion for o in oportunidades],
+        )
+    }
+
+    for item in oportunidades:
+        item.es_preferido = False
+        if item.id_agrupacion in prefs:
+            prod_pref = prefs[item.id_agrupacion]
+            if item.producto_recomendado != prod_pref:
+                stats = item.get_competidores_stats()
+                match = next((s for s in stats if s['nombre'] == prod_pref), None)
+
+                if match:
+                    item.producto_recomendado = prod_pref
+                    item.margen_pct = match['margen']
+                    item.es_preferido = True
+
+
+def resumen_dashboard_efp(farmacia_id, familia_activa, pagina=1):
+    """
+    Calcula las tarjetas del dashboard EFP aplicando las preferencias manuales.
+
+    La familia y la página vienen de la URL: antes de buscar en la caché se
+    normalizan con las facetas (familia desconocida -> 'TODAS', página fuera
+    de rango -> la primera o la última), para que valores inventados no
+    creen entradas nuevas con el mismo contenido.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+        familia_activa (str): Familia a mostrar o 'TODAS'
+        pagina (int): Número de página de tarjetas
 
-    random.shuffle(items_posibles)
+    Returns:
+        dict: oportunidades, familias, familia_activa (normalizada), total_ahorro,
+              ahorro_mensual, total_referencias y pagina (datos de paginación)
+    """
+    num_por_familia = {f['familia']: f['num'] for f in facetas_familias_efp(farmacia_id)}
+    if familia_activa not in num_por_familia:
+        familia_activa = 'TODAS'
+    total = sum(num_por_familia.values()) if familia_activa == 'TODAS' else num_por_familia[familia_activa]
+    num_paginas = max(math.ceil(total / TARJETAS_POR_PAGINA), 1)
+    return _pagina_dashboard_efp(farmacia_id, familia_activa, min(max(pagina, 1), num_paginas))
+
+
+@cache_por_farmacia('efp_dashboard')
+def _pagina_dashboard_efp(farmacia_id, familia_activa, pagina):
+    """
+    Una página del dashboard EFP, con familia y página ya normalizadas.
+
+    El filtro de familia y la paginación se hacen en la base de datos, y las
+    preferencias solo se consultan para los grupos de la página mostrada.
+    """
+    familias = facetas_familias_efp(farmacia_id)
+
+    qs = OportunidadEFP.objects.filter(farmacia_id=farmacia_id)
+    if familia_activa != 'TODAS':
+        qs = qs.filter(familia=familia_activa)
+        facetas = [f for f in familias if f['familia'] == familia_activa]
+    else:
+        facetas = familias
 
-    # 2. Iteramos para encontrar un grupo válido
-    for item in items_posibles:
+    # Totales a partir de las facetas (sin recorrer las filas)
+    total_referencias = sum(f['num'] for f in facetas)
+    total_ahorro = sum((f['ahorro'] for f in facetas), Decimal('0'))
+
+    paginador = Paginator(qs, TARJETAS_POR_PAGINA)
+    # Le damos el total ya conocido para ahorrarnos el COUNT(*)
+    paginador.count = total_referencias
+    pagina_obj = paginador.get_page(pagina)
+    oportunidades_list = list(pagina_obj.object_list)
+
+    # --- LOGICA DE PREFERENCIAS (solo de la página) ---
+    aplicar_preferencias_efp(farmacia_id, oportunidades_list)
+
+    return {
+        'oportunidades': oportunidades_list,
+        'familias': familias,
+        'familia_activa': familia_activa,
+        'total_ahorro': total_ahorro,
+        'ahorro_mensual': total_ahorro / 12,
+        'total_referencias': total_referencias,
+        # Solo datos planos: un Page lleva dentro el queryset completo
+        'pagina': {
+            'numero': pagina_obj.number,
+            'num_paginas': paginador.num_pages,
+            'anterior': pagina_obj.previous_page_number() if pagina_obj.has_previous() else None,
+            'siguiente': pagina_obj.next_page_number() if pagina_obj.has_next() else None,
+        },
+    }
+
+
+@cache_por_farmacia('efp_competidores')
+def competidores_oportunidad_efp(farmacia_id, pk, con_preferencia=True):
+    """
+    Alternativas de una oportunidad EFP (fragmentos que se cargan al abrirlos).
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+        pk (int): ID de la oportunidad
+        con_preferencia (bool): Aplicar la preferencia manual, como en las tarjetas del
+            dashboard (datos brutos muestra la oportunidad tal cual)
+
+    Returns:
+        dict | None: oportunidad y competidores, o None si no es de la farmacia
+    """
+    item = OportunidadEFP.objects.filter(farmacia_id=farmacia_id, pk=pk).first()
+    if item is None:
+        return None
+    if con_preferencia:
+        aplicar_preferencias_efp(farmacia_id, [item])
+    return {'oportunidad': item, 'competidores': item.get_competidores_stats()}
+
+
+@cache_por_farmacia('efp_buscador')
+def buscar_oportunidades_efp(farmacia_id, query):
+    """Oportunidades EFP cuyo grupo, producto o competidores contienen `query`."""
+    return list(OportunidadEFP.objects.filter(farmacia_id=farmacia_id).filter(
+        Q(nombre_grupo__icontains=query) |
+        Q(a_sustituir__icontains=query) |
+        Q(producto_recomendado__icontains=query)
+    ))
+
+
+@cache_por_farmacia('efp_datos_brutos')
+def listar_datos_brutos_efp(farmacia_id, orden):
+    """Todas las oportunidades EFP de la farmacia ordenadas por `orden` (ya validado)."""
+    return list(OportunidadEFP.objects.filter(farmacia_id=farmacia_id).order_by(orden))
+
+
+@cache_por_farmacia('efp_banco_preguntas')
+def banco_preguntas_efp(farmacia_id):
+    """
+    Prepara todas las preguntas de examen EFP posibles de una farmacia.
+
+    Cada grupo con al menos un competidor distinto del ganador es una
+    pregunta; el parseo de `a_sustituir` se hace una sola vez por versión de
+    datos y luego cada examen solo sortea sobre la lista cacheada.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+
+    Returns:
+        list: dicts con id_pregunta, pregunta_texto, ganador y distractores
+    """
+    banco = []
+    qs = OportunidadEFP.objects.filter(farmacia_id=farmacia_id).exclude(a_sustituir="")
+
+    for item in qs:
         # --- GANADOR ---
         ganador = {
             'nombre': item.producto_recomendado, 
@@ -291,22 +533,76 @@ def generar_pregunta_examen(farmacia_id):
         unique_distractores = {d['nombre']: d for d in distractores_objs}.values()
         distractores_finales = list(unique_distractores)
 
-        # 3. Validar si tenemos suficientes opciones
-        # Intentamos conseguir 2 distractores
-        if len(distractores_finales) >= 1:
-            # Si hay 2 o más, cogemos 2. Si hay 1, cogemos 1.
-            count_to_take = min(len(distractores_finales), 2)
-            seleccion = random.sample(distractores_finales, count_to_take)
-            
-            opciones = [ganador] + seleccion
-            random.shuffle(opciones)
-            
-            return {
+        # Solo sirven los grupos con al menos un distractor
+        if distractores_finales:
+            banco.append({
                 'id_pregunta': str(item.id),
                 'pregunta_texto': item.nombre_grupo,
-                'producto_correcto': ganador['nombre'],
-                'opciones': opciones, # Lista de diccionarios
-                'explicacion': f"**{ganador['nombre']}** es la opción recomendada por rentabilidad en este grupo."
-            }
+                'ganador': ganador,
+                'distractores': distractores_finales,
+            })
+
+    return banco
+
+
+def _candidatos(pregunta):
+    """Ganador + distractores en orden alfabético (el orden al que apuntan los índices en sesión)."""
+    return sorted([pregunta['ganador']] + pregunta['distractores'], key=lambda o: o['nombre'])
+
+
+def _montar_pregunta(pregunta, indices):
+    """Construye el dict que usa la plantilla a partir de una entrada del banco y sus índices."""
+    candidatos = _candidatos(pregunta)
+    ganador = pregunta['ganador']
+    return {
+        'id_pregunta': pregunta['id_pregunta'],
+        'indices': indices,
+        'pregunta_texto': pregunta['pregunta_texto'],
+        'producto_correcto': ganador['nombre'],
+        'opciones': [candidatos[i] for i in indices], # Lista de diccionarios
+        'explicacion': f"**{ganador['nombre']}** es la opción recomendada por rentabilidad en este grupo."
+    }
+
+
+def generar_pregunta_examen(farmacia_id):
+    """
+    Genera una pregunta donde TODAS las opciones pertenecen al MISMO grupo terapéutico.
+    Devuelve lista de OBJETOS (dicts) con nombre, cn y pvp, y los índices
+    compactos (`id_pregunta` + `indices`) para guardar en la sesión.
+    """
+    # 1. Banco de preguntas válidas (cacheado por versión de datos)
+    banco = banco_preguntas_efp(farmacia_id)
+    
+    if not banco: return None
+
+    pregunta = random.choice(banco)
+    candidatos = _candidatos(pregunta)
+    idx_ganador = candidatos.index(pregunta['ganador'])
+
+    # 2. Intentamos conseguir 2 distractores
+    # Si hay 2 o más, cogemos 2. Si hay 1, cogemos 1.
+    otros = [i for i in range(len(candidatos)) if i != idx_ganador]
+    indices = [idx_ganador] + random.sample(otros, min(len(otros), 2))
+    random.shuffle(indices)
+    
+    return _montar_pregunta(pregunta, indices)
+
 
-    return None
\ No newline at end of file
+def recuperar_pregunta_examen(farmacia_id, id_pregunta, indices):
+    """
+    Reconstruye una pregunta a partir de su forma compacta guardada en sesión.
+
+    Args:
+        farmacia_id (str): ID de la farmacia
+        id_pregunta (str): ID de la pregunta en el banco
+        indices (list): Índices de las opciones mostradas
+
+    Returns:
+        dict | None: La pregunta, o None si ya no existe (p. ej. tras una sincronización)
+    """
+    for pregunta in banco_preguntas_efp(farmacia_id):
+        if pregunta['id_pregunta'] == id_pregunta:
+            if all(0 <= i < len(pregunta['distractores']) + 1 for i in indices):
+                return _montar_pregunta(pregunta, indices)
+            return None
+    return None
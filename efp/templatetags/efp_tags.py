@@ -1,4 +1,10 @@
+from functools import lru_cache
+from urllib.parse import quote
+
 from django import template
+from django.utils.html import format_html, format_html_join
+
+from efp.imagenes import indice_variantes, tiene_foto, url_imagen
 
 register = template.Library()
 
@@ -153,4 +159,94 @@ def efp_family_color(nombre_familia):
         "HIGIENE OÍDO":         ("#efebe9", "#4e342e"), # Marrón
         "HIGIENE OIDO":         ("#efebe9", "#4e342e")
     }
-    return colores.get(str(nombre_familia).strip().upper(), ("#ffffff", "#6c757d"))
\ No newline at end of file
+    return colores.get(str(nombre_familia).strip().upper(), ("#ffffff", "#6c757d"))
+
+
+@lru_cache(maxsize=64)
+def placeholder_foto(ancho, alto=None, texto='Sin foto'):
+    """
+    Placeholder SVG en línea (data URI): no cuesta ninguna petición.
+
+    Args:
+        ancho (int): Ancho en px
+        alto (int): Alto en px (por defecto, cuadrado)
+        texto (str): Texto centrado
+    """
+    alto = alto or ancho
+    svg = (
+        f"<svg xmlns='http://www.w3.org/2000/svg' width='{ancho}' height='{alto}' viewBox='0 0 {ancho} {alto}'>"
+        f"<rect width='100%' height='100%' fill='#f8f9fa'/>"
+        f"<text x='50%' y='50%' dominant-baseline='middle' text-anchor='middle' fill='#adb5bd' "
+        f"font-family='sans-serif' font-size='{max(min(ancho, alto) // 7, 8)}'>{texto}</text></svg>"
+    )
+    return 'data:image/svg+xml,' + quote(svg)
+
+
+@register.filter
+def efp_tiene_foto(cn):
+    """True si el CN tiene foto en el servidor (según el manifiesto de descargas)."""
+    return tiene_foto(cn)
+
+
+@register.filter
+def efp_foto_url(cn, ancho=120):
+    """
+    URL de la foto original de un CN o, si no la hay, un placeholder en línea.
+
+    Uso:
+        <img src="{{ item.codigo_nacional|efp_foto_url:200 }}">
+    """
+    if tiene_foto(cn):
+        return url_imagen(f"{str(cn).strip()}.jpg")
+    return placeholder_foto(int(ancho))
+
+
+@register.simple_tag
+def efp_imagen(cn, ancho, clase='', estilo='', alt='', onerror=''):
+    """
+    Foto de un producto EFP con sus variantes (WebP y JPEG en varios anchos) y carga diferida.
+
+    Uso:
+        {% efp_imagen item.codigo_nacional 150 clase="img-fluid" alt=item.producto_recomendado %}
+
+    Args:
+        cn: Código nacional
+        ancho (int): Ancho (px CSS) al que se muestra; el navegador elige la variante con `sizes`
+        onerror (str): JavaScript si falla la carga
+
+    Si el CN no tiene foto se pinta directamente el placeholder (sin petición ni 404);
+    si aún no tiene variantes (ver procesar_imagenes_efp) se usa el JPEG original.
+    """
+    if not tiene_foto(cn):
+        return format_html(
+            '<img src="{}" class="{}" style="{}" alt="{}">', placeholder_foto(int(ancho)), clase, estilo, alt,
+        )
+    entrada = indice_variantes.datos().get(str(cn))
+    if onerror and entrada:
+        # Dentro del <picture> el <source> WebP manda sobre src: se quita antes de aplicar el onerror
+        onerror = "this.previousElementSibling.remove(); this.srcset=''; " + onerror
+    atributos = format_html(
+        'class="{}" style="{}" alt="{}" loading="lazy" decoding="async"{}', clase, estilo, alt,
+        format_html(' onerror="{}"', onerror) if onerror else '',
+    )
+    if not entrada:
+        return format_html('<img src="{}" {}>', url_imagen(f"{cn}.jpg"), atributos)
+
+    srcset = {
+        extension: format_html_join(
+            ', ', '{} {}w', ((url_imagen(nombre, 'variantes'), a) for a, nombre in sorted(
+                por_ancho.items(), key=lambda v: int(v[0])
+            ))
+        )
+        for extension, por_ancho in entrada['variantes'].items()
+    }
+    # src para navegadores sin srcset: la variante JPEG más pequeña que cubre el ancho mostrado
+    anchos_jpg = sorted(entrada['variantes']['jpg'], key=int)
+    ancho_src = next((a for a in anchos_jpg if int(a) >= int(ancho)), anchos_jpg[-1])
+    return format_html(
+        '<picture style="display: contents"><source type="image/webp" srcset="{}" sizes="{}px">'
+        '<img src="{}" srcset="{}" sizes="{}px" {}></picture>',
+        srcset['webp'], ancho, url_imagen(entrada['variantes']['jpg'][ancho_src], 'variantes'),
+        srcset['jpg'], ancho, atributos,
+    )
+
@@ -1,3 +1,410 @@
-from django.test import TestCase
+import importlib.util
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.template import Context, Template
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core.benchmarks import cliente_de_farmacia
+from core.cache_utils import clave_cache
+from core.datos_sinteticos import cargar_en_django, ids_grupos_efp
+from core.tests import FARMACIA, GRANDE, NumeroConsultasMixin, PlanesConsultaMixin, WarehouseLocalMixin
+from core.warehouse_local import FARMACIAS_DEMO
+from efp import descargas
+from efp.descargas import DescargadorFotos, guardar_manifiesto, leer_manifiesto
+from efp.imagenes import fotos_disponibles, indice_variantes, leer_indice, manifiesto_fotos, procesar_biblioteca
+from efp.models import OportunidadEFP, PreferenciaEFP
+from efp.services import copiar_preferencias_efp, resumen_dashboard_efp, sincronizar_efp_desde_databricks
+
+
+class PlanesConsultaEFPTests(PlanesConsultaMixin, TestCase):
+
+    def test_vistas_sin_recorridos_completos(self):
+        for url in (
+            '/efp/dashboard/',
+            '/efp/dashboard/?familia=DERMATOLOGÍA',
+            '/efp/dashboard/?page=2',
+            '/efp/buscador/?q=RIVAL',
+            '/efp/datos-brutos/',
+            '/efp/datos-brutos/?order=nombre_grupo',
+            '/efp/entrenamiento/',
+            '/efp/examen/',
+            '/efp/configuracion/',
+            '/efp/configuracion/exportar/',
+        ):
+            self.assertSinRecorridosCompletos(url)
+
+    def test_datos_brutos_ordena_por_indice(self):
+        self.assertUsaIndiceOrdenado(
+            OportunidadEFP.objects.filter(farmacia_id=FARMACIA).order_by('-ahorro_potencial')
+        )
+
+    def test_configuracion_ordena_por_indice(self):
+        self.assertUsaIndiceOrdenado(
+            OportunidadEFP.objects.filter(farmacia_id=FARMACIA).order_by('nombre_grupo')
+        )
+
+    def test_facetas_agrupan_por_indice(self):
+        self.assertUsaIndiceOrdenado(
+            OportunidadEFP.objects.filter(farmacia_id=FARMACIA).values('familia').order_by('familia')
+        )
+
+
+class SincronizacionLocalEFPTests(WarehouseLocalMixin, TestCase):
+
+    def test_sincroniza_con_la_consulta_real(self):
+        farmacia = FARMACIAS_DEMO[0]
+        num, error = sincronizar_efp_desde_databricks(farmacia, '2024-01-01', '2025-01-01')
+
+        self.assertIsNone(error)
+        self.assertGreater(num, 0)
+        oportunidad = OportunidadEFP.objects.filter(farmacia_id=farmacia).order_by('-ahorro_potencial').first()
+        self.assertNotEqual(oportunidad.familia, 'OTRAS')
+        self.assertGreater(len(oportunidad.opciones), 1)
+        # Formato de competidores: nombre (unidades###margen###cuota###cn###pvp)
+        self.assertRegex(oportunidad.a_sustituir, r'^.+ \(\d+###\d+###\d+\.\d###\d+###\d+\.\d\d\)')
+
+
+class NumeroConsultasEFPTests(NumeroConsultasMixin, TestCase):
+
+    def test_vistas_de_lectura(self):
+        for url, maximo in (
+            ('/efp/dashboard/', 5),
+            ('/efp/buscador/?q=TOS', 3),
+            ('/efp/datos-brutos/', 3),
+            ('/efp/entrenamiento/', 4),
+            ('/efp/examen/', 3),
+            ('/efp/configuracion/', 5),
+            ('/efp/configuracion/exportar/', 3),
+        ):
+            with self.subTest(url=url):
+                self.assertConsultasConstantes(maximo, 'get', url)
+
+    def test_opciones_configuracion(self):
+        self.assertConsultasConstantes(
+            2, 'get',
+            lambda f: f"/efp/configuracion/opciones/{OportunidadEFP.objects.filter(farmacia_id=f).first().pk}/",
+        )
+
+    def test_responder_examen(self):
+        self.assertConsultasConstantes(
+            1, 'post', '/efp/examen/', {'opcion': 0}, preparar=lambda c: c.get('/efp/examen/'),
+        )
+
+    def test_fragmento_competidores(self):
+        for formato, maximo in (('alternativas', 3), ('preferencia', 3), ('tabla', 2)):
+            with self.subTest(formato=formato):
+                self.assertConsultasConstantes(
+                    maximo, 'get',
+                    lambda f: f"/efp/fragmentos/competidores/"
+                              f"{OportunidadEFP.objects.filter(farmacia_id=f).first().pk}/?formato={formato}",
+                )
+
+    def test_dashboard_normaliza_pagina_y_familia(self):
+        cache.clear()
+        ultima = resumen_dashboard_efp(GRANDE, 'TODAS', 10 ** 6)
+        self.assertEqual(ultima['pagina']['numero'], ultima['pagina']['num_paginas'])
+        # Otra página fuera de rango o una familia inventada: la misma entrada de caché, sin consultas
+        with CaptureQueriesContext(connection) as consultas:
+            otra = resumen_dashboard_efp(GRANDE, 'TODAS', 999999)
+            desconocida = resumen_dashboard_efp(GRANDE, 'NO-EXISTE', ultima['pagina']['numero'])
+        self.assertEqual(len(consultas), 0, [c['sql'] for c in consultas])
+        self.assertEqual(otra['pagina'], ultima['pagina'])
+        self.assertEqual(desconocida['familia_activa'], 'TODAS')
+        for pagina in (10 ** 6, 999999):
+            self.assertIsNone(cache.get(clave_cache('efp_dashboard', GRANDE, ('TODAS', pagina))))
+
+    def test_modal_de_preferencia_bajo_demanda(self):
+        cliente = cliente_de_farmacia(self.usuarios[GRANDE], GRANDE)
+        preferencia = PreferenciaEFP.objects.filter(farmacia_id=GRANDE).first()
+        item = OportunidadEFP.objects.get(farmacia_id=GRANDE, id_agrupacion=preferencia.id_agrupacion)
+
+        pagina = cliente.get('/efp/dashboard/').content.decode()
+        self.assertNotIn('Mejor Margen Matemático', pagina)
+
+        # Con la preferencia aplicada, como se pintaba antes dentro de la tarjeta
+        fragmento = cliente.get(f"/efp/fragmentos/competidores/{item.pk}/?formato=preferencia").content.decode()
+        self.assertIn('Mejor Margen Matemático', fragmento)
+        marcada = re.search(r'value="([^"]*)"\s*checked', fragmento)
+        if item.producto_recomendado != preferencia.producto_preferido:
+            self.assertEqual(marcada.group(1), preferencia.producto_preferido)
+
+    def test_set_preferencia(self):
+        # Grupo sin preferencia previa en ambas farmacias (update_or_create crea en lugar de actualizar)
+        def preferencia(farmacia_id):
+            oportunidad = OportunidadEFP.objects.filter(farmacia_id=farmacia_id).exclude(
+                id_agrupacion__in=PreferenciaEFP.objects.filter(farmacia_id=farmacia_id).values('id_agrupacion')
+            ).first()
+            return {'id_agrupacion': oportunidad.id_agrupacion, 'producto': oportunidad.producto_recomendado}
+        self.assertConsultasConstantes(7, 'post', '/efp/set_preferencia/', preferencia)
+
+    def test_preferencias_masivo(self):
+        def cambios(farmacia_id):
+            return {'preferencias': [
+                {'id_agrupacion': o.id_agrupacion, 'producto': o.producto_recomendado}
+                for o in OportunidadEFP.objects.filter(farmacia_id=farmacia_id)
+            ]}
+        self.assertConsultasConstantes(
+            6, 'post', '/efp/configuracion/masivo/', cambios, content_type='application/json',
+        )
+
+
+class PreferenciasMasivasEFPTests(TestCase):
+    """Exportar/importar CSV, copiar entre farmacias y el `next` de los formularios (EFP)."""
+
+    OTRA = 'HFTEST2'
+
+    @classmethod
+    def setUpTestData(cls):
+        cargar_en_django([FARMACIA, cls.OTRA], grupos_ah=1, ids_efp=ids_grupos_efp(14),
+                         fraccion_preferencias=0.5, semilla=3)
+        cls.usuario = User.objects.create_user('preferencias_efp', password='x')
+        cls.staff = User.objects.create_user('preferencias_efp_staff', password='x', is_staff=True)
+
+    @staticmethod
+    def preferencias(farmacia_id):
+        return set(PreferenciaEFP.objects.filter(farmacia_id=farmacia_id).values_list(
+            'id_agrupacion', 'producto_preferido'
+        ))
+
+    def test_exportar_e_importar_csv(self):
+        cliente = cliente_de_farmacia(self.usuario, FARMACIA)
+        antes = self.preferencias(FARMACIA)
+        self.assertTrue(antes)
+
+        respuesta = cliente.get(reverse('efp_exportar_preferencias'))
+        self.assertEqual(respuesta['Content-Type'], 'text/csv; charset=utf-8')
+        PreferenciaEFP.objects.filter(farmacia_id=FARMACIA).delete()
+
+        archivo = SimpleUploadedFile('preferencias.csv', respuesta.content)
+        respuesta = cliente.post(reverse('efp_importar_preferencias'), {'archivo': archivo})
+        self.assertRedirects(respuesta, reverse('efp_configuracion'), fetch_redirect_response=False)
+        self.assertEqual(self.preferencias(FARMACIA), antes)
+
+    def test_copiar_preferencias(self):
+        PreferenciaEFP.objects.filter(farmacia_id=self.OTRA).delete()
+        origen = dict(self.preferencias(FARMACIA))
+
+        resultados = copiar_preferencias_efp(FARMACIA, [self.OTRA, FARMACIA])
+        self.assertEqual(list(resultados), [self.OTRA])
+        aplicadas, errores = resultados[self.OTRA]
+        self.assertEqual(aplicadas + len(errores), len(origen))
+        copiadas = self.preferencias(self.OTRA)
+        self.assertEqual(len(copiadas), aplicadas)
+        for id_agrupacion, producto in copiadas:
+            self.assertEqual(origen[id_agrupacion], producto)
+
+    def test_copiar_solo_staff(self):
+        PreferenciaEFP.objects.filter(farmacia_id=self.OTRA).delete()
+        datos = {'destinos': self.OTRA}
+
+        respuesta = cliente_de_farmacia(self.usuario, FARMACIA).post(reverse('efp_copiar_preferencias'), datos)
+        self.assertEqual(respuesta.status_code, 302)
+        self.assertFalse(self.preferencias(self.OTRA))
+
+        respuesta = cliente_de_farmacia(self.staff, FARMACIA).post(reverse('efp_copiar_preferencias'), datos)
+        self.assertRedirects(respuesta, reverse('efp_configuracion'), fetch_redirect_response=False)
+        self.assertTrue(self.preferencias(self.OTRA))
+
+    def test_next_solo_del_propio_sitio(self):
+        cliente = cliente_de_farmacia(self.usuario, FARMACIA)
+        oportunidad = OportunidadEFP.objects.filter(farmacia_id=FARMACIA).first()
+        for url, datos, por_defecto in (
+            (reverse('efp_preferencias_masivo'), {}, reverse('efp_configuracion')),
+            ('/efp/set_preferencia/', {'id_agrupacion': oportunidad.id_agrupacion, 'producto': ''},
+             reverse('efp_dashboard')),
+        ):
+            for siguiente, destino in (
+                ('/efp/datos-brutos/', '/efp/datos-brutos/'),
+                ('https://evil.example/', por_defecto),
+                ('//evil.example/', por_defecto),
+            ):
+                with self.subTest(url=url, next=siguiente):
+                    respuesta = cliente.post(url, {**datos, 'next': siguiente})
+                    self.assertRedirects(respuesta, destino, fetch_redirect_response=False)
+
+
+class ServidorFotos(BaseHTTPRequestHandler):
+    """
+    Servidor de imágenes de prueba: /ok/<cn> con ETag, /falla/<cn> da 503 la primera vez
+    y /no/<cn> da 404. Cuenta las peticiones por ruta.
+    """
+    peticiones = Counter()
+    contenido = b'\xff\xd8 foto'
+
+    def do_GET(self):
+        self.peticiones[self.path] += 1
+        if self.path.startswith('/no/'):
+            self.send_error(404)
+        elif self.path.startswith('/falla/') and self.peticiones[self.path] == 1:
+            self.send_error(503)
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(self.contenido)))
+            self.end_headers()
+            self.wfile.write(self.contenido)
+
+    def log_message(self, *args):
+        pass
+
+
+class DescargaFotosTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.servidor = ThreadingHTTPServer(('127.0.0.1', 0), ServidorFotos)
+        threading.Thread(target=cls.servidor.serve_forever, daemon=True).start()
+        cls.addClassCleanup(cls.servidor.server_close)
+        cls.addClassCleanup(cls.servidor.shutdown)
+        cls.base = f"http://127.0.0.1:{cls.servidor.server_port}"
+
+    def setUp(self):
+        ServidorFotos.peticiones.clear()
+        self.carpeta = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.carpeta)
+
+    def descargar(self, fotos):
+        return DescargadorFotos(carpeta=self.carpeta, hilos=4, por_host=2, espera_base=0.01).descargar(fotos)
+
+    def test_descarga_reintenta_y_reanuda(self):
+        fotos = [(str(cn), f"{self.base}/ok/{cn}") for cn in range(600000, 600010)]
+        fotos += [('700000', f"{self.base}/falla/700000"), ('800000', f"{self.base}/no/800000")]
+
+        totales = self.descargar(fotos)
+        self.assertEqual(totales, Counter(descargada=11, error=1))
+        self.assertEqual(ServidorFotos.peticiones['/falla/700000'], 2)
+        self.assertEqual((Path(self.carpeta) / '600000.jpg').read_bytes(), ServidorFotos.contenido)
+        # Sin temporales a medias
+        self.assertEqual(len(list(Path(self.carpeta).glob('.descarga-*'))), 0)
+
+        manifiesto = leer_manifiesto(self.carpeta)
+        self.assertEqual(manifiesto['600000']['etag'], '"v1"')
+        self.assertEqual(manifiesto['800000']['error'], 'HTTP 404')
+
+        # Segunda pasada: lo que ya está se revalida con If-None-Match y no se reescribe
+        totales = self.descargar(fotos)
+        self.assertEqual(totales, Counter(sin_cambios=11, error=1))
+
+    def test_ficheros_legibles_por_el_servidor_web(self):
+        self.descargar([('600000', f"{self.base}/ok/600000")])
+        guardar_manifiesto({'600000': {'estado': 'descargada'}}, self.carpeta)
+
+        # Los permisos de open() (0666 menos la umask), no los 0600 de mkstemp
+        mascara = os.umask(0o022)
+        os.umask(mascara)
+        for nombre in ('600000.jpg', 'manifiesto.json'):
+            modo = stat.S_IMODE(os.stat(Path(self.carpeta) / nombre).st_mode)
+            self.assertEqual(modo, 0o666 & ~mascara, nombre)
+
+    def test_importar_no_cambia_la_umask(self):
+        # Se importa al renderizar la primera plantilla, con hilos ya en marcha
+        with mock.patch('os.umask') as umask:
+            importlib.reload(descargas)
+        umask.assert_not_called()
+
+
+class DisponibilidadFotosTests(SimpleTestCase):
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        ajustes = override_settings(MEDIA_ROOT=media)
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+        self.carpeta = Path(media) / 'efp_imagenes'
+        self.carpeta.mkdir()
+        (self.carpeta / '700000.jpg').write_bytes(b'foto')
+
+    def renderizar(self, plantilla, cn):
+        return Template('{% load efp_tags %}' + plantilla).render(Context({'cn': cn}))
+
+    def test_sin_manifiesto_usa_la_carpeta(self):
+        self.assertEqual(fotos_disponibles(), {'700000'})
+        self.assertEqual(self.renderizar('{{ cn|efp_foto_url }}', '700000'), '/media/efp_imagenes/700000.jpg')
+
+    def test_sin_foto_pinta_el_placeholder_sin_peticion(self):
+        html = self.renderizar('{% efp_imagen cn 120 clase="img-fluid" %}', '799999')
+        self.assertIn('src="data:image/svg+xml,', html)
+        self.assertNotIn('/media/', html)
+        self.assertNotIn('onerror', html)
+        self.assertEqual(self.renderizar('{% if cn|efp_tiene_foto %}si{% else %}no{% endif %}', ''), 'no')
+
+    def test_manifiesto_manda_y_se_recarga_al_cambiar(self):
+        guardar_manifiesto({
+            '700000': {'estado': 'error', 'error': 'HTTP 404'},
+            '700001': {'estado': 'descargada', 'bytes': 10},
+        }, str(self.carpeta))
+        self.assertEqual(fotos_disponibles(), {'700001'})
+
+        guardar_manifiesto({'700000': {'estado': 'sin_cambios', 'bytes': 4}}, str(self.carpeta))
+        # Dentro del intervalo se sirve lo que hay en memoria, sin stat()
+        self.assertEqual(fotos_disponibles(), {'700001'})
+        manifiesto_fotos.invalidar()
+        self.assertEqual(fotos_disponibles(), {'700000'})
+        self.assertIn('/media/efp_imagenes/700000.jpg', self.renderizar('{% efp_imagen cn 60 %}', '700000'))
+
+
+@skipUnless(importlib.util.find_spec('PIL'), 'Hace falta Pillow')
+class VariantesImagenesTests(SimpleTestCase):
+
+    def setUp(self):
+        from PIL import Image
+
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        ajustes = override_settings(MEDIA_ROOT=media)
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+        self.carpeta = Path(media) / 'efp_imagenes'
+        self.carpeta.mkdir()
+        Image.new('RGB', (600, 400), 'red').save(self.carpeta / '600000.jpg')
+        Image.new('RGB', (100, 80), 'blue').save(self.carpeta / '600001.jpg')
+        (self.carpeta / '600002.jpg').write_bytes(b'no es una imagen')
+        indice_variantes.invalidar()
+
+    def renderizar(self, cn):
+        indice_variantes.invalidar()
+        return Template('{% load efp_tags %}{% efp_imagen cn 120 clase="img-fluid" %}').render(Context({'cn': cn}))
+
+    def test_genera_variantes_y_srcset(self):
+        totales = procesar_biblioteca(procesos=2)
+        self.assertEqual((totales['procesada'], totales['error']), (2, 1))
+
+        indice = leer_indice()
+        # Nunca se amplía: la foto de 100 px se queda en 64 y 100
+        self.assertEqual(sorted(indice['600000']['variantes']['webp'], key=int), ['64', '128', '256'])
+        self.assertEqual(sorted(indice['600001']['variantes']['webp'], key=int), ['64', '100'])
+        nombre = indice['600000']['variantes']['webp']['128']
+        self.assertRegex(nombre, r'^600000-128\.[0-9a-f]{10}\.webp$')
+        self.assertTrue((self.carpeta / 'variantes' / nombre).exists())
+
+        html = self.renderizar('600000')
+        self.assertIn('<source type="image/webp" srcset="/media/efp_imagenes/variantes/600000-64.', html)
+        self.assertIn('256w', html)
+        self.assertIn('sizes="120px"', html)
+        self.assertIn('loading="lazy"', html)
+        # Sin variantes: el original tal cual
+        self.assertIn('<img src="/media/efp_imagenes/600002.jpg"', self.renderizar('600002'))
+
+        # Segunda pasada: nada que hacer
+        self.assertEqual(procesar_biblioteca(procesos=2)['sin_cambios'], 2)
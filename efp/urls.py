@@ -11,4 +11,10 @@ urlpatterns = [
     path('buscador/', views.buscador, name='efp_buscador'),
     path('datos-brutos/', views.datos_brutos, name='efp_datos_brutos'),
     path('configuracion/', views.configuracion, name='efp_configuracion'),
+    path('configuracion/opciones/<int:pk>/', views.opciones_configuracion, name='efp_opciones_configuracion'),
+    path('fragmentos/competidores/<int:pk>/', views.fragmento_competidores, name='efp_fragmento_competidores'),
+    path('configuracion/masivo/', views.preferencias_masivo, name='efp_preferencias_masivo'),
+    path('configuracion/exportar/', views.exportar_preferencias, name='efp_exportar_preferencias'),
+    path('configuracion/importar/', views.importar_preferencias, name='efp_importar_preferencias'),
+    path('configuracion/copiar/', views.copiar_preferencias, name='efp_copiar_preferencias'),
 ]
\ No newline at end of file
@@ -1,54 +1,51 @@
 # efp/views.py
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import JsonResponse, HttpResponse
+from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.paginator import Paginator
 from django.db.models import Sum, Q
 from django.contrib.auth.decorators import login_required
 from .models import OportunidadEFP, PreferenciaEFP
-from .services import ICONOS_FAMILIAS, generar_pregunta_examen
-import random
+from .services import (
+    generar_pregunta_examen, recuperar_pregunta_examen, resumen_dashboard_efp,
+    buscar_oportunidades_efp, listar_datos_brutos_efp,
+    guardar_preferencias_efp_masivo, exportar_preferencias_efp_csv, leer_preferencias_efp_csv,
+    copiar_preferencias_efp, competidores_oportunidad_efp, PREFERENCIAS_EFP,
+)
+from django.conf import settings
+from django.http import Http404
+from django.utils.cache import patch_cache_control
+from core.cache_utils import obtener_version, incrementar_version
+from core.estado_examen import EstadoExamen
+from core.preferencias import avisar_resultado, siguiente_seguro
+from core.metricas import EXAMEN_RESPUESTAS
+import json
 
 # --- DASHBOARD ---
 @login_required(login_url='login')
 def dashboard(request):
     f_id = request.session.get('farmacia_activa', 'HF280050001')
-    qs = OportunidadEFP.objects.filter(farmacia_id=f_id)
-    
-    # --- LOGICA DE PREFERENCIAS ---
-    prefs = { p.id_agrupacion: p.producto_preferido for p in PreferenciaEFP.objects.filter(farmacia_id=f_id) }
-    
-    oportunidades_list = []
-    for item in qs:
-        if item.id_agrupacion in prefs:
-            prod_pref = prefs[item.id_agrupacion]
-            if item.producto_recomendado != prod_pref:
-                stats = item.get_competidores_stats()
-                match = next((s for s in stats if s['nombre'] == prod_pref), None)
-                
-                if match:
-                    item.producto_recomendado = prod_pref
-                    item.margen_pct = match['margen']
-                    item.es_preferido = True 
-        else:
-            item.es_preferido = False
-            
-        oportunidades_list.append(item)
-    
-    # Filtros de Familia
-    familias = sorted(list(set(o.familia for o in oportunidades_list)))
     familia_activa = request.GET.get('familia', 'TODAS')
-    
-    if familia_activa != 'TODAS':
-        oportunidades_list = [o for o in oportunidades_list if o.familia == familia_activa]
+    try:
+        pagina = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        pagina = 1
 
-    total_ahorro = sum(o.ahorro_potencial for o in oportunidades_list)
-    ahorro_mensual = total_ahorro / 12
+    # Tarjetas de la página con preferencias aplicadas (cacheadas por farmacia, versión, familia y página;
+    # la familia y la página se normalizan antes de construir la clave)
+    resumen = resumen_dashboard_efp(f_id, familia_activa, pagina)
 
     context = {
-        'oportunidades': oportunidades_list,
-        'familias': familias,
-        'familia_activa': familia_activa,
-        'total_ahorro': total_ahorro,
-        'ahorro_mensual': ahorro_mensual,
-        'total_referencias': len(oportunidades_list),
+        'oportunidades': resumen['oportunidades'],
+        'familias': resumen['familias'],
+        'familia_activa': resumen['familia_activa'],
+        'total_ahorro': resumen['total_ahorro'],
+        'ahorro_mensual': resumen['ahorro_mensual'],
+        'total_referencias': resumen['total_referencias'],
+        'pagina': resumen['pagina'],
+        'farmacia_activa': f_id,
+        'version_datos': obtener_version(f_id),
         'active_tab': 'dashboard', # Ilumina "Dashboard" en el menú
         'segmento': 'EFP',         # Mantiene el sidebar en modo EFP
     }
@@ -63,11 +60,7 @@ def buscador(request):
     
     if query:
         # Buscamos por nombre del grupo (síntoma) o por productos a sustituir
-        resultados = OportunidadEFP.objects.filter(farmacia_id=f_id).filter(
-            Q(nombre_grupo__icontains=query) | 
-            Q(a_sustituir__icontains=query) |
-            Q(producto_recomendado__icontains=query)
-        )
+        resultados = buscar_oportunidades_efp(f_id, query)
     
     context = {
         'query': query,
@@ -96,11 +89,13 @@ def datos_brutos(request):
     
     orden_final = order_param if order_param in campos_validos else '-ahorro_potencial'
 
-    # 3. Query Ordenada
-    datos = OportunidadEFP.objects.filter(farmacia_id=f_id).order_by(orden_final)
+    # 3. Query Ordenada (resultado cacheado)
+    datos = listar_datos_brutos_efp(f_id, orden_final)
     
     context = {
         'datos': datos,
+        'farmacia_activa': f_id,
+        'version_datos': obtener_version(f_id),
         'active_tab': 'datos_brutos',
         'segmento': 'EFP',
         'current_order': orden_final # Pasamos el orden para las flechas
@@ -108,6 +103,8 @@ def datos_brutos(request):
     return render(request, 'efp/datos_brutos.html', context)
 
 # --- CONFIGURACIÓN ---
+GRUPOS_POR_PAGINA = 50
+
 @login_required(login_url='login')
 def configuracion(request):
     f_id = request.session.get('farmacia_activa', 'HF280050001')
@@ -127,21 +124,30 @@ def configuracion(request):
             else:
                 # Si viene vacío o "Automático", borramos
                 PreferenciaEFP.objects.filter(farmacia_id=f_id, id_agrupacion=id_agrupacion).delete()
+            incrementar_version(f_id)
         
-        return redirect('efp_configuracion')
+        # Volvemos a la misma página y filtro
+        return redirect(request.get_full_path())
 
-    # 2. Cargar datos para la vista
-    qs = OportunidadEFP.objects.filter(farmacia_id=f_id).order_by('nombre_grupo')
-    prefs = { p.id_agrupacion: p.producto_preferido for p in PreferenciaEFP.objects.filter(farmacia_id=f_id) }
+    # 2. Cargar la página de grupos (filtrada por texto). Las opciones de
+    #    cada grupo se piden al desplegar su fila (`opciones_configuracion`).
+    query = request.GET.get('q', '')
+    qs = OportunidadEFP.objects.filter(farmacia_id=f_id).only(
+        'id', 'id_agrupacion', 'nombre_grupo', 'producto_recomendado'
+    ).order_by('nombre_grupo')
+    if query:
+        qs = qs.filter(nombre_grupo__icontains=query)
+
+    page_obj = Paginator(qs, GRUPOS_POR_PAGINA).get_page(request.GET.get('page'))
+    prefs = {
+        p.id_agrupacion: p.producto_preferido
+        for p in PreferenciaEFP.objects.filter(
+            farmacia_id=f_id, id_agrupacion__in=[item.id_agrupacion for item in page_obj]
+        )
+    }
     
     lista_config = []
-    for item in qs:
-        opciones = [item.producto_recomendado]
-        stats = item.get_competidores_stats()
-        for s in stats:
-            if s['nombre'] not in opciones:
-                opciones.append(s['nombre'])
-        
+    for item in page_obj:
         valor_actual = prefs.get(item.id_agrupacion, item.producto_recomendado)
         es_manual = item.id_agrupacion in prefs
         
@@ -149,16 +155,54 @@ def configuracion(request):
             'item': item,
             'valor_actual': valor_actual,
             'es_manual': es_manual,
-            'opciones': sorted(opciones)
         })
 
     context = {
         'lista_config': lista_config,
+        'page_obj': page_obj,
+        'query': query,
         'active_tab': 'configuracion',
         'segmento': 'EFP'
     }
     return render(request, 'efp/configuracion.html', context)
 
+@login_required(login_url='login')
+def opciones_configuracion(request, pk):
+    """Devuelve en JSON las opciones de preferencia de un grupo EFP (carga diferida)."""
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    item = get_object_or_404(OportunidadEFP, pk=pk, farmacia_id=f_id)
+    return JsonResponse({'opciones': item.get_opciones()})
+
+# --- FRAGMENTOS (carga diferida) ---
+# formato -> (plantilla, aplicar la preferencia manual como en las tarjetas)
+FRAGMENTOS_COMPETIDORES = {
+    'alternativas': ('efp/fragmentos/alternativas.html', True),         # Desplegable del dashboard
+    'preferencia': ('efp/fragmentos/opciones_preferencia.html', True),  # Modal de preferencia
+    'tabla': ('efp/fragmentos/competidores_tabla.html', False),         # Datos brutos
+}
+
+
+@login_required(login_url='login')
+def fragmento_competidores(request, pk):
+    """
+    HTML de las alternativas de un grupo EFP, que la página pide al abrirlo.
+
+    `?formato=` elige la plantilla (ver FRAGMENTOS_COMPETIDORES); con la versión
+    de datos actual en `v` el navegador puede guardarlo hasta que cambien.
+    """
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    formato = FRAGMENTOS_COMPETIDORES.get(request.GET.get('formato', 'tabla'))
+    if formato is None:
+        raise Http404("Fragmento no encontrado")
+    plantilla, con_preferencia = formato
+    detalle = competidores_oportunidad_efp(f_id, pk, con_preferencia)
+    if detalle is None:
+        raise Http404("Fragmento no encontrado")
+    respuesta = render(request, plantilla, detalle)
+    if request.GET.get('v') == str(obtener_version(f_id)):
+        patch_cache_control(respuesta, private=True, max_age=settings.FARMA_CACHE_TIMEOUT)
+    return respuesta
+
 # --- ENTRENAMIENTO ---
 @login_required(login_url='login')
 def entrenamiento(request):
@@ -182,133 +226,117 @@ def entrenamiento(request):
     return render(request, 'efp/entrenamiento.html', context)
 
 # --- EXAMEN ---
+def _fin_examen_efp(request, aciertos, total, max_preguntas):
+    score = (aciertos / max_preguntas * 100) if total > 0 else 0
+    if score == 100: feedback_text = "¡Eres un experto en Venta Libre! 🌟"
+    elif score >= 50: feedback_text = "Buen trabajo, sigue practicando. 💪"
+    else: feedback_text = "Revisa los márgenes y grupos de las EFP. ¡Ánimo! 📚"
+    
+    context = {
+        'finalizado': True,
+        'aciertos': aciertos,
+        'total': total,
+        'score': score,
+        'feedback': feedback_text,
+        'active_tab': 'examen',
+        'segmento': 'EFP',
+    }
+    return render(request, 'efp/examen.html', context)
+
 @login_required(login_url='login')
 def examen(request):
     f_id = request.session.get('farmacia_activa', 'HF280050001')
     MAX_PREGUNTAS = 10 
 
+    # Estado compacto en sesión: contadores + ids/índices (ver core/estado_examen.py)
+    estado = EstadoExamen(request.session, 'examen_efp')
+
     # 1. Reset
-    if 'reset' in request.GET or 'efp_stats' not in request.session:
-        request.session['efp_stats'] = {'aciertos': 0, 'total': 0}
-        request.session.pop('pregunta_actual', None)
-        request.session.pop('resultado_pendiente', None)
-        request.session.modified = True
+    if 'reset' in request.GET or not estado.iniciado:
+        estado.reiniciar()
         if 'reset' in request.GET:
             return redirect('efp_examen')
 
-    stats = request.session.get('efp_stats', {'aciertos': 0, 'total': 0})
-
     # 2. Verificar fin de examen
-    if stats['total'] >= MAX_PREGUNTAS:
-        score = (stats['aciertos'] / MAX_PREGUNTAS * 100) if stats['total'] > 0 else 0
-        if score == 100: feedback_text = "¡Eres un experto en Venta Libre! 🌟"
-        elif score >= 50: feedback_text = "Buen trabajo, sigue practicando. 💪"
-        else: feedback_text = "Revisa los márgenes y grupos de las EFP. ¡Ánimo! 📚"
-        
-        request.session.pop('resultado_pendiente', None)
-        context = {
-            'finalizado': True,
-            'aciertos': stats['aciertos'],
-            'total': MAX_PREGUNTAS,
-            'score': score,
-            'feedback': feedback_text,
-            'active_tab': 'examen',
-            'segmento': 'EFP',
-        }
-        return render(request, 'efp/examen.html', context)
+    if estado.total >= MAX_PREGUNTAS:
+        estado.resultado = None
+        estado.guardar()
+        return _fin_examen_efp(request, estado.aciertos, MAX_PREGUNTAS, MAX_PREGUNTAS)
 
     # 3. Si hay resultado pendiente, mostrarlo y borrarlo
-    resultado_pendiente = request.session.pop('resultado_pendiente', None)
-    if resultado_pendiente:
-        # También borra pregunta actual para que genere una nueva en el siguiente GET
-        request.session.pop('pregunta_actual', None)
-        request.session.modified = True
-        context = resultado_pendiente
-        return render(request, 'efp/examen.html', context)
-
-    # 4. Procesar respuesta del usuario
-    if request.method == 'POST' and 'opcion' in request.POST:
-        pregunta_data = request.session.get('pregunta_actual')
+    if estado.resultado:
+        id_pregunta, indices, idx_elegido = estado.resultado
+        estado.resultado = None
+        estado.guardar()
+        pregunta_data = recuperar_pregunta_examen(f_id, id_pregunta, indices)
         if pregunta_data:
-            seleccion_usuario = request.POST.get('opcion')
-            correcto = pregunta_data.get('producto_correcto')
-            pregunta_texto = request.POST.get('pregunta_texto', pregunta_data.get('pregunta_texto', 'medicina'))
-            
-            # Asegurar encoding UTF-8
-            if isinstance(seleccion_usuario, bytes):
-                seleccion_usuario = seleccion_usuario.decode('utf-8')
-            if isinstance(correcto, bytes):
-                correcto = correcto.decode('utf-8')
-            if isinstance(pregunta_texto, bytes):
-                pregunta_texto = pregunta_texto.decode('utf-8')
-            
-            stats['total'] += 1
-            if seleccion_usuario == correcto:
-                stats['aciertos'] += 1
-                es_correcto = True
+            seleccion_usuario = pregunta_data['opciones'][idx_elegido]['nombre']
+            correcto = pregunta_data['producto_correcto']
+            es_correcto = seleccion_usuario == correcto
+            if es_correcto:
                 mensaje = "¡Correcto! Es la opción adecuada para este grupo."
             else:
-                es_correcto = False
-                mensaje = f"Incorrecto. El paciente pide: {pregunta_texto}. Tú elegiste: {seleccion_usuario}. La opción óptima es: {correcto}"
-            
-            request.session['efp_stats'] = stats
-            request.session.pop('pregunta_actual', None)  # Borra pregunta actual para generar nueva
-            
-            # Guardar resultado para mostrar en siguiente render
-            request.session['resultado_pendiente'] = {
+                mensaje = f"Incorrecto. El paciente pide: {pregunta_data['pregunta_texto']}. Tú elegiste: {seleccion_usuario}. La opción óptima es: {correcto}"
+            context = {
                 'pregunta': pregunta_data,
                 'mensaje': mensaje,
                 'es_correcto': es_correcto,
                 'seleccion_usuario': seleccion_usuario,
-                'aciertos': stats['aciertos'],
-                'total_jugado': stats['total'],
+                'aciertos': estado.aciertos,
+                'total_jugado': estado.total,
                 'total_max': MAX_PREGUNTAS,
                 'mostrar_feedback_solo': True,
                 'active_tab': 'examen',
                 'segmento': 'EFP',
                 'finalizado': False
             }
-            request.session.modified = True
+            return render(request, 'efp/examen.html', context)
+
+    # 4. Procesar respuesta del usuario (la opción llega como índice de la lista mostrada)
+    if request.method == 'POST' and 'opcion' in request.POST and estado.pregunta:
+        id_pregunta, indices = estado.pregunta
+        pregunta_data = recuperar_pregunta_examen(f_id, id_pregunta, indices)
+        try:
+            idx_elegido = int(request.POST.get('opcion'))
+        except (TypeError, ValueError):
+            idx_elegido = -1
+
+        if pregunta_data and 0 <= idx_elegido < len(indices):
+            estado.total += 1
+            acierto = pregunta_data['opciones'][idx_elegido]['nombre'] == pregunta_data['producto_correcto']
+            EXAMEN_RESPUESTAS.inc(examen='efp', resultado='acierto' if acierto else 'fallo')
+            if acierto:
+                estado.aciertos += 1
+            
+            # Borra pregunta actual para generar nueva y deja el resultado para el siguiente GET
+            estado.pregunta = None
+            estado.resultado = [id_pregunta, indices, idx_elegido]
+            estado.guardar()
             
-            # Redirect a GET para que procese resultado_pendiente
+            # Redirect a GET para que procese el resultado pendiente
             return redirect('efp_examen')
 
-    # 5. Generar nueva pregunta
-    pregunta_data = request.session.get('pregunta_actual')
+    # 5. Generar nueva pregunta (o recuperar la que está sin responder)
+    pregunta_data = None
+    if estado.pregunta:
+        pregunta_data = recuperar_pregunta_examen(f_id, *estado.pregunta)
     if not pregunta_data:
-        nueva_pregunta = generar_pregunta_examen(f_id)
-        if not nueva_pregunta:
+        pregunta_data = generar_pregunta_examen(f_id)
+        if not pregunta_data:
             # Se acabaron preguntas: fuerza fin de examen
-            stats['total'] = MAX_PREGUNTAS
-            request.session['efp_stats'] = stats
-            request.session.modified = True
-            
-            score = (stats['aciertos'] / MAX_PREGUNTAS * 100)
-            if score == 100: feedback_text = "¡Eres un experto en Venta Libre! 🌟"
-            elif score >= 50: feedback_text = "Buen trabajo, sigue practicando. 💪"
-            else: feedback_text = "Revisa los márgenes y grupos de las EFP. ¡Ánimo! 📚"
-            
-            context = {
-                'finalizado': True,
-                'aciertos': stats['aciertos'],
-                'total': stats['total'],
-                'score': score,
-                'feedback': feedback_text,
-                'active_tab': 'examen',
-                'segmento': 'EFP',
-            }
-            return render(request, 'efp/examen.html', context)
+            estado.total = MAX_PREGUNTAS
+            estado.guardar()
+            return _fin_examen_efp(request, estado.aciertos, estado.total, MAX_PREGUNTAS)
         
-        request.session['pregunta_actual'] = nueva_pregunta
-        request.session.modified = True
-        pregunta_data = nueva_pregunta
+        estado.pregunta = [pregunta_data['id_pregunta'], pregunta_data['indices']]
+        estado.guardar()
 
     # 6. Mostrar pregunta normal
     context = {
         'pregunta': pregunta_data,
         'mostrar_feedback_solo': False,
-        'aciertos': stats['aciertos'],
-        'total_jugado': stats['total'],
+        'aciertos': estado.aciertos,
+        'total_jugado': estado.total,
         'total_max': MAX_PREGUNTAS,
         'active_tab': 'examen',
         'segmento': 'EFP',
@@ -332,6 +360,74 @@ def set_preferencia_efp(request):
             )
         else:
             PreferenciaEFP.objects.filter(farmacia_id=f_id, id_agrupacion=id_agrupacion).delete()
+        incrementar_version(f_id)
             
-        return redirect(request.POST.get('next', 'efp_dashboard'))
-    return redirect('efp_dashboard')
\ No newline at end of file
+        return redirect(siguiente_seguro(request, 'efp_dashboard'))
+    return redirect('efp_dashboard')
+
+# --- PREFERENCIAS EN BLOQUE ---
+@login_required(login_url='login')
+def preferencias_masivo(request):
+    """
+    Guarda muchas preferencias EFP de una vez.
+
+    Acepta un formulario (listas paralelas `id_agrupacion`/`producto`) o JSON:
+    {"preferencias": [{"id_agrupacion", "producto"}]}. Producto vacío = automático.
+    """
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    if request.method != 'POST':
+        return redirect('efp_configuracion')
+
+    es_json = request.content_type == 'application/json'
+    if es_json:
+        try:
+            cambios = json.loads(request.body).get('preferencias', [])
+        except (ValueError, AttributeError):
+            return JsonResponse({'error': 'JSON no válido'}, status=400)
+        if not isinstance(cambios, list):
+            return JsonResponse({'error': '"preferencias" debe ser una lista'}, status=400)
+    else:
+        cambios = [
+            {'id_agrupacion': i, 'producto': p}
+            for i, p in zip(request.POST.getlist('id_agrupacion'), request.POST.getlist('producto'))
+        ]
+
+    aplicadas, errores = guardar_preferencias_efp_masivo(f_id, cambios)
+
+    if es_json:
+        return JsonResponse({'aplicadas': aplicadas, 'errores': errores})
+
+    avisar_resultado(request, PREFERENCIAS_EFP, aplicadas, errores)
+    return redirect(siguiente_seguro(request, 'efp_configuracion'))
+
+@login_required(login_url='login')
+def exportar_preferencias(request):
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    response = HttpResponse(exportar_preferencias_efp_csv(f_id), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="preferencias_efp_{f_id}.csv"'
+    return response
+
+@login_required(login_url='login')
+def importar_preferencias(request):
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    archivo = request.FILES.get('archivo')
+    if request.method == 'POST' and archivo:
+        try:
+            cambios = leer_preferencias_efp_csv(archivo.read().decode('utf-8-sig'))
+        except UnicodeDecodeError:
+            messages.error(request, "El fichero debe ser un CSV en UTF-8.")
+        else:
+            aplicadas, errores = guardar_preferencias_efp_masivo(f_id, cambios)
+            avisar_resultado(request, PREFERENCIAS_EFP, aplicadas, errores)
+    return redirect('efp_configuracion')
+
+@staff_member_required
+def copiar_preferencias(request):
+    """Copia las preferencias EFP de la farmacia activa a otras (solo admins)."""
+    f_id = request.session.get('farmacia_activa', 'HF280050001')
+    if request.method == 'POST':
+        destinos = [d.strip() for d in request.POST.get('destinos', '').split(',') if d.strip()]
+        resultados = copiar_preferencias_efp(f_id, destinos)
+        for destino, (aplicadas, errores) in resultados.items():
+            messages.info(request, f"{destino}: {aplicadas} preferencias copiadas, {len(errores)} omitidas.")
+    return redirect('efp_configuracion')
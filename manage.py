@@ -2,9 +2,6 @@
 """Django's command-line utility for administrative tasks."""
 import os
 import sys
-from dotenv import load_dotenv
-
-load_dotenv()  # carga .env en os.environ
 
 def main():
     """Run administrative tasks."""